@@ -0,0 +1,24 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Performance benchmarks for the Tractor's hot paths: rendering, derivatives,
+optimizer update directions and forced photometry.  Everything is built
+from synthetic data (see `benchmarks.common`), so no data files or network
+access are needed.
+
+The benchmarks follow the airspeed velocity (asv) conventions: classes with
+`params`, `setup`, and `time_*` / `peakmem_*` methods.  Build the C
+extensions ("make") and then either use asv, with the configuration in
+asv.conf.json at the top level,
+
+    asv run --python=same
+    asv continuous --python=same main HEAD
+
+or, without asv installed,
+
+    python -m benchmarks [substring]
+
+which prints the time per call of each `time_*` benchmark and the peak
+(tracemalloc) memory allocated during each `peakmem_*` benchmark.
+'''
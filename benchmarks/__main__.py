@@ -0,0 +1,98 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+A small runner for the benchmarks, for when asv is not installed:
+
+    python -m benchmarks [substring ...]
+
+runs the benchmarks whose names contain any of the given substrings (all
+of them by default), for every combination of their parameters.
+'''
+from __future__ import print_function
+
+import sys
+import os
+import importlib
+import itertools
+import timeit
+import tracemalloc
+
+def find_benchmarks():
+    pkg = os.path.dirname(os.path.abspath(__file__))
+    for fn in sorted(os.listdir(pkg)):
+        if not (fn.startswith('bench_') and fn.endswith('.py')):
+            continue
+        mod = importlib.import_module('benchmarks.' + fn[:-3])
+        for clsname in sorted(dir(mod)):
+            cls = getattr(mod, clsname)
+            if not isinstance(cls, type) or cls.__module__ != mod.__name__:
+                continue
+            for meth in sorted(dir(cls)):
+                if meth.startswith('time_') or meth.startswith('peakmem_'):
+                    yield '%s.%s.%s' % (fn[:-3], clsname, meth), cls, meth
+
+def run_one(cls, meth, args):
+    '''
+    Returns seconds per call for time_* benchmarks, peak bytes for
+    peakmem_* benchmarks, or None if setup() skipped these parameters.
+    '''
+    def setup():
+        obj = cls()
+        if hasattr(obj, 'setup'):
+            try:
+                obj.setup(*args)
+            except NotImplementedError:
+                return None
+        return obj
+
+    obj = setup()
+    if obj is None:
+        return None
+    func = getattr(obj, meth)
+    if meth.startswith('peakmem_'):
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    number = getattr(cls, 'number', 0)
+    repeat = getattr(cls, 'repeat', 3)
+    if not number:
+        timer = timeit.Timer(lambda: func(*args))
+        number, t = timer.autorange()
+        best = t / number
+        for i in range(repeat - 1):
+            best = min(best, timer.timeit(number) / number)
+        return best
+    best = None
+    for i in range(repeat):
+        if i:
+            obj = setup()
+            func = getattr(obj, meth)
+        t = timeit.Timer(lambda: func(*args)).timeit(number) / number
+        best = t if best is None else min(best, t)
+    return best
+
+def main(patterns):
+    for name, cls, meth in find_benchmarks():
+        if patterns and not any(p in name for p in patterns):
+            continue
+        params = getattr(cls, 'params', [])
+        if len(params) and not isinstance(params[0], (list, tuple)):
+            params = [params]
+        for args in itertools.product(*params):
+            r = run_one(cls, meth, args)
+            label = '%s(%s)' % (name, ', '.join(str(a) for a in args))
+            if r is None:
+                val = 'skipped'
+            elif meth.startswith('peakmem_'):
+                val = '%.1f MB' % (r / 1e6)
+            else:
+                val = '%.3f ms' % (r * 1e3)
+            print('%-72s %12s' % (label, val))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,102 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Benchmarks of derivatives, optimizer update directions, fitting and
+forced photometry.
+'''
+from __future__ import print_function
+
+from tractor.lsqr_optimizer import LsqrOptimizer
+
+from .common import make_tractor, perturb
+
+class Derivatives(object):
+    '''
+    Tractor.getDerivs, for all source parameters.
+    '''
+    params = [['point', 'exp', 'sersic'], [10, 100], [128, 512]]
+    param_names = ['source', 'nsrcs', 'size']
+
+    def setup(self, srckind, nsrcs, size):
+        self.tractor = make_tractor(srckind, 'mog', nsrcs, size)
+        perturb(self.tractor)
+
+    def time_getDerivs(self, *args):
+        self.tractor.getDerivs()
+
+    def peakmem_getDerivs(self, *args):
+        self.tractor.getDerivs()
+
+class UpdateDirection(object):
+    '''
+    LsqrOptimizer.getUpdateDirection, given precomputed derivatives.
+    '''
+    params = [['point', 'exp'], [10, 100], [128, 512]]
+    param_names = ['source', 'nsrcs', 'size']
+
+    def setup(self, srckind, nsrcs, size):
+        self.tractor = make_tractor(srckind, 'mog', nsrcs, size)
+        perturb(self.tractor)
+        self.derivs = self.tractor.getDerivs()
+        self.optimizer = LsqrOptimizer()
+
+    def time_getUpdateDirection(self, *args):
+        self.optimizer.getUpdateDirection(self.tractor, self.derivs)
+
+    def peakmem_getUpdateDirection(self, *args):
+        self.optimizer.getUpdateDirection(self.tractor, self.derivs)
+
+class OptimizeLoop(object):
+    '''
+    Tractor.optimize_loop from a perturbed catalog to convergence.
+    '''
+    params = [['point', 'exp'], [10, 50], [128, 256]]
+    param_names = ['source', 'nsrcs', 'size']
+    # the fit changes the parameters: reset them before every call
+    number = 1
+    repeat = 3
+
+    def setup(self, srckind, nsrcs, size):
+        self.tractor = make_tractor(srckind, 'mog', nsrcs, size)
+        self.p0 = perturb(self.tractor)
+
+    def time_optimize_loop(self, *args):
+        self.tractor.setParams(self.p0)
+        self.tractor.optimize_loop()
+
+    def peakmem_optimize_loop(self, *args):
+        self.tractor.setParams(self.p0)
+        self.tractor.optimize_loop()
+
+class ForcedPhotometry(object):
+    '''
+    Tractor.optimize_forced_photometry (fluxes only) with the LSQR and
+    Ceres optimizers; the Ceres cases are skipped if it is not built.
+    '''
+    params = [['lsqr', 'ceres'], ['point', 'exp'], [10, 100], [128, 512]]
+    param_names = ['optimizer', 'source', 'nsrcs', 'size']
+    number = 1
+    repeat = 5
+
+    def setup(self, optimizer, srckind, nsrcs, size):
+        if optimizer == 'ceres':
+            try:
+                from tractor.ceres_optimizer import CeresOptimizer
+                import tractor.ceres
+            except ImportError:
+                # asv's convention for "skip this parameter combination"
+                raise NotImplementedError('Ceres is not available')
+        tr = make_tractor(srckind, 'mog', nsrcs, size)
+        perturb(tr)
+        tr.freezeAllRecursive()
+        tr.thawPathsTo('brightness')
+        if optimizer == 'ceres':
+            tr.optimizer = CeresOptimizer()
+        self.tractor = tr
+
+    def time_forced_photometry(self, *args):
+        self.tractor.optimize_forced_photometry(shared_params=False)
+
+    def peakmem_forced_photometry(self, *args):
+        self.tractor.optimize_forced_photometry(shared_params=False)
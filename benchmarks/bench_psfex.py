@@ -0,0 +1,38 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Benchmarks of evaluating spatially-varying PsfEx models.
+'''
+from __future__ import print_function
+
+from tractor.psfex import PixelizedPsfEx
+
+from .common import make_psfex_model
+
+class PsfExModelAt(object):
+    '''
+    PsfExModel.at, which sums the polynomial-weighted eigen-PSFs.
+    '''
+    params = [[0, 2, 3], [25, 63]]
+    param_names = ['degree', 'stamp']
+
+    def setup(self, degree, stamp):
+        self.psfex = make_psfex_model(degree=degree, size=stamp)
+
+    def time_at(self, *args):
+        self.psfex.at(100., 200.)
+
+class PixelizedPsfExConstant(object):
+    '''
+    PixelizedPsfEx.constantPsfAt, which builds a PixelizedPSF.
+    '''
+    params = [[0, 2], [25, 63]]
+    param_names = ['degree', 'stamp']
+
+    def setup(self, degree, stamp):
+        self.psf = PixelizedPsfEx(
+            None, psfex=make_psfex_model(degree=degree, size=stamp))
+
+    def time_constantPsfAt(self, *args):
+        self.psf.constantPsfAt(100., 200.)
@@ -0,0 +1,43 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Benchmarks of model-image rendering.
+'''
+from __future__ import print_function
+
+from .common import make_tractor, source_types, psf_types
+
+class RenderModelImage(object):
+    '''
+    Tractor.getModelImage for each source and PSF type.
+    '''
+    params = [source_types, psf_types, [10, 100], [128, 512]]
+    param_names = ['source', 'psf', 'nsrcs', 'size']
+
+    def setup(self, srckind, psfkind, nsrcs, size):
+        self.tractor = make_tractor(srckind, psfkind, nsrcs, size)
+        # first call: builds any per-PSF caches (eg, FFTs)
+        self.tractor.getModelImage(0)
+
+    def time_getModelImage(self, *args):
+        self.tractor.getModelImage(0)
+
+    def peakmem_getModelImage(self, *args):
+        self.tractor.getModelImage(0)
+
+class RenderModelPatch(object):
+    '''
+    The per-source path: getModelPatch on each source in turn.
+    '''
+    params = [source_types, psf_types]
+    param_names = ['source', 'psf']
+
+    def setup(self, srckind, psfkind):
+        self.tractor = make_tractor(srckind, psfkind, 25, 256)
+        self.image = self.tractor.getImage(0)
+        self.time_getModelPatch()
+
+    def time_getModelPatch(self, *args):
+        for src in self.tractor.getCatalog():
+            src.getModelPatch(self.image)
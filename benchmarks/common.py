@@ -0,0 +1,134 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Synthetic images, PSFs and catalogs shared by the benchmarks.  All of
+these are deterministic given their arguments.
+'''
+from __future__ import print_function
+
+import numpy as np
+
+from tractor import (Image, Tractor, PointSource, PixPos, Flux,
+                     LinearPhotoCal, ConstantSky, GaussianMixturePSF,
+                     PixelizedPSF, EllipseE, ExpGalaxy, DevGalaxy)
+from tractor.psfex import PsfExModel, PixelizedPsfEx
+from tractor.sersic import SersicGalaxy, SersicIndex
+
+source_types = ['point', 'exp', 'dev', 'sersic']
+psf_types = ['mog', 'pixelized', 'psfex']
+
+# A three-component, roughly 2.5-pixel FWHM PSF
+psf_amps = np.array([0.7, 0.25, 0.05])
+psf_vars = np.array([1.1, 3., 10.])
+
+def psf_stamp(size=25, scale=1.):
+    '''
+    Returns a *size* x *size* float32 image of the mixture-of-Gaussians
+    PSF, normalized to unit sum, with its variances scaled by *scale*.
+    '''
+    r = np.arange(size) - size // 2
+    rr = (r[np.newaxis, :]**2 + r[:, np.newaxis]**2)
+    img = np.zeros((size, size))
+    for a, v in zip(psf_amps, psf_vars * scale):
+        img += a / (2. * np.pi * v) * np.exp(-0.5 * rr / v)
+    img /= img.sum()
+    return img.astype(np.float32)
+
+def make_psfex_model(degree=2, size=25, W=512, H=512):
+    '''
+    Returns a PsfExModel whose polynomial terms, over a *W* x *H* image,
+    slowly change the PSF width.
+    '''
+    nb = (degree + 1) * (degree + 2) // 2
+    base = psf_stamp(size)
+    bases = [base]
+    for i in range(1, nb):
+        # differences of widths, so that every term has zero sum
+        bases.append(0.05 / i * (psf_stamp(size, 1. + 0.1 * i) - base))
+    psfex = PsfExModel()
+    psfex.psfbases = np.array(bases, np.float32)
+    psfex.degree = degree
+    psfex.x0, psfex.y0 = W / 2., H / 2.
+    psfex.xscale, psfex.yscale = W / 2., H / 2.
+    psfex.sampling = 1.
+    psfex.radius = (size + 1) / 2.
+    psfex.fwhm = 2.5
+    return psfex
+
+def make_psf(kind, W=512, H=512):
+    '''
+    *kind*: one of *psf_types*.
+    '''
+    if kind == 'mog':
+        K = len(psf_amps)
+        return GaussianMixturePSF(psf_amps, np.zeros((K, 2)),
+                                  np.array([np.eye(2) * v for v in psf_vars]))
+    if kind == 'pixelized':
+        return PixelizedPSF(psf_stamp())
+    if kind == 'psfex':
+        return PixelizedPsfEx(None, psfex=make_psfex_model(W=W, H=H))
+    raise ValueError('Unknown PSF type "%s"' % kind)
+
+def make_catalog(kind, nsrcs, W, H, seed=42):
+    '''
+    Returns a list of *nsrcs* sources of type *kind* (one of
+    *source_types*) scattered over a *W* x *H* image.
+    '''
+    rng = np.random.RandomState(seed)
+    margin = 8
+    srcs = []
+    for i in range(nsrcs):
+        pos = PixPos(rng.uniform(margin, W - margin),
+                     rng.uniform(margin, H - margin))
+        flux = Flux(10.**rng.uniform(2., 4.))
+        if kind == 'point':
+            srcs.append(PointSource(pos, flux))
+            continue
+        shape = EllipseE(rng.uniform(1., 4.), rng.uniform(-0.3, 0.3),
+                         rng.uniform(-0.3, 0.3))
+        if kind == 'exp':
+            srcs.append(ExpGalaxy(pos, flux, shape))
+        elif kind == 'dev':
+            srcs.append(DevGalaxy(pos, flux, shape))
+        elif kind == 'sersic':
+            srcs.append(SersicGalaxy(pos, flux, shape,
+                                     SersicIndex(rng.uniform(1., 4.))))
+        else:
+            raise ValueError('Unknown source type "%s"' % kind)
+    return srcs
+
+def make_tractor(srckind='point', psfkind='mog', nsrcs=10, size=128,
+                 seed=42, noise=1.):
+    '''
+    Returns a Tractor with one *size* x *size* image whose pixels are the
+    model of a synthetic catalog plus Gaussian noise of standard deviation
+    *noise*.  The image parameters are frozen; the catalog is thawed.
+    '''
+    W = H = size
+    tim = Image(data=np.zeros((H, W), np.float32),
+                inverr=np.zeros((H, W), np.float32) + 1. / noise,
+                psf=make_psf(psfkind, W=W, H=H),
+                photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+    cat = make_catalog(srckind, nsrcs, W, H, seed=seed)
+    tr = Tractor([tim], cat)
+    tr.freezeParam('images')
+    rng = np.random.RandomState(seed + 1)
+    tim.data[:, :] = (tr.getModelImage(0) +
+                      rng.normal(scale=noise, size=(H, W)))
+    return tr
+
+def perturb(tr, seed=43):
+    '''
+    Moves the sources by about a tenth of a pixel and changes their fluxes
+    by about 10 percent, the starting point for the fitting benchmarks.
+    Returns the perturbed parameter vector.
+    '''
+    rng = np.random.RandomState(seed)
+    for src in tr.getCatalog():
+        x, y = src.pos.getParams()
+        src.pos.setParams([x + rng.normal(scale=0.1),
+                           y + rng.normal(scale=0.1)])
+        src.brightness.setParams([src.brightness.getValue() *
+                                  (1. + rng.normal(scale=0.1))])
+    return tr.getParams()
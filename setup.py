@@ -47,12 +47,25 @@ module_ceres = Extension('tractor._ceres',
                          swig_opts=['-c++'],
                          )
 
+# OpenMP, for the multi-threaded batched EM fit (em_fit_2d_reg_batch)
+# and multi-source rendering (c_gauss_2d_multi)
+em_kwargs = {}
+if sys.platform.startswith('linux') and os.environ.get('CC') != 'icc':
+    em_kwargs.update(extra_compile_args=['-fopenmp'],
+                     extra_link_args=['-fopenmp'])
+
+# (c_gauss_2d_multi's pixel loops vectorize without FP trapping semantics)
+mix_kwargs = {}
+if em_kwargs:
+    mix_kwargs.update(extra_compile_args=['-fopenmp', '-fno-trapping-math'],
+                      extra_link_args=['-fopenmp'])
+
 module_mix = Extension('tractor._mix',
                        sources = ['tractor/mix.i'],
                        include_dirs = numpy_inc,
                        extra_objects = [],
                        undef_macros=['NDEBUG'],
-    )
+                       **mix_kwargs)
 #extra_compile_args=['-O0','-g'],
 #extra_link_args=['-O0', '-g'],
 
@@ -61,7 +74,7 @@ module_em = Extension('tractor._emfit',
                       include_dirs = numpy_inc,
                       extra_objects = [],
                       undef_macros=['NDEBUG'],
-                      )
+                      **em_kwargs)
 
 kwargs = {}
 if os.environ.get('CC') == 'icc':
@@ -138,7 +138,68 @@ class ForcedPhotTest(unittest.TestCase):
         print('Predicted val:', pval)
         
         self.assertAlmostEqual(src.getParams()[0], pval, 6)
-        
+
+    def test_dense_optimizer(self):
+        H,W = 30, 32
+        rng = np.random.RandomState(42)
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    inverr=np.ones((H,W), np.float32) * 2.,
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        srcs = [PointSource(PixPos(10., 12.), Flux(100.)),
+                PointSource(PixPos(14., 13.), Flux(50.)),
+                PointSource(PixPos(22., 20.), Flux(80.))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        tim.data += tr.getModelImage(0) + rng.normal(scale=0.5, size=(H,W))
+        for src in srcs:
+            src.brightness.setParams([60.])
+
+        lsqr = tr.optimizer
+        dense = ConstrainedDenseOptimizer()
+        derivs = tr.getDerivs()
+        for kw in [dict(shared_params=False), dict(damp=1.), dict()]:
+            X0 = lsqr.getUpdateDirection(tr, derivs, **kw)
+            X1 = dense.getUpdateDirection(tr, derivs, **kw)
+            self.assertTrue(np.allclose(X0, X1, rtol=1e-3, atol=1e-3))
+        # the same (conditional) variances as LSQR
+        X0,v0 = lsqr.getUpdateDirection(tr, derivs, variance=True)
+        X1,v1 = dense.getUpdateDirection(tr, derivs, variance=True)
+        self.assertTrue(np.allclose(X0, X1, rtol=1e-3, atol=1e-3))
+        self.assertTrue(np.allclose(v0, v1, rtol=1e-4))
+        # too-sparse matrices are handed to LSQR
+        sparse = ConstrainedDenseOptimizer(min_fill=1.)
+        X2 = sparse.getUpdateDirection(tr, derivs)
+        self.assertTrue(np.allclose(X0, X2))
+        X2,v2 = sparse.getUpdateDirection(tr, derivs, variance=True)
+        self.assertTrue(np.allclose(v0, v2, rtol=1e-4))
+        # marginal variances: the same with and without the fallback
+        mdense = ConstrainedDenseOptimizer(marginal_variance=True)
+        msparse = ConstrainedDenseOptimizer(marginal_variance=True,
+                                            min_fill=1.)
+        for kw in [dict(damp=1.), dict()]:
+            X3,v3 = mdense.getUpdateDirection(tr, derivs, variance=True, **kw)
+            X4,v4 = msparse.getUpdateDirection(tr, derivs, variance=True,
+                                               **kw)
+            self.assertTrue(np.allclose(v3, v4, rtol=1e-3))
+        # and >= the conditional ones; larger for the overlapping sources'
+        # fluxes
+        self.assertTrue(np.all(v3 >= v0 * 0.999))
+        self.assertTrue(v3[2] > v0[2] * 1.1)
+        self.assertTrue(v3[5] > v0[5] * 1.1)
+
+        tr.freezeAllRecursive()
+        tr.thawPathsTo('brightness')
+        tr.setParams([0., 0., 0.])
+        tr.optimize_forced_photometry()
+        f0 = tr.getParams()
+        tr.setParams([0., 0., 0.])
+        tr.optimizer = dense
+        R = tr.optimize_forced_photometry(variance=True, fitstats=True)
+        self.assertTrue(np.allclose(tr.getParams(), f0, rtol=1e-4))
+        self.assertEqual(len(R.IV), 3)
+        self.assertEqual(len(R.fitstats.prochi2), 3)
+
 if __name__ == '__main__':
     # import sys
     # if '--plots' in sys.argv:
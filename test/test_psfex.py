@@ -93,6 +93,22 @@ class PsfExTest(unittest.TestCase):
             ps.savefig()
             
         
+    def test_fromstamps(self):
+        ims = []
+        for x,y in [(0,0), (1000,0), (2000,0), (0,4000), (1000,4000)]:
+            im = self.psf.constantPsfAt(x, y).img
+            ims.append(im / np.sum(im))
+        # warm-start each fit from the previous one
+        init = [-1, 0, 1, 2, 3]
+        psfs = GaussianMixturePSF.fromStamps(ims, N=2, init=init)
+        self.assertEqual(len(psfs), len(ims))
+        P0 = None
+        for im,psf in zip(ims, psfs):
+            psf1 = GaussianMixturePSF.fromStamp(im, N=2, P0=P0)
+            P0 = (psf1.mog.amp.copy(), psf1.mog.mean.copy(),
+                  psf1.mog.var.copy())
+            self.assertTrue(np.allclose(psf.getParams(), psf1.getParams()))
+
     def test_psfex(self):
 
         if ps is not None:
@@ -0,0 +1,106 @@
+from __future__ import print_function
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from tractor.sfd import SFDMap
+
+
+class SFDTest(unittest.TestCase):
+    def setUp(self):
+        # Small fake SFD maps with Lambert-projection headers like the
+        # real ones: both the LAM_ cards and an equivalent ZEA WCS.
+        self.tempdir = tempfile.mkdtemp()
+        W = H = 64
+        rng = np.random.RandomState(42)
+        self.fns = []
+        # degrees per pixel
+        cd = np.rad2deg(np.sqrt(2.)) / (W // 2)
+        for n, name in [(1, 'ngp'), (-1, 'sgp')]:
+            img = rng.uniform(0.01, 1., size=(H, W)).astype(np.float32)
+            img[rng.uniform(size=img.shape) < 0.1] = 0.
+            hdr = fitsio.FITSHDR()
+            hdr.add_record(dict(name='CTYPE1', value='GLON-ZEA'))
+            hdr.add_record(dict(name='CTYPE2', value='GLAT-ZEA'))
+            hdr.add_record(dict(name='CRVAL1', value=0.))
+            hdr.add_record(dict(name='CRVAL2', value=90. * n))
+            hdr.add_record(dict(name='CRPIX1', value=W / 2. + 0.5))
+            hdr.add_record(dict(name='CRPIX2', value=H / 2. + 0.5))
+            hdr.add_record(dict(name='CD1_1', value=n * cd))
+            hdr.add_record(dict(name='CD1_2', value=0.))
+            hdr.add_record(dict(name='CD2_1', value=0.))
+            hdr.add_record(dict(name='CD2_2', value=-n * cd))
+            hdr.add_record(dict(name='LONPOLE', value=270.))
+            hdr.add_record(dict(name='LAM_NSGP', value=n))
+            hdr.add_record(dict(name='LAM_SCAL', value=W // 2))
+            fn = os.path.join(self.tempdir, 'SFD_%s.fits' % name)
+            fitsio.write(fn, img, header=hdr, clobber=True)
+            self.fns.append(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_mmap_tiles(self):
+        rng = np.random.RandomState(17)
+        N = 5000
+        ra = rng.uniform(0., 360., size=N)
+        dec = np.rad2deg(np.arcsin(rng.uniform(-1., 1., size=N)))
+
+        sfd = SFDMap(*self.fns, mmap=True, chunksize=1000)
+        self.assertTrue(isinstance(sfd.north, np.memmap))
+        ebv = sfd.ebv(ra, dec)
+        self.assertEqual(ebv.shape, (N,))
+        self.assertTrue(np.all(np.isfinite(ebv)))
+        self.assertTrue(np.all(ebv >= 0.))
+        self.assertTrue(np.any(ebv > 0.))
+
+        # The tile cache gives identical results, cold and warm.
+        tiled = SFDMap(*self.fns, mmap=True, tilesize=8, ntiles=20)
+        self.assertTrue(np.all(tiled.ebv(ra, dec) == ebv))
+        self.assertTrue(np.all(tiled.ebv(ra, dec) == ebv))
+        self.assertEqual(len(tiled.tilecache), 20)
+
+        # Pickling re-opens the memory maps.
+        sfd2 = pickle.loads(pickle.dumps(tiled))
+        self.assertTrue(isinstance(sfd2.south, np.memmap))
+        self.assertTrue(np.all(sfd2.ebv(ra, dec) == ebv))
+
+        ext = sfd.extinction(['DES g', 'DES r'], ra, dec)
+        self.assertEqual(ext.shape, (N, 2))
+        self.assertTrue(np.allclose(ext[:, 1], 2.165 * ebv))
+
+    def test_mmap_vs_wcs(self):
+        # The memory-mapped mode's Lambert projection matches the WCS
+        # path.  (Away from b=0, where the WCS path can step outside the
+        # maps.)
+        rng = np.random.RandomState(18)
+        N = 2000
+        ra = rng.uniform(0., 360., size=N)
+        dec = np.rad2deg(np.arcsin(rng.uniform(-1., 1., size=N)))
+        from astrometry.util.starutil_numpy import radectolb
+        l, b = radectolb(ra, dec)
+        I = (np.abs(b) > 5.)
+        ra, dec = ra[I], dec[I]
+        self.assertTrue(np.any(b[I] > 0) and np.any(b[I] < 0))
+
+        ebv = SFDMap(*self.fns).ebv(ra, dec)
+        self.assertTrue(np.any(ebv > 0.))
+        for kw in [dict(), dict(tilesize=8)]:
+            ebv2 = SFDMap(*self.fns, mmap=True, **kw).ebv(ra, dec)
+            self.assertTrue(np.allclose(ebv, ebv2, rtol=1e-6, atol=1e-7))
+
+    def test_bilinear_nonzero(self):
+        img = np.array([[1., 0.], [2., 4.]])
+        ebv = SFDMap.bilinear_interp_nonzero(img, np.array([0.5, 0., 0.5]),
+                                             np.array([0., 0.5, 0.5]))
+        # Zero pixels are ignored, not interpolated towards.
+        self.assertTrue(np.allclose(ebv, [1., 1.5, 2.]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -124,6 +124,649 @@ class TractorTest(unittest.TestCase):
         self.assertTrue(np.abs(star.getBrightness().getValue() - trueflux)
                         < 5.)
 
+    def test_checkpoint(self):
+        import tempfile
+        from tractor.checkpoint import write_checkpoint, read_checkpoint
+
+        W,H = 50,40
+        np.random.seed(42)
+        iv = np.ones((H,W))
+        tim1 = Image(data=np.random.normal(size=(H,W)), invvar=iv,
+                     psf=NCircularGaussianPSF([2.], [1.]),
+                     photocal=LinearPhotoCal(1.), name='tim1')
+        # shares tim1's inverr plane
+        tim2 = Image(data=np.random.normal(size=(H,W)), inverr=tim1.inverr,
+                     psf=NCircularGaussianPSF([3.], [1.]),
+                     photocal=LinearPhotoCal(1.), name='tim2')
+        star = PointSource(PixPos(20, 20), Flux(100.))
+        gal = ExpGalaxy(PixPos(10, 12), Flux(50.), EllipseE(2., 0.1, 0.))
+        tr = Tractor([tim1, tim2], [star, gal])
+        tr.setModelMasks([{star: ModelMask(10, 10, 20, 20)},
+                          {gal: ModelMask(0, 0, 25, 25)}])
+        tr.freezeParam('images')
+        star.freezeParam('pos')
+
+        dirnm = tempfile.mkdtemp()
+        write_checkpoint(tr, dirnm)
+        tr2 = read_checkpoint(dirnm)
+
+        self.assertTrue(isinstance(tr2.getImage(0).getImage(), np.memmap))
+        self.assertTrue(tr2.getImage(0).getInvError() is
+                        tr2.getImage(1).getInvError())
+        self.assertEqual(tr2.getParamNames(), tr.getParamNames())
+        self.assertEqual(tr2.getParams(), tr.getParams())
+        # model masks still refer to the (unpickled) sources
+        self.assertTrue(tr2.catalog[0] in tr2.modelMasks[0])
+        for i in range(2):
+            self.assertTrue(np.all(tr2.getImage(i).getImage() ==
+                                   tr.getImage(i).getImage()))
+            self.assertTrue(np.all(tr2.getModelImage(i) ==
+                                   tr.getModelImage(i)))
+
+    def test_pixpsf_hashkey(self):
+        img = np.random.normal(size=(11,11))
+        psf1 = PixelizedPSF(img)
+        psf2 = PixelizedPSF(img.copy())
+        self.assertEqual(psf1.hashkey(), psf2.hashkey())
+        psf2.img = psf2.img * 2.
+        self.assertNotEqual(psf1.hashkey(), psf2.hashkey())
+        # In-place changes are seen after clear_cache().
+        psf1.img *= 2.
+        psf1.clear_cache()
+        self.assertEqual(psf1.hashkey(), psf2.hashkey())
+
+    def test_mog_psf_derivs(self):
+        from tractor.ellipses import EllipseESoft
+        W,H = 40,30
+        amp = np.array([0.7, 0.3])
+        mean = np.array([[0.1, -0.2], [0.3, 0.1]])
+        # (psf, number of params, finite-difference step, tolerance)
+        for psf,nparams,step,tol in [
+                (GaussianMixturePSF(amp, mean,
+                                    np.array([[[2., 0.3], [0.3, 1.5]],
+                                              [[6., -0.5], [-0.5, 5.]]])),
+                 12, 1e-3, 1e-5),
+                # (a smaller step: the model is more curved in the
+                # EllipseESoft parameters)
+                (GaussianMixtureEllipsePSF(amp, mean,
+                                           [EllipseESoft(0.3, 0.1, -0.05),
+                                            EllipseESoft(0.9, -0.1, 0.2)]),
+                 12, 1e-4, 1e-5),
+                # (renders through a float32 mixture: a larger step and
+                # tolerance for the finite differences)
+                (NCircularGaussianPSF([1.2, 2.5], [0.7, 0.3]),
+                 4, 3e-3, 1e-4)]:
+            tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                        psf=psf)
+            tr = Tractor([tim], [PointSource(PixPos(12.3, 15.7), Flux(100.)),
+                                 ExpGalaxy(PixPos(28.2, 14.1), Flux(50.),
+                                           EllipseE(3., 0.2, -0.1))])
+            tr.modtype = np.float64
+            tr.freezeParam('catalog')
+            tim.freezeAllBut('psf')
+            derivs = psf.getParamDerivatives(tr, tim, tr.catalog)
+            self.assertEqual(len(derivs), nparams)
+            p0 = tim.getParams()
+            for i,deriv in enumerate(derivs):
+                tim.setParam(i, p0[i] + step)
+                mod1 = tr.getModelImage(0)
+                tim.setParam(i, p0[i] - step)
+                mod0 = tr.getModelImage(0)
+                tim.setParam(i, p0[i])
+                fd = (mod1 - mod0) / (2. * step)
+                d = np.zeros((H,W))
+                deriv.addTo(d)
+                self.assertLess(np.max(np.abs(d - fd)),
+                                tol * np.max(np.abs(fd)))
+
+    def test_calib_derivs(self):
+        try:
+            from astrometry.util.util import Tan
+        except ImportError:
+            Tan = None
+        W,H = 60,50
+        psf = GaussianMixturePSF(np.array([0.7, 0.3]), np.zeros((2,2)),
+                                 np.array([[[2., 0.], [0., 2.]],
+                                           [[6., 0.], [0., 6.]]]))
+        for photocal,b1,b2 in [(LinearPhotoCal(2.), Flux(100.), Flux(50.)),
+                               (MagsPhotoCal('r', 22.5), Mags(r=18.),
+                                Mags(r=19.))]:
+            if Tan is None:
+                wcs = NullWCS()
+                pos1,pos2 = PixPos(20.3, 30.6), PixPos(41.2, 18.7)
+            else:
+                ps = 0.262 / 3600.
+                wcs = TanWcs(Tan(10., 20., 30., 25., -ps, 1e-6, 2e-6, ps,
+                                 float(W), float(H)))
+                pos1,pos2 = RaDecPos(10.0003, 20.0004), RaDecPos(9.9996, 19.9998)
+            tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf,
+                        wcs=wcs, photocal=photocal)
+            tr = Tractor([tim], [PointSource(pos1, b1),
+                                 ExpGalaxy(pos2, b2, EllipseE(1.5, 0.2, -0.1))])
+            tr.modtype = np.float64
+            tr.freezeParam('catalog')
+            tim.freezeAllBut('wcs', 'photocal')
+            derivs = tim.getParamDerivatives(tr, tr.catalog)
+            self.assertEqual(len(derivs), tim.numberOfParams())
+            p0 = tim.getParams()
+            steps = tim.getStepSizes()
+            for i,deriv in enumerate(derivs):
+                step = 1e-2 * steps[i]
+                tim.setParam(i, p0[i] + step)
+                mod1 = tr.getModelImage(0)
+                tim.setParam(i, p0[i] - step)
+                mod0 = tr.getModelImage(0)
+                tim.setParam(i, p0[i])
+                fd = (mod1 - mod0) / (2. * step)
+                d = np.zeros((H,W))
+                deriv.addTo(d)
+                self.assertLess(np.max(np.abs(d - fd)),
+                                1e-4 * np.max(np.abs(fd)))
+
+    def test_moving_positions(self):
+        from tractor.motion import (MovingPointSource, PMRaDec,
+                                    getPositionsAtTime)
+        from tractor.tractortime import TAITime
+        epoch = TAITime(None, mjd=55000.)
+        srcs = [MovingPointSource(RaDecPos(133.79, -7.24), Flux(100.),
+                                  PMRaDec(1e-4, -2e-4), 0.8, epoch=epoch),
+                MovingPointSource(RaDecPos(10., 60.), Flux(100.),
+                                  PMRaDec(-3e-4, 1e-4), 0.1, epoch=epoch)]
+        times = [TAITime(None, mjd=mjd) for mjd in [54800., 55123., 56000.]]
+        src = srcs[0]
+        ra, dec, D = src.getPositionsAtTimes(times, derivs=True)
+        for i,t in enumerate(times):
+            pos = src.getPositionAtTime(t)
+            self.assertEqual((pos.ra, pos.dec), (ra[i], dec[i]))
+            r, d = getPositionsAtTime(srcs, t)
+            self.assertEqual((r[0], d[0]), (ra[i], dec[i]))
+            pos = srcs[1].getPositionAtTime(t)
+            self.assertAlmostEqual(r[1], pos.ra, 12)
+            self.assertAlmostEqual(d[1], pos.dec, 12)
+        # analytic derivatives, in (ra, dec, pmra, pmdec, parallax) order
+        p0 = src.getParams()
+        for i,k in [(0,0), (1,1), (3,2), (4,3), (5,4)]:
+            step = 1e-6
+            src.setParam(i, p0[i] + step)
+            r1,d1 = src.getPositionsAtTimes(times)
+            src.setParam(i, p0[i] - step)
+            r0,d0 = src.getPositionsAtTimes(times)
+            src.setParam(i, p0[i])
+            self.assertTrue(np.allclose((r1 - r0) / (2. * step), D[:,0,k],
+                                        atol=1e-6))
+            self.assertTrue(np.allclose((d1 - d0) / (2. * step), D[:,1,k],
+                                        atol=1e-6))
+
+    def test_pixel_positions(self):
+        try:
+            from astrometry.util.util import Tan
+        except ImportError:
+            return
+        W,H = 60,50
+        ps = 0.262 / 3600.
+        wcs = TanWcs(Tan(10., 20., 30., 25., -ps, 1e-6, 2e-6, ps,
+                         float(W), float(H)))
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]), wcs=wcs)
+        srcs = [PointSource(RaDecPos(10. + dr, 20. + dd), Flux(100.))
+                for dr,dd in [(0.0003, 0.0004), (-0.0004, -0.0002),
+                              (0.001, -0.001)]]
+        tr = Tractor([tim], srcs)
+        x,y = tr.getPixelPositions(tim)
+        xx,yy = wcs.positionsToPixels([s.pos.ra for s in srcs],
+                                      [s.pos.dec for s in srcs])
+        for i,src in enumerate(srcs):
+            px,py = wcs.positionToPixel(src.pos)
+            self.assertAlmostEqual(x[i], px, 8)
+            self.assertAlmostEqual(y[i], py, 8)
+            self.assertAlmostEqual(xx[i], px, 8)
+            self.assertAlmostEqual(yy[i], py, 8)
+        mod = tr.getModelImage(0)
+        self.assertTrue(wcs.pixcache is None)
+        # Changing the WCS or moving a source must not use stale positions
+        p0 = wcs.getParams()
+        wcs.setParam(2, p0[2] + 1.5)
+        wcs.setParam(3, p0[3] - 0.5)
+        srcs[0].pos.ra += 0.0001
+        mod2 = tr.getModelImage(0)
+        tr.pixcache.clear()
+        self.assertTrue(np.all(mod2 == tr.getModelImage(0)))
+        self.assertFalse(np.all(mod2 == mod))
+        x2,y2 = tr.getPixelPositions(tim)
+        px,py = wcs.positionToPixel(srcs[0].pos)
+        self.assertAlmostEqual(x2[0], px, 8)
+        self.assertAlmostEqual(y2[0], py, 8)
+
+    def test_footprints(self):
+        from tractor.footprint import getSourceFootprint, planFootprints
+        W,H = 80,60
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 100.,
+                    psf=NCircularGaussianPSF([2.], [1.]))
+        bright = PointSource(PixPos(20.3, 30.6), Flux(1000.))
+        faint = PointSource(PixPos(60.2, 25.1), Flux(5.))
+        gal = ExpGalaxy(PixPos(45.5, 40.2), Flux(200.), EllipseE(3., 0.2, 0.))
+        tr = Tractor([tim], [bright, faint, gal])
+        full = [tr.getModelPatch(tim, src) for src in tr.catalog]
+
+        minsb = 0.01
+        for src,mod in zip(tr.catalog, full):
+            mm = getSourceFootprint(tim, src, minsb=minsb)
+            img = np.zeros((H,W))
+            mod.addTo(img)
+            img[mm.y0:mm.y1, mm.x0:mm.x1] = 0.
+            self.assertLess(np.max(img), minsb)
+        mb = getSourceFootprint(tim, bright, minsb=minsb)
+        mf = getSourceFootprint(tim, faint, minsb=minsb)
+        self.assertLess(mf.w, mb.w)
+
+        fluxfrac = 1e-3
+        for src,mod in zip(tr.catalog, full):
+            mm = getSourceFootprint(tim, src, fluxfrac=fluxfrac)
+            img = np.zeros((H,W))
+            mod.addTo(img)
+            inside = np.sum(img[mm.y0:mm.y1, mm.x0:mm.x1])
+            self.assertGreater(inside, (1. - fluxfrac) * np.sum(img))
+        # fluxfrac=0 -> the whole model
+        for src,mod in zip(tr.catalog, full):
+            mm = getSourceFootprint(tim, src, fluxfrac=0.)
+            self.assertLessEqual(mm.x0, max(0, mod.x0))
+            self.assertLessEqual(mm.y0, max(0, mod.y0))
+            self.assertGreaterEqual(mm.x1, min(W, mod.x1))
+            self.assertGreaterEqual(mm.y1, min(H, mod.y1))
+
+        # nsigma=1 -> truncate at the noise level, 0.1
+        masks = planFootprints(tr, nsigma=1.)
+        self.assertEqual(len(masks), 1)
+        self.assertEqual(len(masks[0]), 3)
+        tr.setModelMasks(masks)
+        mod = tr.getModelImage(0)
+        tr.setModelMasks(None)
+        self.assertLess(np.max(np.abs(mod - tr.getModelImage(0))), 0.1)
+
+    def test_plan_model_masks(self):
+        W,H = 60,50
+        psf = NCircularGaussianPSF([2.], [1.])
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 100.,
+                    psf=psf)
+        a = PointSource(PixPos(20.3, 30.6), Flux(1000.))
+        b = PointSource(PixPos(40.2, 15.1), Flux(100.))
+        tr = Tractor([tim], [a, b])
+        tim.data = tr.getModelImage(0)
+        masks = tr.planModelMasks(nsigma=1.)
+        self.assertTrue(tr.expectModelMasks)
+        ma,mb = masks[0][a], masks[0][b]
+        self.assertLess(mb.w, ma.w)
+
+        # Small moves keep the masks; larger moves and growth re-plan.
+        a.pos.x += 0.3
+        tr.getDerivs()
+        self.assertTrue(tr.modelMasks[0][a] is ma)
+        a.pos.x += 2.
+        b.brightness.setValue(1000.)
+        tr.getDerivs()
+        self.assertFalse(tr.modelMasks[0][a] is ma)
+        self.assertEqual(tr.modelMasks[0][a].x0, ma.x0 + 3)
+        self.assertEqual(tr.modelMasks[0][b].w, ma.w)
+
+        # Masks are found for images added later.
+        tim2 = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf)
+        tr.addImage(tim2)
+        tr.getDerivs()
+        self.assertEqual(len(tr.modelMasks), 2)
+        self.assertTrue(tr._getModelMaskFor(tim2, a) is not None)
+
+        tr.setModelMasks(None)
+        self.assertTrue(tr.maskplanner is None)
+
+    def test_precision(self):
+        from tractor.utils import sumsq
+        x = np.random.RandomState(1).normal(size=200000).astype(np.float32)
+        self.assertAlmostEqual(sumsq(x), np.sum(x.astype(np.float64)**2),
+                               places=6)
+
+        # Fits in single and double precision agree to a small
+        # fraction of the parameter uncertainties.
+        def fit(modtype):
+            rng = np.random.RandomState(42)
+            W,H = 100,100
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        invvar=np.ones((H,W), np.float32) * 4.,
+                        psf=NCircularGaussianPSF([2.], [1.]))
+            tr = Tractor([tim], [
+                PointSource(PixPos(30.3, 40.6), Flux(500.)),
+                ExpGalaxy(PixPos(60.5, 55.2), Flux(800.),
+                          EllipseE(4., 0.2, -0.1))])
+            tr.modtype = np.float64
+            tim.data = (tr.getModelImage(0) +
+                        rng.normal(size=(H,W)) * 0.5).astype(np.float32)
+            tim.freezeAllParams()
+            tr.setParams(np.array(tr.getParams()) * 1.02)
+            tr.modtype = modtype
+            tr.optimize_loop(dchisq=1e-6)
+            self.assertEqual(tr.getChiImage(0).dtype, modtype)
+            tr.modtype = np.float64
+            var = tr.optimize(variance=True, just_variance=True)
+            return np.array(tr.getParams()), np.sqrt(var)
+        p32,nil = fit(np.float32)
+        p64,sig = fit(np.float64)
+        self.assertLess(np.max(np.abs(p32 - p64) / sig), 0.01)
+
+    def test_profiler(self):
+        from tractor.profiler import Profiler
+        W,H = 40,40
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([2.], [1.]), name='im')
+        a = PointSource(PixPos(10., 12.), Flux(100.))
+        b = PointSource(PixPos(30., 25.), Flux(50.))
+        tr = Tractor([tim], [a, b])
+        tim.data = tr.getModelImage(0)
+        tim.freezeAllParams()
+        a.brightness.setValue(90.)
+        with Profiler(tr) as prof:
+            tr.optimize_loop()
+            with prof.stage('io', img=tim):
+                pass
+        self.assertTrue(tr.profiler is None)
+        stats = prof.getStats()
+        for stage in ['render', 'derivs', 'matrix', 'solve', 'linesearch',
+                      'io']:
+            self.assertTrue(stage in stats)
+        self.assertEqual(stats['io']['ncalls'], 1)
+        srcstats = prof.getStats(by='source')
+        self.assertEqual(srcstats[('derivs', a)]['ncalls'],
+                         srcstats[('derivs', b)]['ncalls'])
+        imstats = prof.getStats(by='image')
+        self.assertEqual(imstats[('render', tim)]['ncalls'],
+                         stats['render']['ncalls'])
+        self.assertTrue('render: im' in prof.format(by='image'))
+
+    def test_lbfgsb_optimizer(self):
+        from tractor.lbfgsb_optimizer import LbfgsbOptimizer
+        rng = np.random.RandomState(3)
+        W,H = 60,60
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 4.,
+                    psf=NCircularGaussianPSF([2.], [1.]))
+        a = PointSource(PixPos(20.3, 30.6), Flux(500.))
+        b = ExpGalaxy(PixPos(40.5, 25.2), Flux(800.), EllipseE(4., 0.2, -0.1))
+        tr = Tractor([tim], [a, b])
+        tr.modtype = np.float64
+        tim.data = tr.getModelImage(0) + rng.normal(size=(H,W)) * 0.5
+        tim.freezeAllParams()
+        p0 = np.array(tr.getParams()) * 1.02
+
+        # The gradient matches finite differences for the (linear)
+        # fluxes, and gradients of Gaussian priors are included.
+        tr.setParams(p0)
+        opt = LbfgsbOptimizer()
+        lnp,g0 = opt.getLogProbGradient(tr)
+        b.shape.addGaussianPrior('e1', 0., 0.1)
+        lnp,g = opt.getLogProbGradient(tr)
+        self.assertAlmostEqual(lnp, tr.getLogProb(), places=6)
+        self.assertAlmostEqual(g[7] - g0[7], -p0[7] / 0.1**2)
+        for i in [2, 5]:
+            h = 1e-3
+            tr.setParam(i, p0[i] + h)
+            lp1 = tr.getLogProb()
+            tr.setParam(i, p0[i] - h)
+            lp0 = tr.getLogProb()
+            tr.setParam(i, p0[i])
+            self.assertLess(np.abs(g[i] - (lp1 - lp0) / (2. * h)),
+                            1e-4 * np.abs(g[i]))
+
+        # Converges to the same optimum as LSQR.
+        tr.optimize_loop()
+        lnp1 = tr.getLogProb()
+        tr.setParams(p0)
+        tr.optimizer = opt
+        R = tr.optimize_loop()
+        self.assertFalse(R['hit_limit'])
+        self.assertLess(np.abs(tr.getLogProb() - lnp1), 0.01)
+
+        # Respects bounds.
+        tr.setParams(p0)
+        a.brightness.upper = 400.
+        R = tr.optimize_loop()
+        self.assertTrue(R['hit_limit'])
+        self.assertAlmostEqual(a.getBrightness().getValue(), 400.)
+
+    def test_batched_logprob(self):
+        rng = np.random.RandomState(7)
+        W,H = 50,40
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 4.,
+                    psf=NCircularGaussianPSF([2.], [1.]),
+                    sky=ConstantSky(1.))
+        a = PointSource(PixPos(20.3, 20.6), Flux(500.))
+        b = ExpGalaxy(PixPos(35.5, 15.2), Flux(800.), EllipseE(3., 0.2, -0.1))
+        c = PointSource(PixPos(10., 30.), Flux(100.))
+        tr = Tractor([tim], [a, b, c])
+        tr.modtype = np.float64
+        tim.data = tr.getModelImage(0) + rng.normal(size=(H,W)) * 0.5
+        tim.freezeAllParams()
+        tr.catalog.freezeParam(2)
+        a.freezeParam('pos')
+        p0 = tr.getParams()
+        X = p0 + rng.normal(size=(6, len(p0))) * 0.01 * np.abs(p0)
+        # illegal ellipse -> -inf
+        X[3, -2] = 2.
+        truth = []
+        for x in X:
+            tr.setParams(x)
+            truth.append(tr.getLogProb())
+        tr.setParams(p0)
+        self.assertFalse(np.isfinite(truth[3]))
+        for threads in [None, 2]:
+            lnp = tr.getLogProbs(X, threads=threads)
+            self.assertTrue(np.allclose(lnp, truth, rtol=1e-10))
+            self.assertEqual(tr.getParams(), p0)
+        self.assertTrue(np.allclose(tr(X), truth, rtol=1e-10))
+
+        # images frozen at the Tractor level, with thawed image params
+        tim.thawAllParams()
+        tr.freezeParam('images')
+        self.assertTrue(tim.numberOfParams() > 0)
+        self.assertEqual(tr.getParams(), p0)
+        for threads in [None, 2]:
+            lnp = tr.getLogProbs(X, threads=threads)
+            self.assertTrue(np.allclose(lnp, truth, rtol=1e-10))
+
+    def test_sersic_table(self):
+        from tractor.sersic import SersicGalaxy, SersicIndex, SersicMixture
+        # profiles are continuous within the fit ranges
+        n = 2.5
+        m0 = SersicMixture.getProfile(n)
+        m1 = SersicMixture.getProfile(n + 1e-6)
+        self.assertEqual(len(m0.amp), len(m1.amp))
+        self.assertTrue(np.allclose(m0.amp, m1.amp, atol=1e-5))
+        self.assertAlmostEqual(np.sum(m0.amp), 1.)
+
+        W,H = 50,50
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]))
+        gal = SersicGalaxy(PixPos(24.3, 25.1), Flux(100.),
+                           EllipseE(3., 0.1, -0.2), SersicIndex(n))
+        tr = Tractor([tim], [gal])
+        tr.modtype = np.float64
+        tr.freezeParam('images')
+        gal.freezeAllBut('sersicindex')
+        derivs = tr.getDerivs()
+        D = np.zeros((H,W))
+        derivs[0][0][0].addTo(D)
+        e = 1e-5
+        gal.sersicindex.setValue(n + e)
+        m1 = tr.getModelImage(0)
+        gal.sersicindex.setValue(n - e)
+        m0 = tr.getModelImage(0)
+        fd = (m1 - m0) / (2. * e)
+        self.assertTrue(np.abs(D - fd).max() < 1e-3 * np.abs(fd).max())
+
+    def test_patch_inplace(self):
+        from tractor.patch import Patch
+        rng = np.random.RandomState(3)
+        a = Patch(2, 3, rng.normal(size=(6, 8)))
+        b = Patch(4, 4, rng.normal(size=(3, 2)))
+        c = Patch(-1, 5, rng.normal(size=(4, 4)))
+        # same results as the allocating operators
+        s1 = a + b
+        d1 = a - c
+        arr = a.patch
+        a2 = a.copy()
+        a2 += b
+        self.assertTrue(np.all(a2.patch == s1.patch))
+        a2 = a.copy()
+        a2 -= c
+        self.assertEqual(a2.getExtent(), d1.getExtent())
+        self.assertTrue(np.all(a2.patch == d1.patch))
+        # in place when the other patch lies within
+        a += b
+        self.assertTrue(a.patch is arr)
+        self.assertTrue(np.all(a.patch == s1.patch))
+
+        img = np.zeros((7, 9))
+        ref = np.zeros((7, 9))
+        c.addTo(img, scale=2.5)
+        Patch(c.x0 + 1, c.y0, (c.patch * 2.5)[:, 1:]).addTo(ref)
+        self.assertTrue(np.allclose(img, ref))
+        self.assertTrue(np.allclose(img[5:, 0:3], 2.5 * c.patch[:2, 1:]))
+
+    def test_render_mixtures(self):
+        from tractor.patch import ModelMask
+        from tractor import mixture_profiles as mp
+        rng = np.random.RandomState(5)
+        H, W = 60, 70
+        psf = GaussianMixturePSF([0.8, 0.2], np.zeros((2, 2)),
+                                 np.array([[[2., 0.3], [0.3, 2.5]],
+                                           [[8., 0.], [0., 8.]]]))
+        tim = Image(data=np.zeros((H, W), np.float32),
+                    invvar=np.ones((H, W), np.float32), psf=psf,
+                    wcs=NullWCS(), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(2.))
+        srcs = [PointSource(PixPos(10.3, 12.8), Flux(100.)),
+                ExpGalaxy(PixPos(40.1, 30.6), Flux(200.),
+                          EllipseE(2., 0.3, -0.2)),
+                PointSource(PixPos(62., 55.), Flux(50.)),
+                DevGalaxy(PixPos(20., 45.), Flux(0.), EllipseE(1., 0., 0.))]
+        masks = {}
+        for i, src in enumerate(srcs):
+            x, y = int(src.pos.x), int(src.pos.y)
+            x0, y0 = max(0, x - 10), max(0, y - 10)
+            x1, y1 = min(W, x + 11), min(H, y + 11)
+            if i % 2:
+                masks[src] = ModelMask(x0, y0, x1 - x0, y1 - y0)
+            else:
+                masks[src] = ModelMask(x0, y0,
+                                       rng.uniform(size=(y1-y0, x1-x0)) > 0.3)
+        tractor = Tractor([tim], srcs)
+        tractor.setModelMasks([masks])
+        mod = tractor.getModelImage(0)
+        tractor.batchRender = False
+        ref = tractor.getModelImage(0)
+        self.assertTrue(np.allclose(mod, ref, rtol=1e-5, atol=1e-5))
+
+        # patches and derivatives, vs the one-source renderers
+        mog = psf.getMixtureOfGaussians()
+        mm = masks[srcs[0]]
+        p, dx, dy = mp.render_mixtures([mog, mog], [(10.3, 12.8), (5., 8.)],
+                                       [mm, (0, 0, 12, 10)],
+                                       masks=[mm.mask, None], derivs=True)
+        r0 = mog.evaluate_grid_masked(mm.x0, mm.y0, mm.mask, 10.3, 12.8,
+                                      derivs=True)
+        r1 = mog.evaluate_grid(0, 12, 0, 10, 5., 8.)
+        self.assertTrue(np.allclose(p[0].patch, r0[0].patch, atol=1e-6))
+        self.assertTrue(np.allclose(dx[0].patch, r0[1].patch, atol=1e-6))
+        self.assertTrue(np.allclose(dy[0].patch, r0[2].patch, atol=1e-6))
+        self.assertTrue(np.allclose(p[1].patch, r1.patch, atol=1e-10))
+
+        # empty mixtures, and no mixtures at all
+        empty = mp.MixtureOfGaussians(np.zeros(0), np.zeros((0, 2)),
+                                      np.zeros((0, 2, 2)), quick=True)
+        p, dx, dy = mp.render_mixtures([empty, mog], [(3., 4.), (5., 8.)],
+                                       [(0, 0, 6, 5), (0, 0, 12, 10)],
+                                       derivs=True)
+        self.assertTrue(np.all(p[0].patch == 0) and np.all(dx[0].patch == 0))
+        self.assertTrue(np.allclose(p[1].patch, r1.patch, atol=1e-10))
+        self.assertEqual(mp.render_mixtures([], [], []), [])
+
+    def test_lazy_import(self):
+        import subprocess
+        import sys
+        code = '''
+import sys, time
+t0 = time.perf_counter()
+import tractor
+from tractor import PointSource, LinearPhotoCal
+print(time.perf_counter() - t0)
+print(' '.join(sorted(sys.modules.keys())))
+'''
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      universal_newlines=True)
+        dt, mods = out.strip().split('\n')
+        mods = mods.split()
+        for m in ['tractor.engine', 'tractor.galaxy', 'tractor.psf',
+                  'tractor.mixture_profiles', 'tractor.mix', 'scipy']:
+            self.assertFalse(m in mods, m)
+        # a generous budget: numpy and the small modules
+        self.assertLess(float(dt), 2.)
+        # names not in __all__ are still found
+        import tractor
+        from tractor.engine import logverb
+        self.assertTrue(tractor.logverb is logverb)
+
+    def test_blobs(self):
+        from tractor.blobs import findBlobs
+        H, W = 60, 100
+        rng = np.random.RandomState(42)
+        tim = Image(data=np.zeros((H, W), np.float32),
+                    inverr=np.ones((H, W), np.float32),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        # two blended pairs and an isolated source
+        srcs = [PointSource(PixPos(20., 20.), Flux(500.)),
+                PointSource(PixPos(24., 22.), Flux(300.)),
+                PointSource(PixPos(70., 30.), Flux(400.)),
+                PointSource(PixPos(20., 45.), Flux(200.)),
+                PointSource(PixPos(74., 28.), Flux(300.))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        tim.data += tr.getModelImage(0) + rng.normal(size=(H, W))
+        truth = tr.getParams()
+
+        blobs = findBlobs(tr, nsigma=0.1)
+        self.assertEqual([b.srcs for b in blobs], [[0, 1], [2, 4], [3]])
+
+        rng = np.random.RandomState(43)
+        for src in srcs:
+            src.pos.setParams(np.array(src.pos.getParams()) +
+                              rng.normal(scale=0.5, size=2))
+            src.brightness.setParams([src.brightness.getValue() * 0.8])
+        srcs[3].freezeParam('brightness')
+        f3 = srcs[3].getBrightness().getValue()
+        p0 = tr.getParams()
+        tr.optimize_loop()
+        p1 = tr.getParams()
+        tr.setParams(p0)
+        blobs = tr.optimize_blobs(blobs)
+        # (the blobs' models are truncated at their footprints)
+        self.assertTrue(np.allclose(tr.getParams(), p1, rtol=2e-3, atol=2e-2))
+        self.assertEqual(srcs[3].getBrightness().getValue(), f3)
+        # (without the frozen flux)
+        truth = np.delete(truth, 11)
+        self.assertTrue(np.allclose(tr.getParams(), truth, rtol=0.1, atol=0.2))
+        for b in blobs:
+            self.assertTrue(b.converged)
+            self.assertTrue(b.dlnp > 0)
+            self.assertTrue(b.time >= 0)
+        # converging on the last allowed step counts
+        blobs = tr.optimize_blobs(blobs, steps=1)
+        for b in blobs:
+            self.assertEqual(b.steps, 0)
+            self.assertTrue(b.converged)
+        # running out of steps does not
+        tr.setParams(p0)
+        blobs = tr.optimize_blobs(blobs, steps=1)
+        for b in blobs:
+            self.assertFalse(b.converged)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -8,8 +8,124 @@ import unittest
 from tractor import *
 from tractor.sdss import *
 from tractor.galaxy import *
+from tractor.patch import ModelMask
+
+try:
+    import tractor.ceres
+    have_ceres = True
+except ImportError:
+    have_ceres = False
 
 class TractorCeresTest(unittest.TestCase):
+    def test_pack_blocks(self):
+        from tractor.ceres_optimizer import CeresOptimizer
+        from tractor.patch import Patch
+        W,H = 25,17
+        tim = Image(data=np.arange(W*H).reshape(H,W).astype(float),
+                    invvar=np.ones((H,W)))
+        opt = CeresOptimizer(BW=10, BH=8)
+        self.assertEqual(opt.BW, 10)
+        self.assertEqual(opt.BH, 8)
+        umods = [Patch(8, 2, np.ones((3,4))),
+                 None,
+                 Patch(20, 12, np.ones((10,10))),
+                 Patch(0, 0, np.zeros((2,2)))]
+        blocks,pmap = opt._pack_forced_phot_blocks(
+            [(umods, tim, 2., np.zeros((H,W)), 0)])
+        img,mod0,ie,blockxy,blockstart,srcs,vals = blocks
+        # 3 x 3 blocks of 10 x 8 pixels
+        self.assertEqual(img.shape, (9, 8, 10))
+        self.assertEqual(list(blockxy[4]), [10, 8])
+        self.assertTrue(np.all(img[4] == tim.getImage()[8:16, 10:20]))
+        # right edge blocks are zero-padded, with zero inverse-error
+        self.assertTrue(np.all(ie[2][:, :5] == 1.))
+        self.assertTrue(np.all(ie[2][:, 5:] == 0.))
+        # the first model straddles blocks 0 and 1; the third is
+        # clipped to the image and straddles blocks 5 and 8; the fourth is
+        # all zero and is dropped.
+        self.assertEqual(pmap, {0:0, 2:1})
+        self.assertEqual(list(blockstart), [0, 1, 2, 2, 2, 2, 3, 3, 3, 4])
+        self.assertEqual(list(srcs[:,0]), [0, 0, 1, 1])
+        self.assertEqual(list(srcs[2,1:5]), [20, 12, 5, 5])
+        self.assertTrue(np.all(vals == 2.))
+
+    def test_plan_tiles(self):
+        from tractor.ceres_optimizer import CeresOptimizer
+        W,H = 25,17
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.], [1.]))
+        tr = Tractor([tim], [PointSource(PixPos(5, 5), Flux(1.)),
+                             PointSource(PixPos(18, 12), Flux(1.))])
+        tr.freezeParam('images')
+        opt = CeresOptimizer(BW=10, BH=8)
+        # (param, x0, y0, deriv)
+        derivs = [(0, 8, 2, np.ones((3,4))),
+                  (2, 0, 0, np.ones((2,2))),
+                  (5, 20, 12, np.ones((5,5))),
+                  (3, 20, 12, np.ones((5,5)))]
+        opt._getOneImageDerivs = lambda tractor, i: derivs
+        tiles,tilestart,tileparams = opt._plan_opt_tiles(tr)
+        # 3 x 3 tiles of 10 x 8 pixels; all are kept, but only tiles 0,
+        # 1, 5, 8 are touched
+        self.assertEqual(tiles.shape, (9, 5))
+        self.assertEqual(list(tiles[:,0]), [0] * 9)
+        self.assertEqual(list(tiles[1]), [0, 10, 0, 10, 8])
+        # clipped at the image edges
+        self.assertEqual(list(tiles[5]), [0, 20, 8, 5, 8])
+        self.assertEqual(list(tiles[8]), [0, 20, 16, 5, 1])
+        self.assertEqual(list(tilestart), [0, 2, 3, 3, 3, 3, 5, 5, 5, 7])
+        self.assertEqual(list(tileparams), [0, 2, 0, 3, 5, 3, 5])
+        # a margin grows the footprints
+        tiles,tilestart,tileparams = opt._plan_opt_tiles(tr, margin=3)
+        self.assertEqual(np.count_nonzero(np.diff(tilestart)), 6)
+        # tiles with no weighted pixels are dropped
+        tim.inverr[:8, :] = 0.
+        tiles,tilestart,tileparams = opt._plan_opt_tiles(tr)
+        self.assertEqual(len(tiles), 6)
+        self.assertEqual(list(tiles[0]), [0, 0, 8, 10, 8])
+        self.assertEqual(list(tilestart), [0, 0, 0, 2, 2, 2, 4])
+        self.assertEqual(list(tileparams), [3, 5, 3, 5])
+
+    def test_plan_tiles_moved(self):
+        # A source moving across a tile boundary picks up the new tile
+        # when re-planning, and keeps its old ones.
+        from tractor.ceres_optimizer import CeresOptimizer
+        W,H = 40,20
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.], [1.]))
+        src = PointSource(PixPos(8, 10), Flux(100.))
+        tr = Tractor([tim], [src])
+        tr.freezeParam('images')
+        tr.setModelMasks([{src: ModelMask(3, 5, 11, 11)}])
+        opt = CeresOptimizer(BW=10, BH=20)
+        plan = opt._plan_opt_tiles(tr)
+        tiles,tilestart,tileparams = plan
+        self.assertEqual(len(tiles), 4)
+        self.assertEqual(list(tilestart), [0, 3, 6, 6, 6])
+        tr.setModelMasks([{src: ModelMask(17, 5, 11, 11)}])
+        src.pos.x = 22.
+        tiles,tilestart,tileparams = opt._plan_opt_tiles(tr, prev=plan)
+        self.assertEqual(list(tilestart), [0, 3, 6, 9, 9])
+        self.assertEqual(list(tileparams), [0, 1, 2] * 3)
+
+    @unittest.skipUnless(have_ceres, 'Ceres is not built')
+    def test_ceres_tiled_moved(self):
+        # The source starts on one tile and its true position is on the
+        # next; the tiled fit must still find it.
+        from tractor.ceres_optimizer import CeresOptimizer
+        W,H = 40,20
+        psf = NCircularGaussianPSF([1.5], [1.])
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf)
+        truth = PointSource(PixPos(21.5, 10.), Flux(1000.))
+        tim.setImage(Tractor([tim], [truth]).getModelImage(0))
+        src = PointSource(PixPos(18., 10.), Flux(800.))
+        tr = Tractor([tim], [src], optimizer=CeresOptimizer(BW=10, BH=20))
+        tr.freezeParam('images')
+        R = tr.optimizer.optimize_loop(tr, tiled=True, print_progress=False)
+        self.assertTrue(R['final_cost'] < R['initial_cost'])
+        self.assertAlmostEqual(src.pos.x, 21.5, places=2)
+        self.assertAlmostEqual(src.brightness.getValue(), 1000., delta=1.)
+
     def test_ceres(self):
         W,H = 100,100
         tim1 = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
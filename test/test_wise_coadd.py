@@ -0,0 +1,112 @@
+from __future__ import print_function
+import unittest
+
+import numpy as np
+
+try:
+    from astrometry.util.util import Tan
+    from astrometry.util.resample import resample_with_wcs
+    from wise.coadd import ResampleMap, Coadd
+    have_astrometry = True
+except ImportError:
+    have_astrometry = False
+
+
+@unittest.skipUnless(have_astrometry, 'astrometry.net is not installed')
+class WiseCoaddTest(unittest.TestCase):
+    def setUp(self):
+        # 1 arcsec pixels; the target is the frame shifted by a
+        # non-integer number of pixels (same projection).
+        W, H = 80, 60
+        ps = 1. / 3600.
+        self.wcs = Tan(150., 2., 40.5, 30.5, -ps, 0., 0., ps, W, H)
+        self.cowcs = Tan(150., 2., 40.5 - 7.3, 30.5 + 4.6,
+                         -ps, 0., 0., ps, W, H)
+        rng = np.random.RandomState(42)
+        self.img = rng.normal(size=(H, W)).astype(np.float32)
+        self.W, self.H = W, H
+
+    def test_maps(self):
+        rmap = ResampleMap(self.cowcs, self.wcs, spline=False)
+        self.assertTrue(np.all(np.abs(rmap.dx) <= 0.5))
+        self.assertTrue(np.all(np.abs(rmap.dy) <= 0.5))
+
+        Yo, Xo, Yi, Xi, rims = resample_with_wcs(
+            self.cowcs, self.wcs, [self.img], 3, spline=False)
+        ref = np.zeros((self.H, self.W), np.float32)
+        ref[Yo, Xo] = rims[0]
+        refnn = np.zeros((self.H, self.W), np.float32)
+        refnn[Yo, Xo] = self.img[Yi, Xi]
+        hit = np.zeros((self.H, self.W), bool)
+        hit[Yo, Xo] = True
+
+        rim, = rmap.lanczos([self.img])
+        I = hit[rmap.Yo, rmap.Xo]
+        self.assertTrue(np.sum(I) > 0.9 * len(Yo))
+        self.assertTrue(np.allclose(rim[I], ref[rmap.Yo, rmap.Xo][I],
+                                    rtol=1e-5, atol=1e-6))
+        self.assertTrue(np.all(rmap.nearest(self.img)[I] ==
+                               refnn[rmap.Yo, rmap.Xo][I]))
+
+        # Cut-out of the frame
+        x0, x1, y0, y1 = rmap.input_extent()
+        rim2, = rmap.lanczos([self.img[y0:y1, x0:x1]], x0=x0, y0=y0)
+        self.assertTrue(np.allclose(rim, rim2))
+
+        # Spline positions: nearly the same positions, self-consistent
+        smap = ResampleMap(self.cowcs, self.wcs, spline=True)
+        self.assertTrue(np.all(np.abs(smap.dx) <= 0.5))
+        self.assertTrue(np.all(np.abs(smap.dy) <= 0.5))
+        fx = rmap.expand(rmap.Xi + rmap.dx, dtype=np.float64)
+        sfx = smap.expand(smap.Xi + smap.dx, dtype=np.float64)
+        both = (rmap.expand(np.ones(len(rmap)), dtype=bool) *
+                smap.expand(np.ones(len(smap)), dtype=bool))
+        self.assertTrue(np.sum(both) > 0.9 * len(rmap))
+        self.assertTrue(np.allclose(fx[both], sfx[both], atol=1e-4))
+
+    def test_coadd(self):
+        rng = np.random.RandomState(43)
+        H, W = self.H, self.W
+        co = Coadd(H, W)
+        wsum = np.zeros((H, W))
+        wimg = np.zeros((H, W))
+        wimg2 = np.zeros((H, W))
+        for i in range(4):
+            wcs = Tan(150., 2., 40.5 - 3. * rng.uniform(),
+                      30.5 + 3. * rng.uniform(),
+                      -1. / 3600., 0., 0., 1. / 3600., W, H)
+            rmap = ResampleMap(self.cowcs, wcs)
+            img = (self.img + rng.normal(scale=0.1, size=self.img.shape))
+            rim, = rmap.lanczos([img])
+            w = rng.uniform(0.5, 2.) * (rng.uniform(size=len(rim)) > 0.1)
+            co.add(rmap, rim, w)
+            I = (rmap.Yo, rmap.Xo)
+            wsum[I] += w
+            wimg[I] += w * rim.astype(np.float64)
+            wimg2[I] += w * rim.astype(np.float64)**2
+
+        coimg = wimg / np.maximum(wsum, Coadd.tinyw)
+        var = wimg2 / np.maximum(wsum, Coadd.tinyw) - coimg**2
+        coppstd = np.sqrt(np.maximum(var, 0.))
+        self.assertTrue(np.allclose(co.invvar(), wsum, rtol=1e-6))
+        self.assertTrue(np.allclose(co.image(), coimg, rtol=1e-5, atol=1e-5))
+        self.assertTrue(np.allclose(co.ppstd(), coppstd, rtol=1e-3,
+                                    atol=1e-3))
+
+    def test_reverse(self):
+        rmap = ResampleMap(self.cowcs, self.wcs, reverse=True)
+        rng = np.random.RandomState(44)
+        mask = rng.uniform(size=self.img.shape) > 0.5
+        comask = rmap.expand(rmap.nearest(mask), dtype=bool)
+        back = rmap.reverse(comask, dtype=bool)
+        # every frame pixel that maps onto the target comes back
+        yo, xo, yi, xi = rmap.rev
+        self.assertTrue(len(yo) > 0)
+        self.assertTrue(np.all(back[yo, xo] == mask[yo, xo]))
+
+        with self.assertRaises(RuntimeError):
+            ResampleMap(self.cowcs, self.wcs).reverse(comask)
+
+
+if __name__ == '__main__':
+    unittest.main()
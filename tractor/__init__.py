@@ -1,13 +1,19 @@
-from .engine import *
-from .ducks import *
-from .basics import *
-from .psf import (NCircularGaussianPSF, GaussianMixturePSF, PixelizedPSF,
-                  HybridPSF, HybridPixelizedPSF, GaussianMixtureEllipsePSF)
-from .motion import *
-from .psfex import *
-from .ellipses import *
-from .imageutils import *
-from .galaxy import *
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+The `tractor` package.
+
+On Python 3.7 and later, importing the package is cheap: the classes
+listed in `__all__` are imported from their submodules (and so the C
+extensions, astrometry.net utilities, etc that those need) when they
+are first used, eg, `tractor.PointSource` or `from tractor import
+PointSource`.  Older Pythons import everything up front.
+'''
+import sys
+import importlib
+import importlib.util
+
 from .version import *
 
 try:
@@ -52,3 +58,82 @@ __all__ = [
     'ExpGalaxy', 'DevGalaxy', 'FracDev', 'SoftenedFracDev',
     'FixedCompositeGalaxy', 'CompositeGalaxy',
 ]
+
+# The submodule defining each of the names in __all__
+_lazy = {}
+for _mod, _names in [
+        ('ducks', ['Params', 'Sky', 'Source', 'Position', 'Brightness',
+                   'PhotoCal', 'PSF', 'WCS']),
+        ('utils', ['BaseParams', 'ScalarParam', 'ParamList', 'MultiParams',
+                   'NamedParams', 'NpArrayParams']),
+        ('sky', ['ConstantSky']),
+        ('pointsource', ['PointSource']),
+        ('brightness', ['Flux', 'Fluxes', 'Mag', 'Mags', 'MagsPhotoCal',
+                        'NanoMaggies', 'NullPhotoCal', 'LinearPhotoCal',
+                        'FluxesPhotoCal']),
+        ('wcs', ['PixPos', 'RaDecPos', 'NullWCS', 'TanWcs', 'WcslibWcs',
+                 'ConstantFitsWcs']),
+        ('psf', ['NCircularGaussianPSF', 'GaussianMixturePSF', 'PixelizedPSF',
+                 'HybridPSF', 'HybridPixelizedPSF',
+                 'GaussianMixtureEllipsePSF']),
+        ('shifted', ['ScaledWcs', 'ShiftedWcs', 'ScaledPhotoCal',
+                     'ShiftedPsf', 'ParamsWrapper']),
+        ('patch', ['Patch', 'ModelMask']),
+        ('image', ['Image']),
+        ('engine', ['Images', 'Catalog', 'Tractor']),
+        ('psfex', ['VaryingGaussianPSF', 'PsfEx']),
+        ('ellipses', ['EllipseE', 'EllipseESoft']),
+        ('imageutils', ['interpret_roi']),
+        ('galaxy', ['GalaxyShape', 'Galaxy', 'ProfileGalaxy',
+                    'GaussianGalaxy', 'ExpGalaxy', 'DevGalaxy', 'FracDev',
+                    'SoftenedFracDev', 'FixedCompositeGalaxy',
+                    'CompositeGalaxy']),
+        ]:
+    for _name in _names:
+        _lazy[_name] = _mod
+del _mod, _names, _name
+
+# The modules whose contents the package used to import with "*";
+# searched, in reverse order, for other names.
+_star_modules = ['engine', 'ducks', 'basics', 'motion', 'psfex', 'ellipses',
+                 'imageutils', 'galaxy']
+
+
+def __getattr__(name):
+    mod = _lazy.get(name, None)
+    if mod is not None:
+        val = getattr(importlib.import_module('.' + mod, __name__), name)
+        globals()[name] = val
+        return val
+    # a submodule, eg, "tractor.galaxy"
+    if (not name.startswith('__') and
+        importlib.util.find_spec('%s.%s' % (__name__, name)) is not None):
+        return importlib.import_module('.' + name, __name__)
+    if not name.startswith('_'):
+        for mod in reversed(_star_modules):
+            mod = importlib.import_module('.' + mod, __name__)
+            if hasattr(mod, name):
+                val = getattr(mod, name)
+                globals()[name] = val
+                return val
+    raise AttributeError("module '%s' has no attribute '%s'" %
+                         (__name__, name))
+
+
+def __dir__():
+    return sorted(set(list(globals().keys()) + list(_lazy.keys())))
+
+
+if sys.version_info < (3, 7):
+    # No module-level __getattr__ (PEP 562): import everything eagerly, as
+    # the package always used to.
+    from .engine import *
+    from .ducks import *
+    from .basics import *
+    from .psf import (NCircularGaussianPSF, GaussianMixturePSF, PixelizedPSF,
+                      HybridPSF, HybridPixelizedPSF, GaussianMixtureEllipsePSF)
+    from .motion import *
+    from .psfex import *
+    from .ellipses import *
+    from .imageutils import *
+    from .galaxy import *
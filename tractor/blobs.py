@@ -0,0 +1,274 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`blobs.py`
+==========
+
+Blob decomposition: splitting a Tractor's sources into groups ("blobs")
+whose model footprints do not overlap (through pixels with non-zero
+inverse-error) in any image.  The blobs are independent least-squares
+problems, so each can be fit on its own -- with a smaller linear system
+and its own line search -- and they can be fit in parallel::
+
+    blobs = tractor.optimize_blobs(mp=mp)
+    for blob in blobs:
+        print(blob, blob.dlnp, blob.converged, blob.time)
+
+Each blob is fit by a sub-Tractor (see `getBlobTractor`) whose images
+are views of the blob's bounding box in each image, weighted only in
+the pixels of its sources' footprints, and whose catalog holds the
+blob's sources themselves, so the fit results land in the original
+catalog.
+'''
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from tractor.patch import ModelMask
+
+
+class Blob(object):
+    '''
+    A group of sources whose footprints are connected.
+
+    - *srcs*: indices of the sources in the catalog.
+    - *extents*: per image, the (x0, x1, y0, y1) bounding box of the
+      sources' footprints, or None if they do not touch the image.
+    - *pixmasks*: per image, a boolean array of the bounding-box shape,
+      True in the sources' footprints (and where the inverse-error is
+      non-zero), or None.
+    - *footprints*: per image, a dict from source index to ModelMask.
+
+    After `optimizeBlobs`: *dlnp* (change in log-probability), *steps*
+    and *converged* (as returned by the optimizer's `optimize_loop`;
+    *converged* is whether it met its convergence criterion rather than
+    running out of steps), *result* (the dict returned by
+    `optimize_loop`) and *time* (wall-clock seconds).
+    '''
+    def __init__(self, srcs, extents, pixmasks, footprints):
+        self.srcs = srcs
+        self.extents = extents
+        self.pixmasks = pixmasks
+        self.footprints = footprints
+        self.dlnp = None
+        self.steps = None
+        self.converged = None
+        self.result = None
+        self.time = None
+
+    def __str__(self):
+        return ('Blob: %i sources in %i images' %
+                (len(self.srcs),
+                 len([e for e in self.extents if e is not None])))
+
+    def numberOfPixels(self):
+        return sum([np.count_nonzero(m) for m in self.pixmasks
+                    if m is not None])
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def findBlobs(tractor, masks=None, minsb=None, nsigma=None, fluxfrac=None,
+              minradius=1):
+    '''
+    Segments the sources of *tractor* into blobs: connected groups of
+    sources whose footprints overlap in pixels with non-zero
+    inverse-error in some image.
+
+    *masks*: per-image {source: ModelMask} dicts giving the footprints.
+    By default, the tractor's model masks (see `Tractor.setModelMasks`)
+    are used if it has them; otherwise footprints are planned with
+    `footprint.planFootprints` (see that for *minsb*, *nsigma*,
+    *fluxfrac* and *minradius*).
+
+    Returns a list of `Blob` objects, in order of their first source.
+    Sources that touch no image are in no blob.
+    '''
+    if masks is None:
+        masks = tractor.modelMasks
+    if masks is None:
+        from tractor.footprint import planFootprints
+        masks = planFootprints(tractor, minsb=minsb, nsigma=nsigma,
+                               fluxfrac=fluxfrac, minradius=minradius)
+    cat = tractor.getCatalog()
+    srcindex = dict([(id(src), j) for j, src in enumerate(cat)
+                     if src is not None])
+    N = len(cat)
+    parent = list(range(N))
+    touches = np.zeros(N, bool)
+
+    # per image: {source index: ModelMask}
+    imfoot = []
+    for img, mm in zip(tractor.getImages(), masks):
+        H, W = img.shape
+        good = (img.getInvError() > 0)
+        # Paint each footprint's good pixels with its source index, first
+        # joining the source to the sources already painted there.  All
+        # sources that have painted a pixel end up in one set, so joining
+        # with the last painter suffices.
+        owner = np.empty((H, W), np.int32)
+        owner[:, :] = -1
+        foot = {}
+        for src, m in mm.items():
+            j = srcindex.get(id(src), None)
+            if j is None or m is None:
+                continue
+            x0, y0 = max(0, m.x0), max(0, m.y0)
+            x1, y1 = min(W, m.x0 + m.w), min(H, m.y0 + m.h)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            slc = slice(y0, y1), slice(x0, x1)
+            g = good[slc]
+            if m.mask is not None:
+                g = g & m.mask[y0 - m.y0:y1 - m.y0, x0 - m.x0:x1 - m.x0]
+            if not np.any(g):
+                continue
+            o = owner[slc]
+            for k in np.unique(o[g]):
+                if k < 0:
+                    continue
+                a, b = _find(parent, j), _find(parent, k)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+            o[g] = j
+            touches[j] = True
+            foot[j] = m
+        imfoot.append(foot)
+
+    groups = {}
+    for j in np.flatnonzero(touches):
+        groups.setdefault(_find(parent, j), []).append(int(j))
+
+    blobs = []
+    for root in sorted(groups.keys()):
+        srcs = groups[root]
+        extents = []
+        pixmasks = []
+        footprints = []
+        for img, foot in zip(tractor.getImages(), imfoot):
+            fp = dict([(j, foot[j]) for j in srcs if j in foot])
+            if len(fp) == 0:
+                extents.append(None)
+                pixmasks.append(None)
+                footprints.append(fp)
+                continue
+            H, W = img.shape
+            x0 = max(0, min([m.x0 for m in fp.values()]))
+            y0 = max(0, min([m.y0 for m in fp.values()]))
+            x1 = min(W, max([m.x0 + m.w for m in fp.values()]))
+            y1 = min(H, max([m.y0 + m.h for m in fp.values()]))
+            pm = np.zeros((y1 - y0, x1 - x0), bool)
+            for m in fp.values():
+                mx0, my0 = max(x0, m.x0), max(y0, m.y0)
+                mx1, my1 = min(x1, m.x0 + m.w), min(y1, m.y0 + m.h)
+                slc = slice(my0 - y0, my1 - y0), slice(mx0 - x0, mx1 - x0)
+                if m.mask is None:
+                    pm[slc] = True
+                else:
+                    pm[slc] |= m.mask[my0 - m.y0:my1 - m.y0,
+                                      mx0 - m.x0:mx1 - m.x0]
+            pm &= (img.getInvError()[y0:y1, x0:x1] > 0)
+            extents.append((int(x0), int(x1), int(y0), int(y1)))
+            pixmasks.append(pm)
+            footprints.append(fp)
+        blobs.append(Blob(srcs, extents, pixmasks, footprints))
+    return blobs
+
+
+def getBlobTractor(tractor, blob):
+    '''
+    Returns a Tractor for fitting *blob* of *tractor*.
+
+    Its images are `Image.subimage` views of the blob's bounding box in
+    each image it touches, with the inverse-error zeroed outside the
+    blob's footprints; its images' parameters are frozen.  Its catalog
+    holds the blob's sources (the same objects as in *tractor*, with
+    the same frozen/thawed state), and its model masks are the sources'
+    footprints.
+    '''
+    from tractor.engine import Tractor, Catalog
+    cat = tractor.getCatalog()
+    subimgs = []
+    submasks = []
+    for img, ext, pm, fp in zip(tractor.getImages(), blob.extents,
+                                blob.pixmasks, blob.footprints):
+        if ext is None:
+            continue
+        x0, x1, y0, y1 = ext
+        sub = img.subimage(x0, x1, y0, y1, copy=False)
+        sub.inverr = sub.inverr * pm
+        subimgs.append(sub)
+        mm = {}
+        for j, m in fp.items():
+            if m.mask is None:
+                mm[cat[j]] = ModelMask(m.x0 - x0, m.y0 - y0, m.w, m.h)
+            else:
+                mm[cat[j]] = ModelMask(m.x0 - x0, m.y0 - y0, m.mask)
+        submasks.append(mm)
+
+    subcat = Catalog(*[cat[j] for j in blob.srcs])
+    for k, j in enumerate(blob.srcs):
+        if not cat.liquid[j]:
+            subcat.freezeParam(k)
+    subtr = Tractor(subimgs, subcat, optimizer=tractor.optimizer,
+                    model_kwargs=tractor.model_kwargs)
+    subtr.modtype = tractor.modtype
+    subtr.batchRender = tractor.batchRender
+    subtr.freezeParam('images')
+    subtr.setModelMasks(submasks)
+    return subtr
+
+
+def _optimize_blob(args):
+    (subtr, kwargs) = args
+    t0 = time.time()
+    lnp0 = subtr.getLogProb()
+    R = subtr.optimize_loop(**kwargs)
+    lnp1 = subtr.getLogProb()
+    dt = time.time() - t0
+    return subtr.catalog.getParams(), R, lnp1 - lnp0, dt
+
+
+def optimizeBlobs(tractor, blobs=None, mp=None, **kwargs):
+    '''
+    Fits each of *blobs* (by default, `findBlobs(tractor)`)
+    independently, with its own `Tractor.optimize_loop` (to which
+    *kwargs* are passed), and sets the results in *tractor*'s catalog.
+
+    *mp*: an object with a `map` method (eg, an
+    `astrometry.util.multiproc.multiproc` or a `multiprocessing.Pool`)
+    with which to fit the blobs in parallel; each worker is sent only
+    its blob's sub-images.
+
+    Returns the list of blobs, with their convergence and timing
+    attributes set (see `Blob`).
+    '''
+    if blobs is None:
+        blobs = findBlobs(tractor)
+    if tractor.isParamFrozen('catalog'):
+        return blobs
+    subs = [getBlobTractor(tractor, blob) for blob in blobs]
+    args = [(sub, kwargs) for sub in subs]
+    if mp is None:
+        R = map(_optimize_blob, args)
+    else:
+        R = mp.map(_optimize_blob, args)
+    for blob, sub, (params, res, dlnp, dt) in zip(blobs, subs, R):
+        # (a no-op unless the blob was fit in another process)
+        sub.catalog.setParams(params)
+        if res is None:
+            res = {}
+        blob.result = res
+        blob.steps = res.get('steps', None)
+        blob.converged = res.get('converged', None)
+        blob.dlnp = dlnp
+        blob.time = dt
+    return blobs
@@ -299,6 +299,21 @@ class MagsPhotoCal(ParamList, ducks.ImageCalibration):
     def countsToMag(self, counts):
         return self.zp - 2.5 * np.log10(counts)
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        '''
+        Counts are proportional to 10**(0.4 * zp), so the derivative
+        of the model image with respect to the zeropoint is just the
+        (sky-free) model image, scaled by 0.4 ln(10).
+        '''
+        from tractor.patch import Patch
+        if self.numberOfParams() == 0:
+            return []
+        mod = tractor.getModelImage(img, srcs, sky=False)
+        mod *= 0.4 * np.log(10.)
+        p = Patch(0, 0, mod)
+        p.setName('dzp')
+        return [p]
+
     def __str__(self):
         return 'MagsPhotoCal(band=%s, zp=%.3f)' % (self.band, self.zp)
 
@@ -343,6 +358,22 @@ class LinearPhotoCal(ScalarParam, ducks.ImageCalibration):
             counts = brightness.getFlux(self.band) * self.val
         return counts
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        '''
+        Counts are linear in the scale factor, so the derivative of
+        the model image is just the (sky-free) model image divided by
+        the scale.
+        '''
+        from tractor.patch import Patch
+        if self.val == 0:
+            # Let the Tractor take finite differences.
+            return [False]
+        mod = tractor.getModelImage(img, srcs, sky=False)
+        mod /= self.val
+        p = Patch(0, 0, mod)
+        p.setName('dscale')
+        return [p]
+
     def toStandardFitsHeader(self, hdr):
         hdr.add_record(
             dict(name='MAGZP',
@@ -17,6 +17,7 @@
 #include <sys/param.h>
 
 #include <vector>
+#include <algorithm>
 
 #include "ceres-tractor.h"
 
@@ -381,3 +382,214 @@ bool ImageCostFunction::_Evaluate(double const* const* parameters,
 
     return true;
 }
+
+
+
+#ifdef TRACTOR_CERES_TILED
+
+TractorEvaluator::TractorEvaluator(PyObject* tractor, int nims,
+                                   PyArrayObject* np_params) :
+    _ok(false), _have_derivs(false),
+    _W(nims, 0), _H(nims, 0), _chi(nims), _derivs(nims),
+    _tractor(tractor), _nims(nims), _np_params(np_params) {
+
+    for (int i=0; i<_nims; i++) {
+        PyObject* image = PyObject_CallMethod(_tractor, (char*)"getImage",
+                                              (char*)"i", i);
+        PyObject* ret;
+        ret = PyObject_CallMethod(image, (char*)"getWidth", NULL);
+        _W[i] = PyInt_AsLong(ret);
+        Py_DECREF(ret);
+        ret = PyObject_CallMethod(image, (char*)"getHeight", NULL);
+        _H[i] = PyInt_AsLong(ret);
+        Py_DECREF(ret);
+        Py_DECREF(image);
+        _chi[i].resize((size_t)_W[i] * _H[i]);
+    }
+}
+
+TractorEvaluator::~TractorEvaluator() {}
+
+void TractorEvaluator::PrepareForEvaluation(bool evaluate_jacobians,
+                                            bool new_evaluation_point) {
+    // Ceres has already written the evaluation point into the
+    // parameter blocks, which are the "_np_params" array's data.
+    if (new_evaluation_point || !_ok) {
+        _ok = false;
+        _have_derivs = false;
+#if defined(IS_PY3K)
+        PyObject* setparams = PyUnicode_FromString("setParams");
+#else
+        PyObject* setparams = PyString_FromString((char*)"setParams");
+#endif
+        PyObject* ret = PyObject_CallMethodObjArgs(_tractor, setparams,
+                                                   _np_params, NULL);
+        Py_DECREF(setparams);
+        if (!ret) {
+            printf("failed to setParams()\n");
+            PyErr_Print();
+            return;
+        }
+        Py_DECREF(ret);
+        for (int i=0; i<_nims; i++)
+            if (!_getChi(i))
+                return;
+        _ok = true;
+    }
+    if (evaluate_jacobians && !_have_derivs) {
+        for (int i=0; i<_nims; i++) {
+            if (!_getDerivs(i)) {
+                _ok = false;
+                return;
+            }
+        }
+        _have_derivs = true;
+    }
+}
+
+bool TractorEvaluator::_getChi(int imagei) {
+    PyObject* chi = PyObject_CallMethod(_tractor, (char*)"getChiImage",
+                                        (char*)"i", imagei);
+    if (!chi) {
+        printf("getChiImage() failed\n");
+        PyErr_Print();
+        return false;
+    }
+    PyArrayObject* np_chi = (PyArrayObject*)PyArray_FROMANY(
+        chi, NPY_DOUBLE, 2, 2, NPY_ARRAY_CARRAY_RO);
+    Py_DECREF(chi);
+    if (!np_chi) {
+        printf("expected getChiImage() to return a 2-d array\n");
+        PyErr_Print();
+        return false;
+    }
+    if ((PyArray_DIM(np_chi, 0) != _H[imagei]) ||
+        (PyArray_DIM(np_chi, 1) != _W[imagei])) {
+        printf("getChiImage(%i) returned the wrong shape\n", imagei);
+        Py_DECREF(np_chi);
+        return false;
+    }
+    memcpy(_chi[imagei].data(), PyArray_DATA(np_chi),
+           _chi[imagei].size() * sizeof(double));
+    Py_DECREF(np_chi);
+    return true;
+}
+
+bool TractorEvaluator::_getDerivs(int imagei) {
+    // NOTE -- _getOneImageDerivs() returns dCHI / dParam, not the usual
+    // dModel / dParam!
+    std::vector<Deriv>& derivs = _derivs[imagei];
+    derivs.clear();
+    PyObject* allderivs = PyObject_CallMethod(
+        _tractor, (char*)"_getOneImageDerivs", (char*)"i", imagei);
+    if (!allderivs) {
+        printf("_getOneImageDerivs() returned NULL\n");
+        PyErr_Print();
+        return false;
+    }
+    if (!PyList_Check(allderivs)) {
+        printf("Expecting allderivs to be a list\n");
+        Py_DECREF(allderivs);
+        return false;
+    }
+    int n = (int)PyList_Size(allderivs);
+    derivs.resize(n);
+    for (int ideriv=0; ideriv<n; ideriv++) {
+        PyObject* deriv = PyList_GetItem(allderivs, ideriv);
+        if (!PyTuple_Check(deriv) || (PyTuple_Size(deriv) != 4)) {
+            printf("Expected allderivs element %i to be a 4-tuple\n", ideriv);
+            Py_DECREF(allderivs);
+            return false;
+        }
+        PyArrayObject* np_deriv = (PyArrayObject*)PyArray_FROMANY(
+            PyTuple_GetItem(deriv, 3), NPY_DOUBLE, 2, 2, NPY_ARRAY_CARRAY_RO);
+        if (!np_deriv) {
+            printf("Expected allderivs element %i to contain a 2-d array\n",
+                   ideriv);
+            PyErr_Print();
+            Py_DECREF(allderivs);
+            return false;
+        }
+        Deriv& d = derivs[ideriv];
+        d._iparam = PyInt_AsLong(PyTuple_GetItem(deriv, 0));
+        d._x0 = PyInt_AsLong(PyTuple_GetItem(deriv, 1));
+        d._y0 = PyInt_AsLong(PyTuple_GetItem(deriv, 2));
+        d._h = PyArray_DIM(np_deriv, 0);
+        d._w = PyArray_DIM(np_deriv, 1);
+        d._vals.resize((size_t)d._w * d._h);
+        memcpy(d._vals.data(), PyArray_DATA(np_deriv),
+               d._vals.size() * sizeof(double));
+        Py_DECREF(np_deriv);
+    }
+    Py_DECREF(allderivs);
+    return true;
+}
+
+ImageTileCostFunction::ImageTileCostFunction(TractorEvaluator* evaluator,
+                                             int imagei,
+                                             int x0, int y0, int w, int h,
+                                             std::vector<int> params) :
+    _ev(evaluator), _imagei(imagei), _x0(x0), _y0(y0), _w(w), _h(h),
+    _params(params) {
+
+    set_num_residuals(_w * _h);
+    std::vector<int32_t>* bs = mutable_parameter_block_sizes();
+    for (size_t i=0; i<_params.size(); i++) {
+        bs->push_back(1);
+    }
+}
+
+ImageTileCostFunction::~ImageTileCostFunction() {}
+
+bool ImageTileCostFunction::Evaluate(double const* const* parameters,
+                                     double* residuals,
+                                     double** jacobians) const {
+    // The chi image and derivatives were computed by the
+    // TractorEvaluator (for all tiles at once); this only reads them,
+    // so can be called from multiple threads.
+    if (!_ev->_ok)
+        return false;
+    int W = _ev->_W[_imagei];
+    const double* chi = _ev->_chi[_imagei].data();
+    for (int y=0; y<_h; y++) {
+        memcpy(residuals + y * _w, chi + (_y0 + y) * W + _x0,
+               _w * sizeof(double));
+    }
+    if (!jacobians)
+        return true;
+    if (!_ev->_have_derivs)
+        return false;
+
+    int npix = _w * _h;
+    for (size_t k=0; k<_params.size(); k++) {
+        if (jacobians[k])
+            memset(jacobians[k], 0, npix * sizeof(double));
+    }
+    const std::vector<TractorEvaluator::Deriv>& derivs = _ev->_derivs[_imagei];
+    for (size_t i=0; i<derivs.size(); i++) {
+        const TractorEvaluator::Deriv& d = derivs[i];
+        std::vector<int>::const_iterator it =
+            std::lower_bound(_params.begin(), _params.end(), d._iparam);
+        if ((it == _params.end()) || (*it != d._iparam))
+            // (the parameter's derivative has moved onto this tile
+            // since the problem was set up; it is dropped)
+            continue;
+        double* J = jacobians[it - _params.begin()];
+        if (!J)
+            continue;
+        int xlo = MAX(d._x0, _x0);
+        int xhi = MIN(d._x0 + d._w, _x0 + _w);
+        int ylo = MAX(d._y0, _y0);
+        int yhi = MIN(d._y0 + d._h, _y0 + _h);
+        for (int y=ylo; y<yhi; y++) {
+            double* jrow = J + (y - _y0) * _w + (xlo - _x0);
+            const double* drow = d._vals.data() + (y - d._y0) * d._w +
+                (xlo - d._x0);
+            for (int x=xlo; x<xhi; x++, jrow++, drow++)
+                (*jrow) += (*drow);
+        }
+    }
+    return true;
+}
+
+#endif // TRACTOR_CERES_TILED
@@ -83,3 +83,74 @@ class ImageCostFunction : public CostFunction {
     int _H;
     PyArrayObject* _np_params;
 };
+
+
+// For ceres_opt_tiled: evaluates the chi images (and their
+// derivatives) of all images once per evaluation point, so that the
+// per-tile residual blocks (ImageTileCostFunction) just copy out of
+// them.  Requires Ceres' EvaluationCallback (ceres >= 1.14).
+#if (CERES_VERSION_MAJOR > 1) || \
+    ((CERES_VERSION_MAJOR == 1) && (CERES_VERSION_MINOR >= 14))
+#define TRACTOR_CERES_TILED 1
+#include "ceres/evaluation_callback.h"
+
+class TractorEvaluator : public ceres::EvaluationCallback {
+ public:
+    TractorEvaluator(PyObject* tractor, int nims, PyArrayObject* np_params);
+    virtual ~TractorEvaluator();
+
+    virtual void PrepareForEvaluation(bool evaluate_jacobians,
+                                      bool new_evaluation_point);
+
+    class Deriv {
+    public:
+        int _iparam;
+        int _x0;
+        int _y0;
+        int _w;
+        int _h;
+        std::vector<double> _vals;
+    };
+
+    bool _ok;
+    bool _have_derivs;
+    std::vector<int> _W;
+    std::vector<int> _H;
+    // per image: chi image
+    std::vector<std::vector<double> > _chi;
+    // per image: dchi/dparam patches
+    std::vector<std::vector<Deriv> > _derivs;
+
+ protected:
+    bool _getChi(int imagei);
+    bool _getDerivs(int imagei);
+
+    PyObject* _tractor;
+    int _nims;
+    PyArrayObject* _np_params;
+};
+
+// A (x0,y0,w,h) pixel tile of one image, which depends only on the
+// given (sorted) list of parameters.
+class ImageTileCostFunction : public CostFunction {
+ public:
+    virtual ~ImageTileCostFunction();
+
+    ImageTileCostFunction(TractorEvaluator* evaluator, int imagei,
+                          int x0, int y0, int w, int h,
+                          std::vector<int> params);
+
+    virtual bool Evaluate(double const* const* parameters,
+                          double* residuals,
+                          double** jacobians) const;
+ protected:
+    TractorEvaluator* _ev;
+    int _imagei;
+    int _x0;
+    int _y0;
+    int _w;
+    int _h;
+    std::vector<int> _params;
+};
+
+#endif // TRACTOR_CERES_TILED
@@ -39,6 +39,117 @@
 
 #include "ceres-tractor.h"
 
+static PyObject* run_forced_phot(Problem& problem,
+                                 double* realfluxes,
+                                 int Nfluxes,
+                                 int nonneg,
+                                 int verbose,
+                                 int nthreads) {
+    // Run the solver!
+    Solver::Options options;
+    if (verbose)
+        options.minimizer_progress_to_stdout = true;
+    if (nthreads) {
+        options.num_threads = nthreads;
+        // deprecated as of ceres 1.14 (controlled by num_threads)
+        // (and gone in ceres 2.0.0)
+        //options.num_linear_solver_threads = nthreads;
+    }
+    //options.linear_solver_type = ceres::SPARSE_NORMAL_CHOLESKY;
+    options.linear_solver_type = ceres::SPARSE_SCHUR;
+
+    options.jacobi_scaling = false;
+    //options.jacobi_scaling = true;
+
+    // .minimizer_type = TRUST_REGION / LINE_SEARCH
+    // .linear_solver_type = SPARSE_NORMAL_CHOLESKY / DENSE_QR
+    // / DENSE_SCHUR / SPARSE_SCHUR
+    // .trust_region_strategy_type = LEVENBERG_MARQUARDT / DOGLEG
+    // .dogleg_type = TRADITIONAL_DOGLEG / SUBSPACE_DOGLEG 
+
+    // linear subspaces
+    // .use_inner_iterations = true;
+    // .minimizer_type = TRUST_REGION / LINE_SEARCH
+    // .line_search_direction_type = LBFGS / STEEPEST_DESCENT / NONLINEAR_CONJUGATE_GRADIENT / BFGS
+    // .line_search_type = WOLFE / ARMIJO
+    // .nonlinear_conjugate_gradient_type = FLETCHER_REEVES / POLAK_RIBIRERE / HESTENES_STIEFEL
+    // .max_lbfs_rank = 20
+    // .use_approximate_eigenvalue_bfgs_scaling
+    // .line_search_interpolation_type = CUBIC / ...
+    // .min_line_search_step_size
+    // .line_search_sufficient_function_decrease
+    // .max_line_search_step_contraction
+    // .min_line_search_step_contraction
+    // .max_num_line_search_step_size_iterations
+    // .max_num_line_search_direction_restarts
+    // .line_search_sufficient_curvature_decrease
+    // .max_line_search_step_expansion
+    // .use_nonmonotonic_steps
+    // .max_consecutive_nonmonotonic_steps
+    // .max_num_iterations
+    // .max_solver_time_in_seconds
+    // .num_threads
+    // .initial_trust_region_radius
+    // .max_trust_region_radius
+    // .min_trust_region_radius
+    // .min_relative_decrease
+    // .min_lm_diagonal
+    // .max_lm_diagonal
+    // .max_num_consecutive_invalid_steps
+    // .function_tolerance = 1e-6
+    // .gradient_tolerance
+    // .parameter_tolerance = 1e-8
+    // .preconditioner_type
+    // .dense_linear_algebra_library_type
+    // .sparse_linear_algebra_library_type
+    // .num_linear_solver_threads
+    // .linear_solver_ordering
+    // .use_post_ordering
+    // .min_linear_solver_iterations
+    // .max_linear_solver_iterations
+    // .eta
+    //
+    // Jacobian is scaled by the norm of its columns before being passed to the linear solver. This improves the numerical conditioning of the normal equations.
+    // .jacobi_scaling = true
+    //
+    // .inner_itearation_tolerance
+    // .inner_iteration_ordering
+    // .logging_type
+    // .minimizer_progress_to_stdout
+    // .numeric_derivative_relative_step_size
+    
+    Solver::Summary summary;
+    Solve(options, &problem, &summary);
+
+    if (verbose)
+        printf("%s\n", summary.BriefReport().c_str());
+    //std::cout << summary.FullReport() << "\n";
+
+    if (nonneg) {
+        for (int j=0; j<Nfluxes; j++) {
+            realfluxes[j] = exp(realfluxes[j]);
+        }
+    }
+
+
+    // CERES 1.9.0
+    const char* errstring = summary.message.c_str();
+    // CERES 1.8.0
+    //const char* errstring = summary.error.c_str();
+
+    return Py_BuildValue("{sisssdsdsdsssssisisi}",
+                         "termination", int(summary.termination_type),
+                         "error", errstring,
+                         "initial_cost", summary.initial_cost,
+                         "final_cost", summary.final_cost,
+                         "fixed_cost", summary.fixed_cost,
+                         "brief_report", summary.BriefReport().c_str(),
+                         "full_report", summary.FullReport().c_str(),
+                         "steps_successful", summary.num_successful_steps,
+                         "steps_unsuccessful", summary.num_unsuccessful_steps,
+                         "steps_inner", summary.num_inner_iteration_steps);
+}
+
 template <typename T>
 static PyObject* real_ceres_forced_phot(PyObject* blocks,
                                         PyObject* np_fluxes,
@@ -165,114 +276,312 @@ static PyObject* real_ceres_forced_phot(PyObject* blocks,
         printf("Ceres: %i blocks, total %i pixels, %i sources-in-blocks, %i sources, %i deriv elements\n",
                (int)Nblocks, totaldatapix, totalsources, Nfluxes, totalderivpix);
     
-    // Run the solver!
-    Solver::Options options;
+    return run_forced_phot(problem, realfluxes, Nfluxes, nonneg, verbose,
+                           nthreads);
+}
+
+template <typename T>
+static PyObject* real_ceres_forced_phot_packed(PyArrayObject* img,
+                                               PyArrayObject* mod0,
+                                               PyArrayObject* ierr,
+                                               PyArrayObject* blockxy,
+                                               PyArrayObject* blockstart,
+                                               PyArrayObject* srcs,
+                                               PyArrayObject* svals,
+                                               PyObject* np_fluxes,
+                                               int npy_type,
+                                               int nonneg,
+                                               int verbose,
+                                               int nthreads) {
+    // Note, if you change this function signature, you also need
+    // to change the template instantiations below!
+    /*
+     img, ierr: (Nblocks, BH, BW) arrays; mod0: same, or NULL.
+     blockxy: (Nblocks, 2) int64: x0,y0 of each block.
+     blockstart: (Nblocks+1) int64: block i contains sources
+        blockstart[i] <= j < blockstart[i+1].
+     srcs: (Nsources, 6) int64: (flux index, x0, y0, w, h, offset into svals)
+     svals: packed unit-flux model pixels.
+     */
+    int Nblocks, BH, BW, bpix;
+    T *imgdata, *mod0data, *ierrdata, *uvals;
+    npy_int64 *bxy, *bstart, *src;
+    Problem problem;
+    int totaldatapix = 0;
+    int totalsources = 0;
+
+    assert(PyArray_Check(np_fluxes));
+    assert(PyArray_TYPE((PyArrayObject*)np_fluxes) == NPY_DOUBLE);
+    int Nfluxes = (int)PyArray_Size(np_fluxes);
+    double* realfluxes = (double*)PyArray_DATA((PyArrayObject*)np_fluxes);
+
+    assert(PyArray_NDIM(img) == 3);
+    assert(PyArray_ISCARRAY(img));
+    assert(PyArray_TYPE(img) == npy_type);
+    assert(PyArray_ISCARRAY(ierr));
+    assert(PyArray_TYPE(ierr) == npy_type);
+    assert(PyArray_ISCARRAY(svals));
+    assert(PyArray_TYPE(svals) == npy_type);
+    assert(PyArray_TYPE(blockxy) == NPY_INT64);
+    assert(PyArray_TYPE(blockstart) == NPY_INT64);
+    assert(PyArray_TYPE(srcs) == NPY_INT64);
+    Nblocks = (int)PyArray_DIM(img, 0);
+    BH = (int)PyArray_DIM(img, 1);
+    BW = (int)PyArray_DIM(img, 2);
+    bpix = BW * BH;
+    assert(PyArray_Size((PyObject*)ierr) == PyArray_Size((PyObject*)img));
+    assert(PyArray_Size((PyObject*)blockxy) == 2 * Nblocks);
+    assert(PyArray_Size((PyObject*)blockstart) == Nblocks + 1);
+
+    imgdata  = (T*)PyArray_DATA(img);
+    ierrdata = (T*)PyArray_DATA(ierr);
+    mod0data = NULL;
+    if (mod0) {
+        assert(PyArray_ISCARRAY(mod0));
+        assert(PyArray_TYPE(mod0) == npy_type);
+        assert(PyArray_Size((PyObject*)mod0) == PyArray_Size((PyObject*)img));
+        mod0data = (T*)PyArray_DATA(mod0);
+    }
+    uvals  = (T*)PyArray_DATA(svals);
+    bxy    = (npy_int64*)PyArray_DATA(blockxy);
+    bstart = (npy_int64*)PyArray_DATA(blockstart);
+    src    = (npy_int64*)PyArray_DATA(srcs);
+
+    if (nonneg) {
+        // params = log(flux)
+        for (int j=0; j<Nfluxes; j++) {
+            realfluxes[j] = log(MAX(realfluxes[j], 1e-6));
+        }
+    }
+
+    for (int i=0; i<Nblocks; i++) {
+        size_t off = (size_t)i * bpix;
+        Patch<T> data((int)bxy[2*i], (int)bxy[2*i+1], BW, BH,
+                      imgdata + off,
+                      (mod0data ? mod0data + off : NULL),
+                      ierrdata + off);
+        std::vector<Patch<T> > patches;
+        std::vector<double*> fluxes;
+        for (npy_int64 j=bstart[i]; j<bstart[i+1]; j++) {
+            npy_int64* s = src + 6*j;
+            assert(s[0] >= 0);
+            assert(s[0] < Nfluxes);
+            patches.push_back(Patch<T>((int)s[1], (int)s[2], (int)s[3],
+                                       (int)s[4], uvals + s[5]));
+            fluxes.push_back(realfluxes + s[0]);
+        }
+        CostFunction* cost = new ForcedPhotCostFunction<T>(data, patches,
+                                                           nonneg);
+        problem.AddResidualBlock(cost, NULL, fluxes);
+        totaldatapix += bpix;
+        totalsources += (int)patches.size();
+    }
     if (verbose)
-        options.minimizer_progress_to_stdout = true;
-    if (nthreads) {
-        options.num_threads = nthreads;
-        // deprecated as of ceres 1.14 (controlled by num_threads)
-        // (and gone in ceres 2.0.0)
-        //options.num_linear_solver_threads = nthreads;
+        printf("Ceres: %i blocks, total %i pixels, %i sources-in-blocks, %i sources\n",
+               Nblocks, totaldatapix, totalsources, Nfluxes);
+
+    return run_forced_phot(problem, realfluxes, Nfluxes, nonneg, verbose,
+                           nthreads);
+}
+
+template PyObject* real_ceres_forced_phot<float>(PyObject*, PyObject*, int, int, int, int);
+template PyObject* real_ceres_forced_phot<double>(PyObject*, PyObject*, int, int, int, int);
+template PyObject* real_ceres_forced_phot_packed<float>(PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyObject*, int, int, int, int);
+template PyObject* real_ceres_forced_phot_packed<double>(PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyArrayObject*, PyObject*, int, int, int, int);
+
+// Adds NormalPrior residual blocks for the (index, mean, sigma)
+// tuples in the "gaussian_priors" list.  Returns 0 on success.
+static int add_gaussian_priors(Problem& problem, double* params,
+                               PyObject* gaussian_priors) {
+    if (gaussian_priors != Py_None) {
+        if (!PyList_Check(gaussian_priors)) {
+            printf("Expected gaussian_priors to be a list\n");
+            return -1;
+        }
+        size_t nterms = PyList_Size(gaussian_priors);
+        for (size_t i=0; i<nterms; i++) {
+            PyObject* tup = PyList_GetItem(gaussian_priors, i);
+            if (!PySequence_Check(tup)) {
+                printf("Expected gaussian_priors to contain iterables; element %i is not\n", (int)i);
+                return -1;
+            }
+            if (PySequence_Size(tup) != 3) {
+                printf("Expected gaussian_priors to contain length-3 iterables; element %i is not\n", (int)i);
+                return -1;
+            }
+            PyObject* pyi = PySequence_GetItem(tup, 0);
+            PyObject* pym = PySequence_GetItem(tup, 1);
+            PyObject* pys = PySequence_GetItem(tup, 2);
+
+            PyObject* ii = PyNumber_Int(pyi);
+            if (!ii) {
+                printf("Expected gaussian_priors element %i, index 0, to be an integer\n", (int)i);
+                return -1;
+            }
+            int index = PyInt_AsLong(ii);
+
+            PyObject* fm = PyNumber_Float(pym);
+            PyObject* fs = PyNumber_Float(pys);
+            if (!fm) {
+                printf("Expected gaussian_priors element %i, index 1, to be a float\n", (int)i);
+                return -1;
+            }
+            if (!fs) {
+                printf("Expected gaussian_priors element %i, index 2, to be a float\n", (int)i);
+            }
+            double mean  = PyFloat_AsDouble(fm);
+            double sigma = PyFloat_AsDouble(fs);
+
+            Py_DECREF(ii);
+            Py_DECREF(fm);
+            Py_DECREF(fs);
+            Py_DECREF(pyi);
+            Py_DECREF(pym);
+            Py_DECREF(pys);
+
+            Eigen::MatrixXd A(1,1);
+            A(0,0) = 1. / sigma;
+            Eigen::VectorXd mu(1);
+            mu[0] = mean;
+
+            //printf("Adding Gaussian prior on parameter %i (current value "
+            //"%f): mean %f, sigma %f\n", index, params[index], mean, sigma);
+            //printf("A size: %i, %i.  Mu size: %i\n", 
+            //A.rows(), A.cols(), mu.size());
+            CostFunction* prior = new ceres::NormalPrior(A, mu);
+            problem.AddResidualBlock(prior, NULL, params + index);
+        }
     }
-    //options.linear_solver_type = ceres::SPARSE_NORMAL_CHOLESKY;
-    options.linear_solver_type = ceres::SPARSE_SCHUR;
+    return 0;
+}
 
-    options.jacobi_scaling = false;
-    //options.jacobi_scaling = true;
+// Sets parameter bounds given the (index, bound, is-lower) tuples in
+// the "lubounds" list.  Returns 0 on success.
+static int add_lubounds(Problem& problem, double* params,
+                        PyObject* lubounds) {
+    if (lubounds != Py_None) {
+        if (!PyList_Check(lubounds)) {
+            printf("Expected lubounds to be a list\n");
+            return -1;
+        }
+        size_t nterms = PyList_Size(lubounds);
+        for (size_t i=0; i<nterms; i++) {
+            PyObject* tup = PyList_GetItem(lubounds, i);
+            if (!PySequence_Check(tup)) {
+                printf("Expected lubounds to contain iterables; element %i is not\n", (int)i);
+                return -1;
+            }
+            if (PySequence_Size(tup) != 3) {
+                printf("Expected lubounds to contain length-3 iterables; element %i is not\n", (int)i);
+                return -1;
+            }
+            // (int index, float bound, bool lower)
+            PyObject* pyi = PySequence_GetItem(tup, 0);
+            PyObject* pyb = PySequence_GetItem(tup, 1);
+            PyObject* pyl = PySequence_GetItem(tup, 2);
 
-    // .minimizer_type = TRUST_REGION / LINE_SEARCH
-    // .linear_solver_type = SPARSE_NORMAL_CHOLESKY / DENSE_QR
-    // / DENSE_SCHUR / SPARSE_SCHUR
-    // .trust_region_strategy_type = LEVENBERG_MARQUARDT / DOGLEG
-    // .dogleg_type = TRADITIONAL_DOGLEG / SUBSPACE_DOGLEG 
+            if (!PyInt_Check(pyi)) {
+                printf("Expected lubounds element %i, index 0, to be an integer\n", (int)i);
+                return -1;
+            }
+            int index = PyInt_AsLong(pyi);
+            Py_DECREF(pyi);
 
-    // linear subspaces
-    // .use_inner_iterations = true;
-    // .minimizer_type = TRUST_REGION / LINE_SEARCH
-    // .line_search_direction_type = LBFGS / STEEPEST_DESCENT / NONLINEAR_CONJUGATE_GRADIENT / BFGS
-    // .line_search_type = WOLFE / ARMIJO
-    // .nonlinear_conjugate_gradient_type = FLETCHER_REEVES / POLAK_RIBIRERE / HESTENES_STIEFEL
-    // .max_lbfs_rank = 20
-    // .use_approximate_eigenvalue_bfgs_scaling
-    // .line_search_interpolation_type = CUBIC / ...
-    // .min_line_search_step_size
-    // .line_search_sufficient_function_decrease
-    // .max_line_search_step_contraction
-    // .min_line_search_step_contraction
-    // .max_num_line_search_step_size_iterations
-    // .max_num_line_search_direction_restarts
-    // .line_search_sufficient_curvature_decrease
-    // .max_line_search_step_expansion
-    // .use_nonmonotonic_steps
-    // .max_consecutive_nonmonotonic_steps
-    // .max_num_iterations
-    // .max_solver_time_in_seconds
-    // .num_threads
-    // .initial_trust_region_radius
-    // .max_trust_region_radius
-    // .min_trust_region_radius
-    // .min_relative_decrease
-    // .min_lm_diagonal
-    // .max_lm_diagonal
-    // .max_num_consecutive_invalid_steps
-    // .function_tolerance = 1e-6
-    // .gradient_tolerance
-    // .parameter_tolerance = 1e-8
-    // .preconditioner_type
-    // .dense_linear_algebra_library_type
-    // .sparse_linear_algebra_library_type
-    // .num_linear_solver_threads
-    // .linear_solver_ordering
-    // .use_post_ordering
-    // .min_linear_solver_iterations
-    // .max_linear_solver_iterations
-    // .eta
-    //
-    // Jacobian is scaled by the norm of its columns before being passed to the linear solver. This improves the numerical conditioning of the normal equations.
-    // .jacobi_scaling = true
-    //
-    // .inner_itearation_tolerance
-    // .inner_iteration_ordering
-    // .logging_type
-    // .minimizer_progress_to_stdout
-    // .numeric_derivative_relative_step_size
-    
-    Solver::Summary summary;
-    Solve(options, &problem, &summary);
+            if (!PyFloat_Check(pyb)) {
+                printf("Expected lubounds element %i, index 1, to be a float\n", (int)i);
+                return -1;
+            }
+            double bound = PyFloat_AsDouble(pyb);
+            Py_DECREF(pyb);
+            
+            if (!PyBool_Check(pyl)) {
+                printf("Expected lubounds element %i, index 2, to be a bool\n", (int)i);
+                return -1;
+            }
+            int islower = (pyl == Py_True);
+            Py_DECREF(pyl);
+
+            //printf("Bound on element %i, bound %g, %s bound\n",
+            //index, bound, (islower ? "lower" : "upper"));
+
+            if (islower)
+                problem.SetParameterLowerBound(params + index, 0, bound);
+            else
+                problem.SetParameterUpperBound(params + index, 0, bound);
+
+        }
+    }
+    return 0;
+}
+
+// Computes the variances (if "py_variance" is not None) and returns
+// the results dict of ceres_opt.
+static PyObject* opt_results(Problem& problem, Solver::Summary& summary,
+                             double* params, int nparams,
+                             PyObject* py_variance) {
+    int i;
+    int get_variance = (py_variance != Py_None);
+    int variance_ok = 0;
+    PyArrayObject *np_variance = NULL;
+
+    if (get_variance && (summary.termination_type == ceres::CONVERGENCE)) {
+        if (!PyArray_Check(py_variance)) {
+            printf("ceres_opt: variance must be a numpy array\n");
+            return NULL;
+        }
+        np_variance = (PyArrayObject*)py_variance;
+        if (PyArray_TYPE(np_variance) != NPY_DOUBLE) {
+            printf("ceres_opt: wrong type for variance variable\n");
+            return NULL;
+        }
+        if (PyArray_SIZE(np_variance) != nparams) {
+            printf("ceres_opt: wrong size for variance variable\n");
+            return NULL;
+        }
+        double* cov_out = (double*)PyArray_DATA(np_variance);
+        for (i=0; i<nparams; i++)
+            cov_out[i] = 0.0;
+
+        ceres::Covariance::Options options;
 
-    if (verbose)
-        printf("%s\n", summary.BriefReport().c_str());
-    //std::cout << summary.FullReport() << "\n";
+        options.algorithm_type = ceres::DENSE_SVD;
+        options.null_space_rank = -1;
+        //options.algorithm_type = SPARSE_QR;
+        //options.algorithm_type = SPARSE_CHOLESKY;
 
-    if (nonneg) {
-        for (int j=0; j<Nfluxes; j++) {
-            realfluxes[j] = exp(realfluxes[j]);
+        ceres::Covariance covariance(options);
+
+        std::vector<std::pair<const double*, const double*> > covar_blocks;
+        for (i=0; i<nparams; i++)
+            covar_blocks.push_back(std::make_pair(params+i, params+i));
+        if (!covariance.Compute(covar_blocks, &problem)) {
+            printf("ceres_opt: failed to compute variance\n");
+            // ?
+            return NULL;
+        } else {
+            variance_ok = 1;
         }
+        for (i=0; i<nparams; i++)
+            covariance.GetCovarianceBlock(params+i, params+i, cov_out+i);
     }
 
-
-    // CERES 1.9.0
     const char* errstring = summary.message.c_str();
-    // CERES 1.8.0
-    //const char* errstring = summary.error.c_str();
 
-    return Py_BuildValue("{sisssdsdsdsssssisisi}",
-                         "termination", int(summary.termination_type),
-                         "error", errstring,
-                         "initial_cost", summary.initial_cost,
-                         "final_cost", summary.final_cost,
-                         "fixed_cost", summary.fixed_cost,
-                         "brief_report", summary.BriefReport().c_str(),
-                         "full_report", summary.FullReport().c_str(),
-                         "steps_successful", summary.num_successful_steps,
-                         "steps_unsuccessful", summary.num_unsuccessful_steps,
-                         "steps_inner", summary.num_inner_iteration_steps);
-                         
+    return Py_BuildValue
+        ("{sisssdsdsdsssssisisisi}",
+         "termination", int(summary.termination_type),
+         "error", errstring,
+         "initial_cost", summary.initial_cost,
+         "final_cost", summary.final_cost,
+         "fixed_cost", summary.fixed_cost,
+         "brief_report", summary.BriefReport().c_str(),
+         "full_report", summary.FullReport().c_str(),
+         "steps_successful", summary.num_successful_steps,
+         "steps_unsuccessful", summary.num_unsuccessful_steps,
+         "steps_inner", summary.num_inner_iteration_steps,
+         "variance_ok", variance_ok);
 }
 
-template PyObject* real_ceres_forced_phot<float>(PyObject*, PyObject*, int, int, int, int);
-template PyObject* real_ceres_forced_phot<double>(PyObject*, PyObject*, int, int, int, int);
 
 
 %}
@@ -320,6 +629,52 @@ static PyObject* ceres_forced_phot(PyObject* blocks,
     Py_RETURN_NONE;
 }
 
+static PyObject* ceres_forced_phot_packed(PyObject* img,
+                                          PyObject* mod0,
+                                          PyObject* ierr,
+                                          PyObject* blockxy,
+                                          PyObject* blockstart,
+                                          PyObject* srcs,
+                                          PyObject* svals,
+                                          PyObject* np_fluxes,
+                                          int nonneg,
+                                          int verbose,
+                                          int nthreads=0) {
+    /*
+     Like ceres_forced_phot, but with the image blocks and the
+     sources-in-blocks given as packed arrays; see
+     CeresOptimizer._pack_forced_phot_blocks.
+     */
+    PyArrayObject* amod0 = NULL;
+    assert(PyArray_Check(img));
+    assert(PyArray_Check(ierr));
+    assert(PyArray_Check(blockxy));
+    assert(PyArray_Check(blockstart));
+    assert(PyArray_Check(srcs));
+    assert(PyArray_Check(svals));
+    if (mod0 != Py_None) {
+        assert(PyArray_Check(mod0));
+        amod0 = (PyArrayObject*)mod0;
+    }
+    int t = PyArray_TYPE((PyArrayObject*)img);
+    if (t == NPY_FLOAT) {
+        return real_ceres_forced_phot_packed<float>(
+            (PyArrayObject*)img, amod0, (PyArrayObject*)ierr,
+            (PyArrayObject*)blockxy, (PyArrayObject*)blockstart,
+            (PyArrayObject*)srcs, (PyArrayObject*)svals, np_fluxes,
+            NPY_FLOAT, nonneg, verbose, nthreads);
+    } else if (t == NPY_DOUBLE) {
+        return real_ceres_forced_phot_packed<double>(
+            (PyArrayObject*)img, amod0, (PyArrayObject*)ierr,
+            (PyArrayObject*)blockxy, (PyArrayObject*)blockstart,
+            (PyArrayObject*)srcs, (PyArrayObject*)svals, np_fluxes,
+            NPY_DOUBLE, nonneg, verbose, nthreads);
+    }
+    printf("Unknown PyArray type %i\n", t);
+
+    Py_RETURN_NONE;
+}
+
 
 // Generic optimization
 
@@ -398,10 +753,8 @@ static PyObject* ceres_opt(PyObject* tractor,
     int i;
     double* params;
     int nparams;
-    int get_variance;
-    int variance_ok = 0;
     DlnpCallback cb(dlnp, (print_progress!=0));
-    PyArrayObject *np_params, *np_variance=NULL;
+    PyArrayObject *np_params;
 
     assert(PyArray_Check(py_params));
     np_params = (PyArrayObject*)py_params;
@@ -414,10 +767,7 @@ static PyObject* ceres_opt(PyObject* tractor,
     nparams = (int)PyArray_SIZE(np_params);
     params = (double*)PyArray_DATA(np_params);
 
-    get_variance = (py_variance != Py_None);
-
-    //printf("ceres_opt, nims %i, nparams %i, get_variance %i\n",
-    //       nims, nparams, get_variance);
+    //printf("ceres_opt, nims %i, nparams %i\n", nims, nparams);
 
     std::vector<double*> allparams;
     // Single-param blocks
@@ -456,118 +806,10 @@ static PyObject* ceres_opt(PyObject* tractor,
         //problem.AddResidualBlock(cost, NULL, params);
     }
 
-    if (gaussian_priors != Py_None) {
-        if (!PyList_Check(gaussian_priors)) {
-            printf("Expected gaussian_priors to be a list\n");
-            return NULL;
-        }
-        size_t nterms = PyList_Size(gaussian_priors);
-        for (size_t i=0; i<nterms; i++) {
-            PyObject* tup = PyList_GetItem(gaussian_priors, i);
-            if (!PySequence_Check(tup)) {
-                printf("Expected gaussian_priors to contain iterables; element %i is not\n", (int)i);
-                return NULL;
-            }
-            if (PySequence_Size(tup) != 3) {
-                printf("Expected gaussian_priors to contain length-3 iterables; element %i is not\n", (int)i);
-                return NULL;
-            }
-            PyObject* pyi = PySequence_GetItem(tup, 0);
-            PyObject* pym = PySequence_GetItem(tup, 1);
-            PyObject* pys = PySequence_GetItem(tup, 2);
-
-            PyObject* ii = PyNumber_Int(pyi);
-            if (!ii) {
-                printf("Expected gaussian_priors element %i, index 0, to be an integer\n", (int)i);
-                return NULL;
-            }
-            int index = PyInt_AsLong(ii);
-
-            PyObject* fm = PyNumber_Float(pym);
-            PyObject* fs = PyNumber_Float(pys);
-            if (!fm) {
-                printf("Expected gaussian_priors element %i, index 1, to be a float\n", (int)i);
-                return NULL;
-            }
-            if (!fs) {
-                printf("Expected gaussian_priors element %i, index 2, to be a float\n", (int)i);
-            }
-            double mean  = PyFloat_AsDouble(fm);
-            double sigma = PyFloat_AsDouble(fs);
-
-            Py_DECREF(ii);
-            Py_DECREF(fm);
-            Py_DECREF(fs);
-            Py_DECREF(pyi);
-            Py_DECREF(pym);
-            Py_DECREF(pys);
-
-            Eigen::MatrixXd A(1,1);
-            A(0,0) = 1. / sigma;
-            Eigen::VectorXd mu(1);
-            mu[0] = mean;
-
-            //printf("Adding Gaussian prior on parameter %i (current value "
-            //"%f): mean %f, sigma %f\n", index, params[index], mean, sigma);
-            //printf("A size: %i, %i.  Mu size: %i\n", 
-            //A.rows(), A.cols(), mu.size());
-            CostFunction* prior = new ceres::NormalPrior(A, mu);
-            problem.AddResidualBlock(prior, NULL, params + index);
-        }
-    }
-
-    if (lubounds != Py_None) {
-        if (!PyList_Check(lubounds)) {
-            printf("Expected lubounds to be a list\n");
-            return NULL;
-        }
-        size_t nterms = PyList_Size(lubounds);
-        for (size_t i=0; i<nterms; i++) {
-            PyObject* tup = PyList_GetItem(lubounds, i);
-            if (!PySequence_Check(tup)) {
-                printf("Expected lubounds to contain iterables; element %i is not\n", (int)i);
-                return NULL;
-            }
-            if (PySequence_Size(tup) != 3) {
-                printf("Expected lubounds to contain length-3 iterables; element %i is not\n", (int)i);
-                return NULL;
-            }
-            // (int index, float bound, bool lower)
-            PyObject* pyi = PySequence_GetItem(tup, 0);
-            PyObject* pyb = PySequence_GetItem(tup, 1);
-            PyObject* pyl = PySequence_GetItem(tup, 2);
-
-            if (!PyInt_Check(pyi)) {
-                printf("Expected lubounds element %i, index 0, to be an integer\n", (int)i);
-                return NULL;
-            }
-            int index = PyInt_AsLong(pyi);
-            Py_DECREF(pyi);
-
-            if (!PyFloat_Check(pyb)) {
-                printf("Expected lubounds element %i, index 1, to be a float\n", (int)i);
-                return NULL;
-            }
-            double bound = PyFloat_AsDouble(pyb);
-            Py_DECREF(pyb);
-            
-            if (!PyBool_Check(pyl)) {
-                printf("Expected lubounds element %i, index 2, to be a bool\n", (int)i);
-                return NULL;
-            }
-            int islower = (pyl == Py_True);
-            Py_DECREF(pyl);
-
-            //printf("Bound on element %i, bound %g, %s bound\n",
-            //index, bound, (islower ? "lower" : "upper"));
-
-            if (islower)
-                problem.SetParameterLowerBound(params + index, 0, bound);
-            else
-                problem.SetParameterUpperBound(params + index, 0, bound);
-
-        }
-    }
+    if (add_gaussian_priors(problem, params, gaussian_priors))
+        return NULL;
+    if (add_lubounds(problem, params, lubounds))
+        return NULL;
 
     // Run the solver!
     Solver::Options options;
@@ -590,62 +832,150 @@ static PyObject* ceres_opt(PyObject* tractor,
     //printf("%s\n", summary.BriefReport().c_str());
     //printf("%s\n", summary.FullReport().c_str());
 
-    if (get_variance && (summary.termination_type == ceres::CONVERGENCE)) {
-        if (!PyArray_Check(py_variance)) {
-            printf("ceres_opt: variance must be a numpy array\n");
-            return NULL;
-        }
-        np_variance = (PyArrayObject*)py_variance;
-        if (PyArray_TYPE(np_variance) != NPY_DOUBLE) {
-            printf("ceres_opt: wrong type for variance variable\n");
-            return NULL;
-        }
-        if (PyArray_SIZE(np_variance) != PyArray_SIZE(np_params)) {
-            printf("ceres_opt: wrong size for variance variable\n");
-            return NULL;
-        }
-        double* cov_out = (double*)PyArray_DATA(np_variance);
-        for (i=0; i<nparams; i++)
-            cov_out[i] = 0.0;
+    return opt_results(problem, summary, params, nparams, py_variance);
+}
 
-        ceres::Covariance::Options options;
+static PyObject* ceres_opt_tiled(PyObject* tractor,
+                                 int nims,
+                                 PyObject* py_params,
+                                 PyObject* py_variance,
+                                 int scale_columns,
+                                 float dlnp,
+                                 int max_iterations,
+                                 PyObject* gaussian_priors,
+                                 PyObject* lubounds,
+                                 int print_progress,
+                                 PyObject* py_tiles,
+                                 PyObject* py_tilestart,
+                                 PyObject* py_tileparams,
+                                 int normal_cholesky,
+                                 int nthreads=0) {
+    /*
+     Like ceres_opt, but each image is split into pixel tiles, and
+     each tile's residual block depends only on the parameters whose
+     derivatives touch it; see CeresOptimizer._plan_opt_tiles.
+
+     tiles: (Ntiles, 5) int64: image index, x0, y0, w, h of each tile.
+     tilestart: (Ntiles+1) int64: tile i depends on parameters
+        tileparams[tilestart[i] : tilestart[i+1]] (sorted).
+     tileparams: int64 parameter indices.
+
+     The chi images and derivatives are computed once per evaluation
+     point, for all tiles, through a Ceres EvaluationCallback; the
+     tiles' residual blocks then only copy pixels, so can be evaluated
+     in parallel (nthreads).
+     */
+#ifndef TRACTOR_CERES_TILED
+    PyErr_SetString(PyExc_RuntimeError,
+                    "ceres_opt_tiled requires ceres-solver >= 1.14");
+    return NULL;
+#else
+    int i;
+    double* params;
+    int nparams;
+    DlnpCallback cb(dlnp, (print_progress!=0));
+    PyArrayObject *np_params, *np_tiles, *np_tilestart, *np_tileparams;
+    npy_int64 *tiles, *tilestart, *tileparams;
+    int Ntiles;
 
-        options.algorithm_type = ceres::DENSE_SVD;
-        options.null_space_rank = -1;
-        //options.algorithm_type = SPARSE_QR;
-        //options.algorithm_type = SPARSE_CHOLESKY;
+    if (!(PyArray_Check(py_params) &&
+          (PyArray_TYPE((PyArrayObject*)py_params) == NPY_DOUBLE))) {
+        printf("ceres_opt_tiled: wrong type for params variable\n");
+        return NULL;
+    }
+    np_params = (PyArrayObject*)py_params;
+    nparams = (int)PyArray_SIZE(np_params);
+    params = (double*)PyArray_DATA(np_params);
 
-        ceres::Covariance covariance(options);
+    np_tiles = (PyArrayObject*)py_tiles;
+    np_tilestart = (PyArrayObject*)py_tilestart;
+    np_tileparams = (PyArrayObject*)py_tileparams;
+    assert(PyArray_Check(np_tiles));
+    assert(PyArray_Check(np_tilestart));
+    assert(PyArray_Check(np_tileparams));
+    assert(PyArray_ISCARRAY(np_tiles));
+    assert(PyArray_TYPE(np_tiles) == NPY_INT64);
+    assert(PyArray_TYPE(np_tilestart) == NPY_INT64);
+    assert(PyArray_TYPE(np_tileparams) == NPY_INT64);
+    Ntiles = (int)PyArray_Size(py_tilestart) - 1;
+    assert(PyArray_Size(py_tiles) == 5 * Ntiles);
+    tiles      = (npy_int64*)PyArray_DATA(np_tiles);
+    tilestart  = (npy_int64*)PyArray_DATA(np_tilestart);
+    tileparams = (npy_int64*)PyArray_DATA(np_tileparams);
+
+    // The evaluator must outlive the Problem.
+    TractorEvaluator evaluator(tractor, nims, np_params);
+    Solver::Options options;
 
-        std::vector<std::pair<const double*, const double*> > covar_blocks;
-        for (i=0; i<nparams; i++)
-            covar_blocks.push_back(std::make_pair(params+i, params+i));
-        if (!covariance.Compute(covar_blocks, &problem)) {
-            printf("ceres_opt: failed to compute variance\n");
-            // ?
-            return NULL;
-        } else {
-            variance_ok = 1;
+#if (CERES_VERSION_MAJOR >= 2)
+    Problem::Options problem_options;
+    problem_options.evaluation_callback = &evaluator;
+    Problem problem(problem_options);
+#else
+    Problem problem;
+    options.evaluation_callback = &evaluator;
+    options.update_state_every_iteration = true;
+#endif
+
+    // Add all parameters, so that ones that touch no tile can still
+    // have priors, bounds, and variances.
+    for (i=0; i<nparams; i++)
+        problem.AddParameterBlock(params + i, 1);
+
+    for (i=0; i<Ntiles; i++) {
+        npy_int64* t = tiles + 5*i;
+        assert(t[0] >= 0);
+        assert(t[0] < nims);
+        std::vector<int> pindex;
+        std::vector<double*> tparams;
+        for (npy_int64 j=tilestart[i]; j<tilestart[i+1]; j++) {
+            assert(tileparams[j] >= 0);
+            assert(tileparams[j] < nparams);
+            pindex.push_back((int)tileparams[j]);
+            tparams.push_back(params + tileparams[j]);
         }
-        for (i=0; i<nparams; i++)
-            covariance.GetCovarianceBlock(params+i, params+i, cov_out+i);
+        if (pindex.size() == 0) {
+            // No parameter touches this tile, but its residuals still
+            // count; Ceres needs a parameter block, so attach the first
+            // (its Jacobian here is zero unless its derivative moves
+            // onto this tile).
+            pindex.push_back(0);
+            tparams.push_back(params);
+        }
+        CostFunction* cost = new ImageTileCostFunction
+            (&evaluator, (int)t[0], (int)t[1], (int)t[2], (int)t[3],
+             (int)t[4], pindex);
+        problem.AddResidualBlock(cost, NULL, tparams);
     }
 
-    const char* errstring = summary.message.c_str();
+    if (add_gaussian_priors(problem, params, gaussian_priors))
+        return NULL;
+    if (add_lubounds(problem, params, lubounds))
+        return NULL;
 
-    return Py_BuildValue
-        ("{sisssdsdsdsssssisisisi}",
-         "termination", int(summary.termination_type),
-         "error", errstring,
-         "initial_cost", summary.initial_cost,
-         "final_cost", summary.final_cost,
-         "fixed_cost", summary.fixed_cost,
-         "brief_report", summary.BriefReport().c_str(),
-         "full_report", summary.FullReport().c_str(),
-         "steps_successful", summary.num_successful_steps,
-         "steps_unsuccessful", summary.num_unsuccessful_steps,
-         "steps_inner", summary.num_inner_iteration_steps,
-         "variance_ok", variance_ok);
+    // Run the solver!
+    options.minimizer_progress_to_stdout = print_progress;
+    if (normal_cholesky)
+        options.linear_solver_type = ceres::SPARSE_NORMAL_CHOLESKY;
+    else
+        options.linear_solver_type = ceres::SPARSE_SCHUR;
+    options.jacobi_scaling = scale_columns;
+    if (nthreads) {
+        options.num_threads = nthreads;
+    }
+    if (max_iterations) {
+        options.max_num_iterations = max_iterations;
+    }
+    if (dlnp > 0) {
+        options.function_tolerance = 1e-16;
+        options.callbacks.push_back(&cb);
+    }
+
+    Solver::Summary summary;
+    Solve(options, &problem, &summary);
+
+    return opt_results(problem, summary, params, nparams, py_variance);
+#endif
 }
 
 
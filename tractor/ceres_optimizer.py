@@ -11,8 +11,8 @@ class CeresOptimizer(Optimizer):
 
     def __init__(self, BW=10, BH=10, threads=None):
         super(CeresOptimizer, self).__init__()
-        self.BW = 10
-        self.BH = 10
+        self.BW = BW
+        self.BH = BH
         self.ceresType = np.float32
         self.threads = threads
 
@@ -52,13 +52,34 @@ class CeresOptimizer(Optimizer):
 
     def optimize_loop(self, tractor, **kwargs):
         X = self._ceres_opt(tractor, **kwargs)
+        if X is not None:
+            # ceres::CONVERGENCE, or USER_SUCCESS (from the dlnp callback)
+            X.update(converged=(X['termination'] in [0, 3]))
         return X
 
     def _ceres_opt(self, tractor, variance=False, scale_columns=True,
                    numeric=False, scaled=True, numeric_stepsize=0.1,
                    dynamic_scale=True,
                    dlnp=1e-3, max_iterations=0, print_progress=True,
-                   priors=False, bounds=False, **nil):
+                   priors=False, bounds=False, tiled=False, tile_margin=0,
+                   tile_replans=5, linear_solver='sparse_schur', **nil):
+        '''
+        *tiled*: split the images into BW x BH-pixel tiles, each of
+        which depends only on the parameters whose derivatives touch
+        it (see `_plan_opt_tiles`), rather than making each image
+        depend on all parameters.  This lets Ceres exploit the
+        sparsity of the problem (with *linear_solver* =
+        'sparse_schur' or 'sparse_normal_cholesky'), and evaluate
+        the tiles with *threads*.  Not compatible with *numeric*.
+
+        The tiles' parameters are planned from the derivatives at the
+        start of the fit.  If, at the solution, a parameter's
+        derivative touches a tile that was not planned for it (eg, a
+        source has moved onto a new tile), the plan is extended and
+        the fit is continued, up to *tile_replans* times.
+        *tile_margin* grows the planned footprints, which makes this
+        less likely.
+        '''
         from tractor.ceres import ceres_opt
 
         pp = tractor.getParams()
@@ -126,11 +147,53 @@ class CeresOptimizer(Optimizer):
                           if b is not None])
             #print('lubounds:', lubounds)
 
-        R = ceres_opt(trwrapper, tractor.getNImages(), params, variance_out,
-                      (1 if scale_columns else 0),
-                      (1 if numeric else 0), numeric_stepsize,
-                      dlnp, max_iterations, gpriors, lubounds,
-                      print_progress)
+        # (includes the model and derivative callbacks)
+        prof = self._getProfiler(tractor)
+        if prof is not None:
+            t0 = prof.start()
+        if tiled:
+            from tractor.ceres import ceres_opt_tiled
+            assert(not numeric)
+            assert(linear_solver in ['sparse_schur', 'sparse_normal_cholesky'])
+            ithreads = 0
+            if self.threads is not None:
+                ithreads = int(self.threads)
+            plan = self._plan_opt_tiles(tractor, margin=tile_margin)
+            R0 = None
+            for replan in range(tile_replans + 1):
+                tiles, tilestart, tileparams = plan
+                logverb('Ceres opt: %i tiles (%ix%i), %i tile-params' %
+                        (len(tiles), self.BW, self.BH, len(tileparams)))
+                R = ceres_opt_tiled(trwrapper, tractor.getNImages(), params,
+                                    variance_out, (1 if scale_columns else 0),
+                                    dlnp, max_iterations, gpriors, lubounds,
+                                    print_progress, tiles, tilestart,
+                                    tileparams,
+                                    (1 if linear_solver ==
+                                     'sparse_normal_cholesky' else 0),
+                                    ithreads)
+                if R0 is None:
+                    R0 = R
+                if replan == tile_replans:
+                    break
+                # Re-plan at the solution; done if no derivative has
+                # moved onto a tile not planned for it.
+                trwrapper.setParams(params)
+                plan = self._plan_opt_tiles(tractor, margin=tile_margin,
+                                            prev=plan)
+                if len(plan[2]) == len(tileparams):
+                    break
+                logverb('Ceres opt: derivatives moved; re-planning tiles')
+            R['initial_cost'] = R0['initial_cost']
+            R['tile_replans'] = replan
+        else:
+            R = ceres_opt(trwrapper, tractor.getNImages(), params,
+                          variance_out, (1 if scale_columns else 0),
+                          (1 if numeric else 0), numeric_stepsize,
+                          dlnp, max_iterations, gpriors, lubounds,
+                          print_progress)
+        if prof is not None:
+            prof.stop(t0, 'solve')
         if variance:
             R['variance'] = variance_out
 
@@ -146,6 +209,96 @@ class CeresOptimizer(Optimizer):
 
         return R
 
+    def _plan_opt_tiles(self, tractor, margin=0, prev=None):
+        '''
+        Dices up the images into BW x BH-pixel tiles, for
+        `ceres_opt_tiled`, and finds the parameters whose (current)
+        derivatives touch each tile.  *margin* grows each derivative's
+        footprint by that many pixels to allow for sources moving.
+
+        Every tile containing pixels with non-zero inverse-error is
+        kept, even if no parameter touches it, so the residuals cover
+        all of the images.  Derivative pixels that later move onto
+        tiles not planned for their parameters are dropped from the
+        Jacobian; `_ceres_opt` re-plans when that happens.
+
+        *prev*: a previous plan (for the same images), whose
+        tile-parameters are added to this one's.
+
+        Returns (tiles, tilestart, tileparams):
+
+        - tiles: (Ntiles, 5) int64: image index, x0, y0, width, height.
+        - tilestart: (Ntiles + 1) int64: tile *i* depends on parameters
+          tileparams[tilestart[i] : tilestart[i+1]].
+        - tileparams: int64 parameter indices, sorted within each tile.
+        '''
+        BW, BH = self.BW, self.BH
+        nparams = tractor.numberOfParams()
+        tiles = []
+        good = []
+        keys = []
+        ntiles = 0
+        for i in range(tractor.getNImages()):
+            img = tractor.getImage(i)
+            H, W = img.shape
+            nbw = (W + BW - 1) // BW
+            nbh = (H + BH - 1) // BH
+            bx, by = np.meshgrid(np.arange(nbw) * BW, np.arange(nbh) * BH)
+            bx = bx.ravel()
+            by = by.ravel()
+            tiles.append(np.vstack((np.zeros_like(bx) + i, bx, by,
+                                    np.minimum(BW, W - bx),
+                                    np.minimum(BH, H - by))).T)
+            # Tiles with any pixels with non-zero inverse-error
+            g = np.zeros((nbh * BH, nbw * BW), bool)
+            g[:H, :W] = (img.getInvError() != 0)
+            good.append(g.reshape(nbh, BH, nbw, BW).any(axis=(1, 3)).ravel())
+            derivs = self._getOneImageDerivs(tractor, i)
+            if len(derivs):
+                ind, x0, y0 = [np.array(a, np.int64) for a in
+                               list(zip(*derivs))[:3]]
+                dh, dw = [np.array(a, np.int64) for a in
+                          zip(*[d.shape for _, _, _, d in derivs])]
+                # The range of tiles touched by each derivative
+                bx0 = np.clip((x0 - margin) // BW, 0, nbw - 1)
+                bx1 = np.clip((x0 + dw - 1 + margin) // BW, 0, nbw - 1)
+                by0 = np.clip((y0 - margin) // BH, 0, nbh - 1)
+                by1 = np.clip((y0 + dh - 1 + margin) // BH, 0, nbh - 1)
+                nbx = bx1 - bx0 + 1
+                nb = nbx * (by1 - by0 + 1)
+                nb[dw * dh == 0] = 0
+                # Expand to one entry per (derivative, tile)
+                M = np.repeat(np.arange(len(ind)), nb)
+                k = np.arange(len(M)) - np.repeat(np.cumsum(nb) - nb, nb)
+                t = (ntiles + (by0[M] + k // nbx[M]) * nbw +
+                     bx0[M] + k % nbx[M])
+                keys.append(t * nparams + ind[M])
+            ntiles += nbw * nbh
+
+        tiles = np.concatenate(tiles).astype(np.int64)
+        keep = np.flatnonzero(np.concatenate(good))
+        if len(keys):
+            keys = np.concatenate(keys)
+            # (tiles with no good pixels have only zero residuals)
+            keys = keys[np.isin(keys // nparams, keep)]
+            # to indices into the kept tiles
+            keys = np.searchsorted(keep, keys // nparams) * nparams + (
+                keys % nparams)
+        else:
+            keys = np.zeros(0, np.int64)
+        if prev is not None:
+            ptiles, pstart, pparams = prev
+            assert(np.all(ptiles == tiles[keep]))
+            pkeys = (np.repeat(np.arange(len(ptiles)), np.diff(pstart)) *
+                     nparams + pparams)
+            keys = np.append(keys, pkeys)
+        # Sort by tile and then parameter, dropping duplicates
+        keys = np.unique(keys)
+        tileparams = (keys % nparams).astype(np.int64)
+        counts = np.bincount(keys // nparams, minlength=len(keep))
+        tilestart = np.append(0, np.cumsum(counts)).astype(np.int64)
+        return tiles[keep].copy(), tilestart, tileparams
+
     # This function is called-back by _ceres_opt; it is called from
     # ceres-tractor.cc via ceres.i .
     def _getOneImageDerivs(self, tractor, imgi):
@@ -226,6 +379,143 @@ class CeresOptimizer(Optimizer):
 
         return chiderivs
 
+    def _pack_forced_phot_blocks(self, Z):
+        '''
+        Dices up the images, and the unit-flux models touching them,
+        into BW x BH-pixel blocks, for `ceres_forced_phot_packed`.
+
+        *Z*: list of (unit-flux models, image, scale, mod0, param offset)
+
+        Returns (blocks, usedParamMap), where *usedParamMap* maps from
+        tractor parameter index to Ceres parameter index, and *blocks*
+        is a tuple of packed arrays:
+
+        - img, mod0, inverr: (Nblocks, BH, BW) pixel blocks.  Blocks at
+          the right and top edges of an image are zero-padded; since
+          their padding has zero inverse-error, it does not affect the
+          fit.
+        - blockxy: (Nblocks, 2) int64: x0,y0 of each block.
+        - blockstart: (Nblocks + 1) int64: block *i* contains sources
+          blockstart[i] through blockstart[i+1]-1.
+        - srcs: (Nsources, 6) int64: Ceres parameter index, x0, y0,
+          width, height, and offset into *vals* of each source in each
+          block.
+        - vals: the unit-flux model pixels, scaled and packed.
+        '''
+        BW, BH = self.BW, self.BH
+        ctype = self.ceresType
+        usedParamMap = {}
+        imgblocks = {}
+        nblocks = 0
+        pix = []
+        blockxy = []
+        # per-model arrays, accumulated in lists
+        mparam = []
+        mx0 = []
+        my0 = []
+        mw = []
+        mh = []
+        mblock0 = []
+        mnbw = []
+        mnbh = []
+        mpatches = []
+        mscale = []
+        for zi, (umods, img, scale, mod0, paramoffset) in enumerate(Z):
+            H, W = img.shape
+            nbw = (W + BW - 1) // BW
+            nbh = (H + BH - 1) // BH
+            if img in imgblocks:
+                b0 = imgblocks[img]
+            else:
+                # Dice up the image
+                b0 = nblocks
+                imgblocks[img] = b0
+                nblocks += nbw * nbh
+                planes = []
+                for plane in [img.getImage(), mod0, img.getInvError()]:
+                    p = np.zeros((nbh * BH, nbw * BW), ctype)
+                    if plane is not None:
+                        p[:H, :W] = plane
+                    planes.append(p.reshape(nbh, BH, nbw, BW)
+                                  .transpose(0, 2, 1, 3)
+                                  .reshape(nbh * nbw, BH, BW))
+                pix.append(planes)
+                bx, by = np.meshgrid(np.arange(nbw) * BW,
+                                     np.arange(nbh) * BH)
+                blockxy.append(np.vstack((bx.ravel(), by.ravel())).T)
+
+            for modi, umod in enumerate(umods):
+                if umod is None:
+                    continue
+                umod.clipTo(W, H)
+                umod.trimToNonZero()
+                if umod.patch is None:
+                    continue
+                parami = paramoffset + modi
+                if parami in usedParamMap:
+                    ceresparam = usedParamMap[parami]
+                else:
+                    ceresparam = len(usedParamMap)
+                    usedParamMap[parami] = ceresparam
+                ph, pw = umod.shape
+                mparam.append(ceresparam)
+                mx0.append(umod.x0)
+                my0.append(umod.y0)
+                mw.append(pw)
+                mh.append(ph)
+                mblock0.append(b0)
+                mnbw.append(nbw)
+                mnbh.append(nbh)
+                mpatches.append(umod.patch.ravel())
+                mscale.append(scale)
+
+        if nblocks == 0:
+            return (np.zeros((0, BH, BW), ctype),) * 3 + (
+                np.zeros((0, 2), np.int64), np.zeros(1, np.int64),
+                np.zeros((0, 6), np.int64), np.zeros(0, ctype)), usedParamMap
+
+        img, mod0, ie = [np.concatenate(p) for p in zip(*pix)]
+        blockxy = np.concatenate(blockxy).astype(np.int64)
+
+        if len(mparam) == 0:
+            return ((img, mod0, ie, blockxy, np.zeros(nblocks + 1, np.int64),
+                     np.zeros((0, 6), np.int64), np.zeros(0, ctype)),
+                    usedParamMap)
+
+        mparam, mx0, my0, mw, mh, mblock0, mnbw, mnbh = [
+            np.array(a, np.int64) for a in
+            [mparam, mx0, my0, mw, mh, mblock0, mnbw, mnbh]]
+        # Pack (and scale) the unit-flux models
+        npix = mw * mh
+        moffset = np.cumsum(npix) - npix
+        vals = np.concatenate(mpatches) * np.repeat(mscale, npix)
+        vals = vals.astype(ctype)
+
+        # The range of blocks touched by each model
+        bx0 = np.clip(mx0 // BW, 0, mnbw - 1)
+        bx1 = np.clip((mx0 + mw - 1) // BW, 0, mnbw - 1)
+        by0 = np.clip(my0 // BH, 0, mnbh - 1)
+        by1 = np.clip((my0 + mh - 1) // BH, 0, mnbh - 1)
+        nbx = bx1 - bx0 + 1
+        nb = nbx * (by1 - by0 + 1)
+        # (models trimmed to zero size keep their Ceres parameter, but
+        # touch no blocks)
+        nb[npix == 0] = 0
+        # Expand to one entry per (model, block)
+        M = np.repeat(np.arange(len(mparam)), nb)
+        k = np.arange(len(M)) - np.repeat(np.cumsum(nb) - nb, nb)
+        bi = (mblock0[M] + (by0[M] + k // nbx[M]) * mnbw[M] +
+              bx0[M] + k % nbx[M])
+        # Sort by block, keeping model order within each block
+        I = np.argsort(bi, kind='mergesort')
+        bi = bi[I]
+        M = M[I]
+        srcs = np.vstack((mparam[M], mx0[M], my0[M], mw[M], mh[M],
+                          moffset[M])).T.copy()
+        blockstart = np.searchsorted(bi, np.arange(nblocks + 1)
+                                     ).astype(np.int64)
+        return (img, mod0, ie, blockxy, blockstart, srcs, vals), usedParamMap
+
     def _ceres_forced_photom(self, tractor, result, umodels,
                              imlist, mods0, scales,
                              skyderivs, minFlux,
@@ -240,13 +530,9 @@ class CeresOptimizer(Optimizer):
         negfluxval: when 'nonneg' is set, the flux value to give sources that went
         negative in an unconstrained fit.
         '''
-        from tractor.ceres import ceres_forced_phot
+        from tractor.ceres import ceres_forced_phot_packed
 
         t0 = Time()
-        blocks = []
-        blockstart = {}
-        usedParamMap = {}
-        nextparam = 0
         # umodels[ imagei, srci ] = Patch
         Nsky = 0
         Z = []
@@ -268,68 +554,8 @@ class CeresOptimizer(Optimizer):
 
         sky = (skyderivs is not None)
 
-        for zi, (umods, img, scale, mod0, paramoffset) in enumerate(Z):
-            H, W = img.shape
-            if img in blockstart:
-                (b0, nbw, nbh) = blockstart[img]
-            else:
-                # Dice up the image
-                nbw = int(np.ceil(W / float(self.BW)))
-                nbh = int(np.ceil(H / float(self.BH)))
-                b0 = len(blocks)
-                blockstart[img] = (b0, nbw, nbh)
-                for iy in range(nbh):
-                    for ix in range(nbw):
-                        x0 = ix * self.BW
-                        y0 = iy * self.BH
-                        slc = (slice(y0, min(y0 + self.BH, H)),
-                               slice(x0, min(x0 + self.BW, W)))
-                        data = (x0, y0,
-                                img.getImage()[slc].astype(self.ceresType),
-                                mod0[slc].astype(self.ceresType),
-                                img.getInvError()[slc].astype(self.ceresType))
-                        blocks.append((data, []))
-
-            for modi, umod in enumerate(umods):
-                if umod is None:
-                    continue
-                # DEBUG
-                if len(umod.shape) != 2:
-                    print('zi', zi)
-                    print('modi', modi)
-                    print('umod', umod)
-                umod.clipTo(W, H)
-                umod.trimToNonZero()
-                if umod.patch is None:
-                    continue
-                # Dice up the model
-                ph, pw = umod.shape
-                bx0 = np.clip(int(np.floor(umod.x0 / float(self.BW))),
-                              0, nbw - 1)
-                bx1 = np.clip(int(np.ceil((umod.x0 + pw) / float(self.BW))),
-                              0, nbw - 1)
-                by0 = np.clip(int(np.floor(umod.y0 / float(self.BH))),
-                              0, nbh - 1)
-                by1 = np.clip(int(np.ceil((umod.y0 + ph) / float(self.BH))),
-                              0, nbh - 1)
-
-                parami = paramoffset + modi
-                if parami in usedParamMap:
-                    ceresparam = usedParamMap[parami]
-                else:
-                    usedParamMap[parami] = nextparam
-                    ceresparam = nextparam
-                    nextparam += 1
-
-                cmod = (umod.patch * scale).astype(self.ceresType)
-                for by in range(by0, by1 + 1):
-                    for bx in range(bx0, bx1 + 1):
-                        bi = by * nbw + bx
-                        # if type(umod.x0) != int or type(umod.y0) != int:
-                        #    print('umod:', umod.x0, umod.y0, type(umod.x0), type(umod.y0))
-                        #    print('umod:', umod)
-                        dd = (ceresparam, int(umod.x0), int(umod.y0), cmod)
-                        blocks[b0 + bi][1].append(dd)
+        blocks, usedParamMap = self._pack_forced_phot_blocks(Z)
+        nblocks = len(blocks[0])
         logverb('forced phot: dicing up', Time() - t0)
 
         if wantims0:
@@ -342,9 +568,9 @@ class CeresOptimizer(Optimizer):
         t0 = Time()
         fluxes = np.zeros(len(usedParamMap))
         logverb('Ceres forced phot:')
-        logverb(len(blocks), ('image blocks (%ix%i), %i params' %
-                              (self.BW, self.BH, len(fluxes))))
-        if len(blocks) == 0 or len(fluxes) == 0:
+        logverb(nblocks, ('image blocks (%ix%i), %i params' %
+                          (self.BW, self.BH, len(fluxes))))
+        if nblocks == 0 or len(fluxes) == 0:
             logverb('Nothing to do!')
             return
         # init fluxes passed to ceres
@@ -361,14 +587,16 @@ class CeresOptimizer(Optimizer):
 
         if nonneg:
             # Initial run with nonneg=False, to get in the ballpark
-            x = ceres_forced_phot(blocks, fluxes, 0, iverbose, ithreads)
+            x = ceres_forced_phot_packed(*(blocks + (fluxes, 0, iverbose,
+                                                     ithreads)))
             assert(x == 0)
             logverb('forced phot: ceres initial run', Time() - t0)
             t0 = Time()
             if negfluxval is not None:
                 fluxes = np.maximum(fluxes, negfluxval)
 
-        x = ceres_forced_phot(blocks, fluxes, nonneg, iverbose, ithreads)
+        x = ceres_forced_phot_packed(*(blocks + (fluxes, nonneg, iverbose,
+                                                 ithreads)))
         #print('Ceres forced phot:', x)
         logverb('forced phot: ceres', Time() - t0)
 
@@ -0,0 +1,168 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`checkpoint.py`
+===============
+
+A directory-based checkpoint format for whole Tractor objects.
+
+Pickling a Tractor copies all the image pixels into the pickle
+stream, and unpickling copies them all back out again.  A checkpoint
+instead writes each image pixel plane (*data* and *inverr*) as a
+separate ``.npy`` file, and pickles only the remaining "skeleton" of
+the Tractor (catalog, calibration objects, model masks, optimizer
+settings), with references to the pixel planes.  On reading, the pixel
+planes are memory-mapped, so re-loading a Tractor costs about the same
+as unpickling the catalog.
+
+A checkpoint directory contains:
+
+  * ``tractor.pickle``: the Tractor, with pixel planes replaced by references
+  * ``image<i>-<plane>.npy``: the pixel planes
+  * ``manifest.json``: a human-readable summary: format version, image
+    names and shapes, source classes and parameter values, and the
+    names and values of the thawed parameters.
+
+Usage::
+
+    write_checkpoint(tractor, 'stage1')
+    tractor = read_checkpoint('stage1')
+'''
+from __future__ import print_function
+import os
+import json
+import pickle
+
+import numpy as np
+
+from tractor.utils import getClassName
+
+CHECKPOINT_VERSION = 1
+
+# Image attributes that hold pixel planes.
+image_planes = ['data', 'inverr']
+
+pickle_filename = 'tractor.pickle'
+manifest_filename = 'manifest.json'
+
+
+class _CheckpointPickler(pickle.Pickler):
+    '''
+    A Pickler that writes references (rather than contents) for the
+    pixel-plane arrays given in *planes*, a dict from id(array) to
+    filename.
+    '''
+    def __init__(self, f, planes, **kwargs):
+        pickle.Pickler.__init__(self, f, **kwargs)
+        self.planes = planes
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray):
+            return self.planes.get(id(obj), None)
+        return None
+
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, f, dirname, mmap_mode, **kwargs):
+        pickle.Unpickler.__init__(self, f, **kwargs)
+        self.dirname = dirname
+        self.mmap_mode = mmap_mode
+        self.loaded = {}
+
+    def persistent_load(self, pid):
+        arr = self.loaded.get(pid, None)
+        if arr is None:
+            arr = np.load(os.path.join(self.dirname, pid),
+                          mmap_mode=self.mmap_mode)
+            self.loaded[pid] = arr
+        return arr
+
+
+def write_checkpoint(tractor, dirname):
+    '''
+    Writes the given *tractor* to checkpoint directory *dirname*
+    (which will be created if necessary).  Any existing checkpoint
+    files in that directory are overwritten.
+
+    Image pixel planes that are shared between images (eg, the same
+    *inverr* array) are written once.
+    '''
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    planes = {}
+    imageinfo = []
+    for i, img in enumerate(tractor.getImages()):
+        files = {}
+        for plane in image_planes:
+            arr = img.__dict__.get(plane, None)
+            if not isinstance(arr, np.ndarray):
+                continue
+            fn = planes.get(id(arr), None)
+            if fn is None:
+                fn = 'image%i-%s.npy' % (i, plane)
+                # np.memmap objects are written as plain arrays.
+                np.save(os.path.join(dirname, fn), np.asarray(arr))
+                planes[id(arr)] = fn
+            files[plane] = fn
+        imageinfo.append(dict(name=(None if img.name is None
+                                    else str(img.name)),
+                              cls=getClassName(img),
+                              shape=list(img.shape),
+                              planes=files))
+
+    fn = os.path.join(dirname, pickle_filename)
+    with open(fn, 'wb') as f:
+        _CheckpointPickler(f, planes,
+                           protocol=pickle.HIGHEST_PROTOCOL).dump(tractor)
+
+    sources = [dict(cls=getClassName(src),
+                    params=[float(p) for p in src.getAllParams()])
+               for src in tractor.getCatalog()]
+    manifest = dict(version=CHECKPOINT_VERSION,
+                    cls=getClassName(tractor),
+                    images=imageinfo,
+                    sources=sources,
+                    modelmasks=(tractor.modelMasks is not None),
+                    optimizer=getClassName(tractor.optimizer),
+                    thawed=dict(names=tractor.getParamNames(),
+                                values=[float(p) for p in
+                                        tractor.getParams()]))
+    fn = os.path.join(dirname, manifest_filename)
+    with open(fn, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_checkpoint(dirname, mmap_mode='c'):
+    '''
+    Reads a Tractor from the checkpoint directory *dirname*, written
+    by `write_checkpoint`.
+
+    *mmap_mode*: passed to `numpy.load` for the pixel planes.  The
+    default, 'c' (copy-on-write), memory-maps the planes without
+    copying them, while still allowing in-memory modification.  Use
+    'r' for strictly read-only planes, or None to read the planes into
+    memory.
+    '''
+    fn = os.path.join(dirname, manifest_filename)
+    with open(fn) as f:
+        manifest = json.load(f)
+    ver = manifest.get('version', None)
+    if ver != CHECKPOINT_VERSION:
+        raise ValueError('Checkpoint %s: unknown version %s' % (dirname, ver))
+
+    fn = os.path.join(dirname, pickle_filename)
+    with open(fn, 'rb') as f:
+        tractor = _CheckpointUnpickler(f, dirname, mmap_mode).load()
+    return tractor
+
+
+def read_checkpoint_manifest(dirname):
+    '''
+    Returns the manifest (a dict) of the checkpoint in *dirname*,
+    without reading the Tractor itself.
+    '''
+    fn = os.path.join(dirname, manifest_filename)
+    with open(fn) as f:
+        return json.load(f)
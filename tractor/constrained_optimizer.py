@@ -20,6 +20,7 @@ class ConstrainedOptimizer(LsqrOptimizer):
         R = {}
         self.hit_limit = False
         self.last_step_hit_limit = False
+        converged = False
         for step in range(steps):
             #print('Optimize_loop: step', step)
             self.stepLimited = False
@@ -30,10 +31,12 @@ class ConstrainedOptimizer(LsqrOptimizer):
             #    print(s)
 
             if not self.stepLimited and dlnp <= dchisq:
+                converged = True
                 break
             if self.stepLimited and dlnp <= dchisq_limited:
+                converged = True
                 break
-        R.update(steps=step)
+        R.update(steps=step, converged=converged)
         R.update(hit_limit=self.last_step_hit_limit,
                  ever_hit_limit=self.hit_limit)
         return R
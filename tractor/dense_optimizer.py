@@ -10,28 +10,133 @@ from numpy.linalg import lstsq
 # import pylab as plt
         
 class ConstrainedDenseOptimizer(ConstrainedOptimizer):
+    '''
+    A `ConstrainedOptimizer` that builds the matrix of derivatives as a
+    dense array and solves it directly, rather than with sparse LSQR.
+    For small blobs, where most of the matrix elements are non-zero,
+    this is much faster.
 
-    # TODO: implement:
-    #   _optimized_forcedphot_core
+    When the matrix would be mostly empty (fewer than *min_fill* of its
+    elements non-zero), or would have more than *max_elements*
+    elements, the update is computed by LSQR instead.
+
+    With *variance=True*, the variances returned are, as for
+    `LsqrOptimizer`, the conditional variances 1/|column|^2 (each
+    parameter's variance with the others held fixed).  With
+    *marginal_variance*, they are instead the diagonal of
+    (A^T A)^-1, which accounts for correlations between parameters (eg,
+    the fluxes of overlapping sources); this is returned whether or not
+    the update falls back to LSQR.
+    '''
+
+    def __init__(self, min_fill=0.1, max_elements=2e7,
+                 marginal_variance=False, **kwargs):
+        super(ConstrainedDenseOptimizer, self).__init__(**kwargs)
+        self.min_fill = min_fill
+        self.max_elements = max_elements
+        self.marginal_variance = marginal_variance
+
+    def _optimize_forcedphot_core(
+            self, tractor,
+            result, umodels, imlist, mod0, scales, skyderivs, minFlux,
+            nonneg=None, wantims0=None, wantims1=None,
+            negfluxval=None, rois=None, priors=None, sky=None,
+            justims0=None, subimgs=None, damp=None, alphas=None,
+            Nsky=None, mindlnp=None, shared_params=None):
+        # The model is linear in the fluxes (and sky levels), so one
+        # solve of the normal equations finds them all; we only fall
+        # back to LsqrOptimizer's damped line search if that solution
+        # has fluxes below *minFlux*.
+        if len(umodels) == 0:
+            return
+        Nsourceparams = len(umodels[0])
+        imgs = tractor.images
+
+        derivs = [[] for i in range(Nsourceparams)]
+        for tim, umods, scale in zip(imlist, umodels, scales):
+            for um, dd in zip(umods, derivs):
+                if um is None:
+                    continue
+                dd.append((um * scale, tim))
+        if sky:
+            # Sky derivatives are part of the image derivatives, so go
+            # first in the derivative list.
+            derivs = skyderivs + derivs
+        assert(len(derivs) == tractor.numberOfParams())
+
+        p0 = tractor.getParams()
+        if sky:
+            p0sky = p0[:Nsky]
+            p0 = p0[Nsky:]
+        else:
+            p0sky = None
+        lnp0, chis0, ims0 = self._lnp_for_update(
+            tractor, mod0, imgs, umodels, None, None, p0, rois, scales,
+            None, None, priors, sky, minFlux)
+        assert(np.isfinite(lnp0))
+        result.ims0 = ims0
+        result.ims1 = None
+        if justims0:
+            result.lnp0 = lnp0
+            result.chis0 = chis0
+            return
+
+        # (as in LsqrOptimizer: getUpdateDirection matches chiImages
+        # to tractor.images)
+        if rois is not None:
+            realims = tractor.images
+            tractor.images = subimgs
+        X = self.getUpdateDirection(tractor, derivs, damp=damp,
+                                    priors=priors, scale_columns=False,
+                                    chiImages=chis0,
+                                    shared_params=shared_params,
+                                    cholesky=True)
+        if rois is not None:
+            tractor.images = realims
+        if X is None or len(X) == 0:
+            print('Error getting update direction')
+            return
+        if sky:
+            Xsky = X[:Nsky]
+            X = X[Nsky:]
+        else:
+            Xsky = None
+
+        if minFlux is not None and not np.all((p0 + X) >= minFlux):
+            logverb('Forced phot: some fluxes below minFlux; line search')
+            self._lsqr_forced_photom(
+                tractor, result, derivs, mod0, imgs, umodels,
+                rois, scales, priors, sky, minFlux, justims0, subimgs,
+                damp, alphas, Nsky, mindlnp, shared_params)
+            return
+
+        lnp, chis, ims = self._lnp_for_update(
+            tractor, mod0, imgs, umodels, X, 1., p0, rois, scales,
+            p0sky, Xsky, priors, sky, minFlux)
+        logverb('Forced phot: dlnp', lnp - lnp0)
+        if np.isfinite(lnp) and lnp > lnp0:
+            tractor.catalog.setParams(p0 + X)
+            result.ims1 = ims
+        elif sky:
+            # Revert -- _lnp_for_update sets the sky parameters
+            tractor.images.setParams(p0sky)
 
     def getUpdateDirection(self, tractor, allderivs, damp=0., priors=True,
                            scale_columns=True, scales_only=False,
                            chiImages=None, variance=False,
                            shared_params=True,
-                           get_A_matrix=False):
-
-        if shared_params or scales_only or damp>0 or variance:
-            raise RuntimeError('Not implemented')
-        # I don't want to deal with this right now!
-        assert(shared_params == False)
-        assert(scales_only == False)
-        assert(damp == 0.)
-        assert(variance == False)
+                           get_A_matrix=False, cholesky=False):
 
         # Returns: numpy array containing update direction.
         # If *variance* is True, return    (update,variance)
-        # If *get_A_matrix* is True, returns the sparse matrix of derivatives.
+        #   where "variance" is 1/|column|^2 over the pixels (as in
+        #   LsqrOptimizer), or, if self.marginal_variance, the diagonal
+        #   of the covariance matrix (A^T A)^-1, from the same SVD that
+        #   gives the update.
+        # If *get_A_matrix* is True, returns the dense matrix of derivatives.
         # If *scale_only* is True, return column scalings
+        # If *cholesky* is True, solve the normal equations A^T A x = A^T b
+        #   with a Cholesky factorization rather than by SVD.
         # In cases of an empty matrix, returns the list []
         #
         # allderivs: [
@@ -62,11 +167,18 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
         #print('Getting update direction:')
         #tractor.printThawedParams()
         
-        # Keep track of row offsets for each image.
+        # Keep track of row offsets for each image, and count the
+        # (non-zero) matrix elements.
         imgoffs = {}
         Npixels = 0
+        Nfilled = 0
         for param in allderivs:
             for deriv, img in param:
+                if deriv.patch is not None:
+                    H,W = img.shape
+                    h,w = deriv.shape
+                    Nfilled += (max(0, min(W, deriv.x0 + w) - max(0, deriv.x0)) *
+                                max(0, min(H, deriv.y0 + h) - max(0, deriv.y0)))
                 if img in imgoffs:
                     continue
                 npix = img.numberOfPixels()
@@ -74,6 +186,40 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
                 Npixels += npix
         Ncols = len(allderivs)
 
+        fill = Nfilled / float(max(1, Npixels * Ncols))
+        if fill < self.min_fill or Npixels * Ncols > self.max_elements:
+            logverb('Dense optimizer: %i x %i matrix, fill fraction %.3g: '
+                    'using LSQR' % (Npixels, Ncols, fill))
+            R = super(ConstrainedDenseOptimizer, self).getUpdateDirection(
+                tractor, allderivs, damp=damp, priors=priors,
+                scale_columns=scale_columns, scales_only=scales_only,
+                chiImages=chiImages, variance=variance,
+                shared_params=shared_params, get_A_matrix=get_A_matrix)
+            if (variance and self.marginal_variance and R is not None and
+                    len(R) and not (scales_only or get_A_matrix)):
+                X, var = R
+                var = self._sparse_marginal_variance(
+                    tractor, allderivs, damp, priors, scale_columns,
+                    shared_params)
+                R = (X, var)
+            return R
+
+        prof = self._getProfiler(tractor)
+        if prof is not None:
+            t0 = prof.start()
+
+        # Shared parameters (eg, the same brightness in several sources)
+        # share a column of the matrix.
+        if shared_params:
+            p0 = tractor.getParams()
+            tractor.setParams(np.arange(len(p0)))
+            p1 = tractor.getParams()
+            tractor.setParams(p0)
+            U, paramindexmap = np.unique(p1, return_inverse=True)
+            Ncols = len(U)
+        else:
+            paramindexmap = np.arange(Ncols)
+
         Npriors = 0
         if priors:
             ''' getLogPriorDerivatives()
@@ -111,16 +257,20 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
                 Npriors = max(Npriors, max([1+max(r) for r in rA]))
 
         Nrows = Npixels + Npriors
-        if Nrows == 0:
+        if Nrows == 0 or Ncols == 0:
             return []
+        # Damping: minimize |A x - b|^2 + damp^2 |x|^2, as LSQR does,
+        # by appending damp * I to A.
+        Ndamp = 0
+        if damp > 0 and not scales_only:
+            Ndamp = Ncols
         #print('Allocating', Nrows, 'x', Ncols, 'matrix for update direction')
-        A = np.zeros((Nrows, Ncols), np.float32)
+        A = np.zeros((Nrows + Ndamp, Ncols), np.float32)
         # 'B' holds the chi values
-        B = np.zeros(Nrows, np.float32)
+        B = np.zeros(Nrows + Ndamp, np.float32)
 
-        colscales2 = np.ones(Ncols)
         for col,param in enumerate(allderivs):
-            scale2 = 0.
+            col = paramindexmap[col]
             for (deriv, img) in param:
                 if deriv.patch is None:
                     continue
@@ -140,35 +290,40 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
                 assert(np.all(np.isfinite(dimg)))
                 #print('Derivative', col, 'in image', img, 'gave non-finite value!')
                 #tractor.printThawedParams()
-                if scale_columns:
-                    # accumulate L2 norm
-                    scale2 += np.dot(dimg, dimg)
-
-                A[rows, col] = dimg
+                A[rows, col] += dimg
                 del dimg
-            if scale_columns:
-                colscales2[col] = scale2
 
-        #print('Colscales:', colscales)
+        if variance and not self.marginal_variance:
+            # 1/|column|^2 over the pixels (as LsqrOptimizer)
+            colsq = np.einsum('ij,ij->j', A[:Npixels], A[:Npixels],
+                              dtype=np.float64)
+            condvar = np.empty(Ncols)
+            condvar[colsq == 0] = np.inf
+            condvar[colsq > 0] = 1. / colsq[colsq > 0]
+
         if Npriors > 0:
             rA, cA, vA, pb, mub = priorVals
             #print('Priors: pb', pb, 'mub', mub)
             for ri,ci,vi,bi in zip(rA, cA, vA, pb):
-                if scale_columns:
-                    colscales2[col] += np.dot(vi, vi)
+                ci = paramindexmap[ci]
                 for rij,vij,bij in zip(ri, vi, bi):
-                    A[Npixels + rij, ci] = vij
+                    A[Npixels + rij, ci] += vij
                     B[Npixels + rij] += bij
             del priorVals, rA, cA, vA, pb, mub
 
+        # L2 norms of the columns, including the priors
+        colscales = np.sqrt(np.einsum('ij,ij->j', A, A, dtype=np.float64))
+        if scales_only:
+            return colscales[paramindexmap]
+        # Set to safe value...
+        colscales[colscales == 0] = 1.
         if scale_columns:
-            for col,scale2 in enumerate(colscales2):
-                if scale2 > 0:
-                    A[:,col] /= np.sqrt(scale2)
-                else:
-                    # Set to safe value...
-                    colscales2[col] = 1.
-            colscales = np.sqrt(colscales2)
+            A /= colscales.astype(np.float32)
+        if Ndamp:
+            A[Nrows + np.arange(Ncols), np.arange(Ncols)] = damp
+
+        if get_A_matrix:
+            return A
 
         chimap = {}
         if chiImages is not None:
@@ -184,8 +339,36 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
             B[row0: row0 + npix] = chi
             del chi
 
-        # X, resids, rank, singular_vals
-        X,_,_,_ = lstsq(A, B, rcond=None)
+        if prof is not None:
+            prof.stop(t0, 'matrix')
+            t0 = prof.start()
+
+        var = None
+        if variance and self.marginal_variance:
+            # The update and its variances from one SVD of A
+            U,S,Vt = np.linalg.svd(A, full_matrices=False)
+            Sinv = np.zeros(len(S))
+            I = (S > S.max() * max(A.shape) * np.finfo(A.dtype).eps)
+            Sinv[I] = 1. / S[I]
+            X = np.dot(Vt.T, Sinv * np.dot(U.T, B))
+            # diagonal of (A^T A)^-1 = V S^-2 V^T
+            var = np.sum((Vt.T * Sinv)**2, axis=1)
+            del U, Vt
+        elif cholesky:
+            from scipy.linalg import cho_factor, cho_solve
+            A64 = A.astype(np.float64)
+            try:
+                X = cho_solve(cho_factor(np.dot(A64.T, A64)), np.dot(A64.T, B))
+            except np.linalg.LinAlgError:
+                # singular (eg, a parameter with zero derivatives)
+                X,_,_,_ = lstsq(A, B, rcond=None)
+            del A64
+        else:
+            # X, resids, rank, singular_vals
+            X,_,_,_ = lstsq(A, B, rcond=None)
+
+        if prof is not None:
+            prof.stop(t0, 'solve')
 
         if False:
             Aold = super(ConstrainedDenseOptimizer, self).getUpdateDirection(
@@ -237,6 +420,11 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
 
         if scale_columns:
             X /= colscales
+            if var is not None:
+                var /= colscales**2
+        if variance and not self.marginal_variance:
+            var = condvar
+        X = X[paramindexmap]
 
         if False:
             print('Returning:  ', X)
@@ -250,6 +438,38 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
         if not np.all(np.isfinite(X)):
             return None
 
+        if variance:
+            return X, var[paramindexmap]
         return X
 
+    def _sparse_marginal_variance(self, tractor, allderivs, damp, priors,
+                                  scale_columns, shared_params):
+        '''
+        Returns the diagonal of (A^T A)^-1 for the (sparse, LSQR) matrix
+        A of derivatives, for *marginal_variance* when
+        `getUpdateDirection` falls back to LSQR.  The normal matrix is
+        only (parameters x parameters), so is computed densely.
+        '''
+        A = super(ConstrainedDenseOptimizer, self).getUpdateDirection(
+            tractor, allderivs, damp=damp, priors=priors,
+            scale_columns=False, shared_params=shared_params,
+            get_A_matrix=True)
+        ATA = (A.T.dot(A)).toarray().astype(np.float64)
+        if damp > 0:
+            # The damping applies to the scaled columns
+            d = np.ones(len(ATA))
+            if scale_columns:
+                d = np.diag(ATA).copy()
+                d[d == 0] = 1.
+            ATA[np.diag_indices_from(ATA)] += damp**2 * d
+        var = np.diag(np.linalg.pinv(ATA))
+        if shared_params:
+            p0 = tractor.getParams()
+            tractor.setParams(np.arange(len(p0)))
+            p1 = tractor.getParams()
+            tractor.setParams(p0)
+            U, paramindexmap = np.unique(p1, return_inverse=True)
+            var = var[paramindexmap]
+        return var
+
 
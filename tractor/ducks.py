@@ -376,6 +376,24 @@ class WCS(ImageCalibration, Params):
         '''
         return None
 
+    def positionsToPixels(self, ra, dec):
+        '''
+        Vectorized version of `positionToPixel` for RA,Dec positions:
+        converts numpy arrays *ra*, *dec* (in degrees) into arrays
+        ``x, y`` of pixel coordinates.
+
+        This default implementation calls `positionToPixel` once per
+        position; WCS classes that can project whole arrays at once
+        should override it.
+        '''
+        import numpy as np
+        from tractor.wcs import RaDecPos
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        xy = np.array([self.positionToPixel(RaDecPos(r, d))
+                       for r, d in zip(ra, dec)], float).reshape((-1, 2))
+        return xy[:, 0], xy[:, 1]
+
     def cdAtPixel(self, x, y):
         '''
         Returns a local affine relationship between `Position` and
@@ -406,6 +424,17 @@ class WCS(ImageCalibration, Params):
         cdi = np.linalg.inv(cd)
         return cdi
 
+    def cdInverseAtPixels(self, x, y):
+        '''
+        Vectorized version of `cdInverseAtPixel`: returns a numpy array
+        of shape (N,2,2) for the N pixel positions in arrays *x*, *y*.
+        '''
+        import numpy as np
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        return np.array([self.cdInverseAtPixel(xi, yi)
+                         for xi, yi in zip(x, y)], float).reshape((-1, 2, 2))
+
     def cdInverseAtPosition(self, pos, src=None):
         px, py = self.positionToPixel(pos, src=src)
         return self.cdInverseAtPixel(px, py)
@@ -7,6 +7,10 @@
 #include <numpy/arrayobject.h>
 #include <math.h>
 #include <assert.h>
+#include <sys/param.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
     %}
 
 %init %{
@@ -244,99 +248,36 @@ static int em_fit_1d_samples(PyObject* np_x,
 
 
 
-// _reg: Inverse-Wishart prior on variance (with hard-coded
-// variance prior I), with strength alpha.
-static int em_fit_2d_reg(PyObject* po_img, int x0, int y0,
-                         PyObject* po_amp,
-                         PyObject* po_mean,
-                         PyObject* po_var,
-                         double alpha,
-                         int steps) {
-    npy_intp i, N, K, k;
+// The EM loop of em_fit_2d_reg, on plain C arrays.
+// img: NY x NX; amp: K; mean: K x 2; var: K x 2 x 2 (updated in place).
+// If tol > 0, stops early once no parameter changes by more than tol
+// in a step.
+static int em_fit_2d_reg_core(const double* img, int NX, int NY,
+                              int x0, int y0, int K,
+                              double* amp, double* mean, double* var,
+                              double alpha, int steps, double tol) {
+    npy_intp i, N, k;
     npy_intp ix, iy;
-    npy_intp NX, NY;
     const npy_intp D = 2;
     double* Z = NULL;
     double* scale = NULL, *ivar = NULL;
+    double* prev = NULL;
     int step;
     double tpd;
     int result;
 
-    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
-    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
-    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
-
-    PyArrayObject *np_img, *np_amp, *np_mean, *np_var;
-
-    double* amp;
-    double* mean;
-    double* var;
-    double* img;
-
-    tpd = pow(2.*M_PI, D);
-
-    Py_INCREF(dtype);
-    np_img = (PyArrayObject*)PyArray_FromAny(po_img, dtype, 2, 2, req, NULL);
-    if (!np_img) {
-        ERR("img wasn't the type expected");
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_amp = (PyArrayObject*)PyArray_FromAny(po_amp, dtype, 1, 1, reqout, NULL);
-    if (!np_amp) {
-        ERR("amp wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_mean = (PyArrayObject*)PyArray_FromAny(po_mean, dtype, 2, 2, reqout, NULL);
-    if (!np_mean) {
-        ERR("mean wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(np_amp);
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_var = (PyArrayObject*)PyArray_FromAny(po_var, dtype, 3, 3, reqout, NULL);
-    if (!np_var) {
-        ERR("var wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(np_amp);
-        Py_DECREF(np_mean);
-        Py_DECREF(dtype);
-        return -1;
-    }
-
-    K = PyArray_DIM(np_amp, 0);
-    // printf("K=%i\n", K);
-    if ((PyArray_DIM(np_mean, 0) != K) ||
-        (PyArray_DIM(np_mean, 1) != D)) {
-        ERR("np_mean must be K x D");
-        return -1;
-    }
-    if ((PyArray_DIM(np_var, 0) != K) ||
-        (PyArray_DIM(np_var, 1) != D) ||
-        (PyArray_DIM(np_var, 2) != D)) {
-        ERR("np_var must be K x D x D");
-        return -1;
-    }
-    NY = PyArray_DIM(np_img, 0);
-    NX = PyArray_DIM(np_img, 1);
-
-    amp  = PyArray_DATA(np_amp);
-    mean = PyArray_DATA(np_mean);
-    var  = PyArray_DATA(np_var);
-    img  = PyArray_DATA(np_img);
-
     N = NX*NY;
+    tpd = pow(2.*M_PI, D);
     Z = malloc(K * N * sizeof(double));
     assert(Z);
     scale = malloc(K * sizeof(double));
     ivar = malloc(K * D * D * sizeof(double));
     assert(scale && ivar);
+    if (tol > 0) {
+        // previous amp, mean, var
+        prev = malloc(K * (1 + D + D*D) * sizeof(double));
+        assert(prev);
+    }
 
     // printf("NX=%i, NY=%i; N=%i\n", NX, NY, N);
 
@@ -345,6 +286,12 @@ static int em_fit_2d_reg(PyObject* po_img, int x0, int y0,
         double wsum[K];
         double qsum = 0.0;
 
+        if (prev) {
+            memcpy(prev,             amp,  K       * sizeof(double));
+            memcpy(prev + K,         mean, K*D     * sizeof(double));
+            memcpy(prev + K*(1 + D), var,  K*D*D   * sizeof(double));
+        }
+
         /*              {
          int d;
          printf("step=%i: ", step);
@@ -488,13 +435,111 @@ static int em_fit_2d_reg(PyObject* po_img, int x0, int y0,
         // printf("M amp...\n");
         for (k=0; k<K; k++)
             amp[k] = wsum[k];
+
+        if (prev) {
+            double dmax = 0.0;
+            for (k=0; k<K; k++)
+                dmax = MAX(dmax, fabs(amp[k] - prev[k]));
+            for (k=0; k<K*D; k++)
+                dmax = MAX(dmax, fabs(mean[k] - prev[K + k]));
+            for (k=0; k<K*D*D; k++)
+                dmax = MAX(dmax, fabs(var[k] - prev[K*(1 + D) + k]));
+            if (dmax < tol)
+                break;
+        }
     }
     result = 0;
-        
+
  cleanup:
     free(Z);
     free(scale);
     free(ivar);
+    free(prev);
+    return result;
+}
+
+// _reg: Inverse-Wishart prior on variance (with hard-coded
+// variance prior I), with strength alpha.
+static int em_fit_2d_reg(PyObject* po_img, int x0, int y0,
+                         PyObject* po_amp,
+                         PyObject* po_mean,
+                         PyObject* po_var,
+                         double alpha,
+                         int steps) {
+    npy_intp K;
+    npy_intp NX, NY;
+    const npy_intp D = 2;
+    int result;
+
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+
+    PyArrayObject *np_img, *np_amp, *np_mean, *np_var;
+
+    double* amp;
+    double* mean;
+    double* var;
+    double* img;
+
+    Py_INCREF(dtype);
+    np_img = (PyArrayObject*)PyArray_FromAny(po_img, dtype, 2, 2, req, NULL);
+    if (!np_img) {
+        ERR("img wasn't the type expected");
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_amp = (PyArrayObject*)PyArray_FromAny(po_amp, dtype, 1, 1, reqout, NULL);
+    if (!np_amp) {
+        ERR("amp wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_mean = (PyArrayObject*)PyArray_FromAny(po_mean, dtype, 2, 2, reqout, NULL);
+    if (!np_mean) {
+        ERR("mean wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(np_amp);
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_var = (PyArrayObject*)PyArray_FromAny(po_var, dtype, 3, 3, reqout, NULL);
+    if (!np_var) {
+        ERR("var wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(np_amp);
+        Py_DECREF(np_mean);
+        Py_DECREF(dtype);
+        return -1;
+    }
+
+    K = PyArray_DIM(np_amp, 0);
+    // printf("K=%i\n", K);
+    if ((PyArray_DIM(np_mean, 0) != K) ||
+        (PyArray_DIM(np_mean, 1) != D)) {
+        ERR("np_mean must be K x D");
+        return -1;
+    }
+    if ((PyArray_DIM(np_var, 0) != K) ||
+        (PyArray_DIM(np_var, 1) != D) ||
+        (PyArray_DIM(np_var, 2) != D)) {
+        ERR("np_var must be K x D x D");
+        return -1;
+    }
+    NY = PyArray_DIM(np_img, 0);
+    NX = PyArray_DIM(np_img, 1);
+
+    amp  = PyArray_DATA(np_amp);
+    mean = PyArray_DATA(np_mean);
+    var  = PyArray_DATA(np_var);
+    img  = PyArray_DATA(np_img);
+
+    result = em_fit_2d_reg_core(img, NX, NY, x0, y0, K, amp, mean, var,
+                                alpha, steps, 0.0);
 
     Py_DECREF(np_img);
     Py_DECREF(np_amp);
@@ -505,6 +550,145 @@ static int em_fit_2d_reg(PyObject* po_img, int x0, int y0,
     return result;
 }
 
+// Fits a batch of N same-sized stamps with em_fit_2d_reg.
+// imgs: N x NY x NX; amps: N x K; means: N x K x 2; vars: N x K x 2 x 2
+// (initialized, and updated in place).
+// init: N ints; if init[i] >= 0, stamp i is started from the fit
+// result for stamp init[i] (which must be < i), rather than from its
+// own amps,means,vars -- eg, its neighbour on a grid.
+// tol: stop each fit early once no parameter changes by more than tol
+// in an EM step (0: always run "steps" steps).
+// Stamps that do not depend on each other are fit in parallel, using
+// up to "nthreads" threads (when built with OpenMP; nthreads <= 0
+// means the OpenMP default).
+// Returns 0 on success, -1 if any fit failed.
+static int em_fit_2d_reg_batch(PyObject* po_imgs, int x0, int y0,
+                               PyObject* po_amps,
+                               PyObject* po_means,
+                               PyObject* po_vars,
+                               PyObject* po_init,
+                               double alpha,
+                               int steps,
+                               double tol,
+                               int nthreads) {
+    npy_intp N, K, NX, NY;
+    int i, lev, maxdepth;
+    int* depth = NULL;
+    int* init;
+    int failed = 0;
+    int result = -1;
+
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    PyArray_Descr* itype = PyArray_DescrFromType(NPY_INT);
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+
+    PyArrayObject *np_imgs = NULL, *np_amps = NULL, *np_means = NULL,
+        *np_vars = NULL, *np_init = NULL;
+
+    double* amps;
+    double* means;
+    double* vars;
+    double* imgs;
+
+    Py_INCREF(dtype);
+    np_imgs = (PyArrayObject*)PyArray_FromAny(po_imgs, dtype, 3, 3, req, NULL);
+    Py_INCREF(dtype);
+    np_amps = (PyArrayObject*)PyArray_FromAny(po_amps, dtype, 2, 2, reqout, NULL);
+    Py_INCREF(dtype);
+    np_means = (PyArrayObject*)PyArray_FromAny(po_means, dtype, 3, 3, reqout, NULL);
+    Py_INCREF(dtype);
+    np_vars = (PyArrayObject*)PyArray_FromAny(po_vars, dtype, 4, 4, reqout, NULL);
+    Py_INCREF(itype);
+    np_init = (PyArrayObject*)PyArray_FromAny(po_init, itype, 1, 1, req, NULL);
+    if (!np_imgs || !np_amps || !np_means || !np_vars || !np_init) {
+        ERR("imgs, amps, means, vars, or init wasn't the type expected");
+        goto cleanup;
+    }
+
+    N = PyArray_DIM(np_imgs, 0);
+    NY = PyArray_DIM(np_imgs, 1);
+    NX = PyArray_DIM(np_imgs, 2);
+    K = PyArray_DIM(np_amps, 1);
+    if ((PyArray_DIM(np_amps, 0) != N) ||
+        (PyArray_DIM(np_means, 0) != N) ||
+        (PyArray_DIM(np_means, 1) != K) ||
+        (PyArray_DIM(np_means, 2) != 2) ||
+        (PyArray_DIM(np_vars, 0) != N) ||
+        (PyArray_DIM(np_vars, 1) != K) ||
+        (PyArray_DIM(np_vars, 2) != 2) ||
+        (PyArray_DIM(np_vars, 3) != 2) ||
+        (PyArray_DIM(np_init, 0) != N)) {
+        ERR("amps, means, vars, init must be N x K, N x K x 2, N x K x 2 x 2, N");
+        goto cleanup;
+    }
+
+    imgs  = PyArray_DATA(np_imgs);
+    amps  = PyArray_DATA(np_amps);
+    means = PyArray_DATA(np_means);
+    vars  = PyArray_DATA(np_vars);
+    init  = PyArray_DATA(np_init);
+
+    // Each stamp must be fit after the stamp it starts from.
+    depth = malloc(N * sizeof(int));
+    maxdepth = 0;
+    for (i=0; i<N; i++) {
+        if (init[i] < 0) {
+            depth[i] = 0;
+            continue;
+        }
+        if (init[i] >= i) {
+            ERR("init[%i] = %i: must be < %i\n", i, init[i], i);
+            goto cleanup;
+        }
+        depth[i] = depth[init[i]] + 1;
+        if (depth[i] > maxdepth)
+            maxdepth = depth[i];
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (lev=0; lev<=maxdepth; lev++) {
+#ifdef _OPENMP
+        int nt = (nthreads > 0) ? nthreads : omp_get_max_threads();
+#pragma omp parallel for schedule(dynamic) num_threads(nt) reduction(|:failed)
+#endif
+        for (i=0; i<N; i++) {
+            int j;
+            if (depth[i] != lev)
+                continue;
+            j = init[i];
+            if (j >= 0) {
+                // (normalizing the amplitudes, as em_init_params does)
+                double asum = 0.0;
+                int k;
+                for (k=0; k<K; k++)
+                    asum += amps[j*K + k];
+                for (k=0; k<K; k++)
+                    amps[i*K + k] = amps[j*K + k] / asum;
+                memcpy(means + i*K*2,   means + j*K*2,   K*2 * sizeof(double));
+                memcpy(vars  + i*K*2*2, vars  + j*K*2*2, K*2*2 * sizeof(double));
+            }
+            if (em_fit_2d_reg_core(imgs + i*NX*NY, NX, NY, x0, y0, K,
+                                   amps + i*K, means + i*K*2, vars + i*K*2*2,
+                                   alpha, steps, tol))
+                failed = 1;
+        }
+    }
+    Py_END_ALLOW_THREADS
+    result = (failed ? -1 : 0);
+
+ cleanup:
+    free(depth);
+    Py_XDECREF(np_imgs);
+    Py_XDECREF(np_amps);
+    Py_XDECREF(np_means);
+    Py_XDECREF(np_vars);
+    Py_XDECREF(np_init);
+    Py_DECREF(dtype);
+    Py_DECREF(itype);
+    return result;
+}
+
 //%apply double *OUTPUT { double *p_skyamp };
 static int em_fit_2d_reg2(PyObject* np_img, int x0, int y0,
                           PyObject* np_amp,
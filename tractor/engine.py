@@ -10,12 +10,11 @@ Core image modeling and fitting.
 '''
 from __future__ import print_function
 import logging
+import math
 
 import numpy as np
 
-from astrometry.util.ttime import Time
-
-from tractor.utils import MultiParams, _isint, get_class_from_name
+from tractor.utils import MultiParams, _isint, get_class_from_name, sumsq
 from tractor.patch import Patch, ModelMask
 from tractor.image import Image
 
@@ -118,6 +117,11 @@ class Tractor(MultiParams):
         '''
         - `images:` list of Image objects (data)
         - `catalog:` list of Source objects
+
+        The `modtype` attribute (default np.float32) sets the precision
+        of model images, chi images and the derivative matrix built
+        by the optimizers; chi-squared sums are always accumulated in
+        double precision (see `utils.sumsq`), as is the LSQR solve.
         '''
         if images is None:
             images = []
@@ -140,6 +144,17 @@ class Tractor(MultiParams):
         if model_kwargs is None:
             model_kwargs = {}
         self.model_kwargs = model_kwargs
+        # per-image cache of source pixel positions; see getPixelPositions
+        self.pixcache = {}
+        # id(image) -> index in self.images; see _getImageIndex
+        self.imageindex = {}
+        # see planModelMasks
+        self.maskplanner = None
+        # see profiler.Profiler
+        self.profiler = None
+        # render masked mixture-of-Gaussians sources in one batch; see
+        # getModelImage
+        self.batchRender = True
 
     def __str__(self):
         s = ('%s with %i sources and %i images' % (
@@ -153,17 +168,20 @@ class Tractor(MultiParams):
         s += ' (' + ', '.join(names) + ')'
         return s
 
-    # For use from emcee
+    # For use from emcee; a 2-d *X* (as from emcee with vectorize=True)
+    # is evaluated with getLogProbs.
     def __call__(self, X):
+        if np.ndim(X) == 2:
+            return self.getLogProbs(X)
         self.setParams(X)
         return self.getLogProb()
 
     # For pickling
     def __getstate__(self):
-        version = 1
+        version = 2
         S = (version, self.getImages(), self.getCatalog(), self.liquid,
              self.modtype, self.modelMasks, self.expectModelMasks,
-             self.optimizer)
+             self.optimizer, self.model_kwargs)
         return S
 
     def __setstate__(self, state):
@@ -176,6 +194,16 @@ class Tractor(MultiParams):
         elif len(state) == 8:
             (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
              self.expectModelMasks, self.optimizer) = state
+        elif len(state) == 9:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer, self.model_kwargs) = state
+        if not hasattr(self, 'model_kwargs'):
+            self.model_kwargs = {}
+        self.pixcache = {}
+        self.imageindex = {}
+        self.maskplanner = None
+        self.profiler = None
+        self.batchRender = True
         self.subs = [images, catalog]
 
     def getNImages(self):
@@ -266,6 +294,7 @@ class Tractor(MultiParams):
         '''
         kw = self.model_kwargs.copy()
         kw.update(kwargs)
+        self._updateModelMasks()
         return self.optimizer.optimize(self, **kw)
 
     def optimize_loop(self, **kwargs):
@@ -276,8 +305,22 @@ class Tractor(MultiParams):
         '''
         kw = self.model_kwargs.copy()
         kw.update(kwargs)
+        self._updateModelMasks()
         return self.optimizer.optimize_loop(self, **kw)
 
+    def optimize_blobs(self, blobs=None, mp=None, **kwargs):
+        '''
+        Splits the sources into independent blobs (groups of sources
+        whose footprints overlap; see `blobs.findBlobs`) and optimizes
+        each separately with `optimize_loop`, in parallel if *mp* is
+        given.  See `blobs.optimizeBlobs`.
+
+        Returns the list of `blobs.Blob` objects, with per-blob
+        convergence and timing.
+        '''
+        from .blobs import optimizeBlobs
+        return optimizeBlobs(self, blobs=blobs, mp=mp, **kwargs)
+
     def getDerivs(self, **kwargs):
         '''
         Computes model-image derivatives for each parameter.
@@ -292,7 +335,11 @@ class Tractor(MultiParams):
 
         Where the *derivs* are *Patch* objects and *imgs* are *Image*
         objects.
+
+        If model masks are being planned (see `planModelMasks`), they
+        are updated first.
         '''
+        self._updateModelMasks()
         allderivs = []
 
         if self.isParamFrozen('catalog'):
@@ -308,6 +355,8 @@ class Tractor(MultiParams):
         if not self.isParamFrozen('images'):
             for i in self.images.getThawedParamIndices():
                 img = self.images[i]
+                if self.profiler is not None:
+                    t0 = self.profiler.start()
                 derivs = img.getParamDerivatives(self, allsrcs, **kw)
                 mod0 = None
                 for di, deriv in enumerate(derivs):
@@ -320,10 +369,14 @@ class Tractor(MultiParams):
                         oldval = img.setParam(di, p0[di] + stepsizes[di])
                         mod = self.getModelImage(img, **kwargs)
                         img.setParam(di, oldval)
-                        deriv = Patch(0, 0, (mod - mod0) / stepsizes[di])
+                        mod -= mod0
+                        mod /= stepsizes[di]
+                        deriv = Patch(0, 0, mod)
                         deriv.name = 'd(im%i)/d(%s)' % (i, paramnames[di])
                     allderivs.append([(deriv, img)])
                 del mod0
+                if self.profiler is not None:
+                    self.profiler.stop(t0, 'derivs', img=img)
 
         for src in srcs:
             srcderivs = [[] for i in range(src.numberOfParams())]
@@ -358,14 +411,59 @@ class Tractor(MultiParams):
         dictionary; all the ModelMask objects should be non-None and
         non-empty.
         '''
+        self.maskplanner = None
         self.modelMasks = masks
         assert((masks is None) or (len(masks) == len(self.images)))
         self.expectModelMasks = (masks is not None) and assumeMasks
 
+    def planModelMasks(self, minsb=None, nsigma=None, fluxfrac=None,
+                       minradius=1, movetol=1., growtol=0.2):
+        '''
+        Plans model masks for all sources in all images from their
+        current model patches (see `footprint.getSourceFootprint` for
+        *minsb*, *fluxfrac* and *minradius*, and
+        `footprint.planFootprints` for *nsigma*), and installs them
+        with `setModelMasks`.
+
+        The masks are then kept up to date at each optimization step
+        (`optimize`, `optimize_loop` and `getDerivs`): only sources
+        that have moved by more than *movetol* pixels, or whose counts
+        or radius have grown by more than a fraction *growtol*, are
+        re-planned, so the other sources are rendered, and their
+        derivatives computed, in the same pixels at every iteration.
+
+        Returns the list of {src: ModelMask} dicts.  Calling
+        `setModelMasks` stops the planning.
+        '''
+        from .footprint import ModelMaskPlanner
+        planner = ModelMaskPlanner(minsb=minsb, nsigma=nsigma,
+                                   fluxfrac=fluxfrac, minradius=minradius,
+                                   movetol=movetol, growtol=growtol)
+        masks = planner.plan(self)
+        self.maskplanner = planner
+        return masks
+
+    def _updateModelMasks(self):
+        if self.maskplanner is not None:
+            self.maskplanner.update(self)
+
+    def _getImageIndex(self, image):
+        # Index of *image* in self.images, through a dict from id(image)
+        # rebuilt whenever it is found to be stale.
+        i = self.imageindex.get(id(image), None)
+        if (i is None or i >= len(self.images) or
+                self.images[i] is not image):
+            self.imageindex = dict([(id(im), j) for j, im in
+                                    enumerate(self.images)])
+            i = self.imageindex.get(id(image), None)
+            if i is None:
+                return self.images.index(image)
+        return i
+
     def _getModelMaskFor(self, image, src):
         if self.modelMasks is None:
             return None
-        i = self.images.index(image)
+        i = self._getImageIndex(image)
         try:
             return self.modelMasks[i][src]
         except KeyError:
@@ -394,7 +492,11 @@ class Tractor(MultiParams):
         # HACK! -- assume no modelMask -> no overlap
         if self.expectModelMasks and mask is None:
             return [None] * src.numberOfParams()
+        if self.profiler is not None:
+            t0 = self.profiler.start()
         derivs = src.getParamDerivatives(img, modelMask=mask, **kwargs)
+        if self.profiler is not None:
+            self.profiler.stop(t0, 'derivs', src=src, img=img)
 
         # HACK -- auto-add?
         # if self.expectModelMasks:
@@ -420,9 +522,79 @@ class Tractor(MultiParams):
             return None
         kw = self.model_kwargs.copy()
         kw.update(kwargs)
+        if self.profiler is not None:
+            t0 = self.profiler.start()
         mod = src.getModelPatch(img, modelMask=mask, **kw)
+        if self.profiler is not None:
+            self.profiler.stop(t0, 'render', src=src, img=img)
         return mod
 
+    def _getPixelPositionCache(self, img, srcs):
+        # Returns the dict of (ra, dec) -> (x, y) pixel positions in
+        # *img*, for the current state of its WCS, updated to include
+        # the sources *srcs*; or None if the WCS can't use one.
+        from .wcs import ConstantFitsWcs, RaDecPos
+        wcs = img.getWcs()
+        if not isinstance(wcs, ConstantFitsWcs):
+            return None
+        key = wcs.hashkey()
+        cached = self.pixcache.get(id(img), None)
+        if cached is not None and cached[0] is img and cached[1] == key:
+            xy = cached[2]
+        else:
+            xy = {}
+        rd = set()
+        for src in srcs:
+            if src is None or not hasattr(src, 'getPosition'):
+                continue
+            pos = src.getPosition()
+            if type(pos) is RaDecPos:
+                rd.add((pos.ra, pos.dec))
+        if len(xy) + len(rd) > 2 * len(srcs) + 100:
+            # Drop the positions of sources that have since moved.
+            xy = {}
+        rd = [k for k in rd if not k in xy]
+        if len(rd):
+            ra, dec = np.array(rd).T
+            x, y = wcs.positionsToPixels(ra, dec)
+            xy.update(zip(rd, zip(x, y)))
+        self.pixcache[id(img)] = (img, key, xy)
+        return xy
+
+    def getPixelPositions(self, img, srcs=None):
+        '''
+        Returns numpy arrays *x*, *y* of the pixel positions in Image
+        *img* of the sources *srcs* (default, the catalog); NaN for
+        sources without an RA,Dec position.
+
+        For `ConstantFitsWcs` WCSes (including `TanWcs`), positions
+        are projected with one vectorized `positionsToPixels` call
+        and cached per image, keyed by the WCS state, so that
+        repeated calls only project sources that have moved.  The same
+        cache is used by the WCS's `positionToPixel` while
+        `getModelImage` renders sources.
+        '''
+        from .wcs import RaDecPos
+        if _isint(img):
+            img = self.getImage(img)
+        if srcs is None:
+            srcs = self.catalog
+        xy = self._getPixelPositionCache(img, srcs)
+        wcs = img.getWcs()
+        x = np.empty(len(srcs))
+        y = np.empty(len(srcs))
+        x[:] = np.nan
+        y[:] = np.nan
+        for i, src in enumerate(srcs):
+            if src is None or not hasattr(src, 'getPosition'):
+                continue
+            pos = src.getPosition()
+            if xy is not None and type(pos) is RaDecPos:
+                x[i], y[i] = xy[(pos.ra, pos.dec)]
+            else:
+                x[i], y[i] = wcs.positionToPixel(pos, src)
+        return x, y
+
     def getModelImage(self, img, srcs=None, sky=True, minsb=None, **kwargs):
         '''
         Create a model image for the given "tractor image", including
@@ -437,15 +609,104 @@ class Tractor(MultiParams):
             img.getSky().addTo(mod)
         if srcs is None:
             srcs = self.catalog
-        for src in srcs:
-            if src is None:
-                continue
-            patch = self.getModelPatch(img, src, minsb=minsb, **kwargs)
-            if patch is None:
-                continue
-            patch.addTo(mod)
+        elif not hasattr(srcs, '__len__'):
+            srcs = list(srcs)
+        wcs = img.getWcs()
+        xy = self._getPixelPositionCache(img, srcs)
+        if xy is not None:
+            wcs.pixcache = xy
+        # Sources whose models are a mixture of Gaussians evaluated in a
+        # ModelMask are rendered in one call to the C extension.
+        batch = None
+        if self.batchRender and not kwargs and not self.model_kwargs:
+            batch = []
+        try:
+            for src in srcs:
+                if src is None:
+                    continue
+                if batch is not None:
+                    mask = self._getModelMaskFor(img, src)
+                    b = self._getRenderMixture(img, src, mask)
+                    if b is not None:
+                        if len(b):
+                            batch.append((mask,) + b)
+                        continue
+                patch = self.getModelPatch(img, src, minsb=minsb, **kwargs)
+                if patch is None:
+                    continue
+                patch.addTo(mod)
+            if batch:
+                self._renderBatch(img, batch, mod)
+        finally:
+            if xy is not None:
+                wcs.pixcache = None
         return mod
 
+    def _getRenderMixture(self, img, src, mask):
+        # Returns (mixture, x offset, y offset, counts) with which
+        # mixture_profiles.render_mixtures renders the model of *src*
+        # in *img* exactly as src.getModelPatch(img, modelMask=mask)
+        # does; or () if that model is None; or None if the source
+        # must be rendered by getModelPatch.
+        from .pointsource import PointSource, SingleProfileSource
+        from .galaxy import ProfileGalaxy
+        from .psf import GaussianMixturePSF, HybridPSF
+        if mask is None:
+            if self.expectModelMasks:
+                return ()
+            return None
+        H, W = img.shape
+        if mask.x0 < 0 or mask.y0 < 0 or mask.x1 > W or mask.y1 > H:
+            return None
+        cls = type(src)
+        psf = img.getPsf()
+        if (cls.getModelPatch is not SingleProfileSource.getModelPatch
+            or isinstance(psf, HybridPSF)
+            or not hasattr(psf, 'getMixtureOfGaussians')):
+            return None
+        if cls is PointSource:
+            if not (isinstance(psf, GaussianMixturePSF) and
+                    type(psf).getPointSourcePatch is
+                    GaussianMixturePSF.getPointSourcePatch):
+                return None
+        elif not (isinstance(src, ProfileGalaxy) and
+                  cls.getUnitFluxModelPatch is
+                  ProfileGalaxy.getUnitFluxModelPatch and
+                  cls._realGetUnitFluxModelPatch is
+                  ProfileGalaxy._realGetUnitFluxModelPatch):
+            return None
+
+        counts = img.getPhotoCal().brightnessToCounts(src.getBrightness())
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            return ()
+        px, py = img.getWcs().positionToPixel(src.getPosition(), src)
+        if cls is PointSource:
+            r = src.fixedRadius
+            if r is None:
+                r = psf.getRadius()
+            if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
+                return ()
+            return (psf.getMixtureOfGaussians(px=px, py=py), px, py, counts)
+        amix = src._getAffineProfile(img, px, py)
+        if amix is None:
+            return None
+        # (the convolved mixture's means include px,py)
+        cmix = amix.convolve(psf.getMixtureOfGaussians(px=px, py=py))
+        return (cmix, 0., 0., counts)
+
+    def _renderBatch(self, img, batch, mod):
+        # Adds the models listed in *batch* (from _getRenderMixture) to
+        # the model image *mod*.
+        from . import mixture_profiles as mp
+        if self.profiler is not None:
+            t0 = self.profiler.start()
+        masks, mixes, fx, fy, counts = zip(*batch)
+        mp.render_mixtures(mixes, np.vstack((fx, fy)).T, masks,
+                           masks=[m.mask for m in masks], scales=counts,
+                           image=mod, patches=False)
+        if self.profiler is not None:
+            self.profiler.stop(t0, 'render', img=img)
+
     def getModelImages(self, **kwargs):
         for img in self.images:
             yield self.getModelImage(img, **kwargs)
@@ -458,7 +719,10 @@ class Tractor(MultiParams):
         if img is None:
             img = self.getImage(imgi)
         mod = self.getModelImage(img, srcs=srcs, minsb=minsb, **kwargs)
-        chi = (img.getImage() - mod) * img.getInvError()
+        # computed in the model precision, whatever the image's
+        chi = np.empty(mod.shape, self.modtype)
+        np.subtract(img.getImage(), mod, out=chi)
+        chi *= img.getInvError()
         if not np.all(np.isfinite(chi)):
             print('Chi not finite')
             print('Image finite?', np.all(np.isfinite(img.getImage())))
@@ -475,9 +739,7 @@ class Tractor(MultiParams):
         return chi
 
     def getLogLikelihood(self, **kwargs):
-        chisq = 0.
-        for i, chi in enumerate(self.getChiImages(**kwargs)):
-            chisq += (chi.astype(float) ** 2).sum()
+        chisq = math.fsum([sumsq(chi) for chi in self.getChiImages(**kwargs)])
         return -0.5 * chisq
 
     def getLogProb(self, **kwargs):
@@ -497,3 +759,101 @@ class Tractor(MultiParams):
             print('log prior:', lnprior)
             return -np.inf
         return lnp
+
+    def getLogProbs(self, X, threads=None, minsb=0.):
+        '''
+        Returns a vector of the log-probabilities at each row of the
+        (n_walkers, n_params) array of parameters *X*, as for an
+        ensemble sampler (eg, `emcee.EnsembleSampler` with
+        *vectorize=True*).  The current parameters are unchanged.
+
+        When the image parameters are frozen, the sky and the frozen
+        sources are rendered only once, and for each walker only the
+        sources with thawed parameters are re-rendered, on top of
+        that.  With *threads* > 1, walkers are evaluated in that many
+        threads, each with its own copies of the thawed sources and
+        its own model buffers.
+
+        *minsb*: as for `getLogProb` (via `getChiImage`).
+        '''
+        X = np.atleast_2d(X)
+        p0 = self.getParams()
+        lnp = np.empty(len(X))
+        lnp[:] = -np.inf
+        if not self.isParamFrozen('images') and self.images.numberOfParams():
+            # No shared work: evaluate each walker from scratch.
+            try:
+                for k, x in enumerate(X):
+                    self.setParams(x)
+                    lnp[k] = self.getLogProb(minsb=minsb)
+            finally:
+                self.setParams(p0)
+            return lnp
+
+        # The priors are cheap; evaluate them here.
+        try:
+            for k, x in enumerate(X):
+                self.setParams(x)
+                lnp[k] = self.getLogPrior()
+        finally:
+            self.setParams(p0)
+        K = np.flatnonzero(np.isfinite(lnp))
+
+        thawed = []
+        if not self.isParamFrozen('catalog'):
+            thawed = [src for src in self.catalog.getThawedSources()
+                      if src is not None and src.numberOfParams() > 0]
+        thawedids = set([id(src) for src in thawed])
+        fixed = [src for src in self.catalog
+                 if src is not None and not id(src) in thawedids]
+        mod0 = [self.getModelImage(img, srcs=fixed, minsb=minsb)
+                for img in self.images]
+        # offsets of the thawed sources' parameters in X (the images
+        # are frozen, or have no parameters, so contribute none)
+        offsets = np.cumsum([0] + [src.numberOfParams() for src in thawed])
+        kw = self.model_kwargs.copy()
+        kw.update(minsb=minsb)
+
+        def lnlike(srcs, bufs, k):
+            x = X[k]
+            for src, i0, i1 in zip(srcs, offsets[:-1], offsets[1:]):
+                src.setParams(x[i0:i1])
+            chisq = []
+            for img, m0, buf in zip(self.images, mod0, bufs):
+                np.copyto(buf, m0)
+                for src, orig in zip(srcs, thawed):
+                    mask = self._getModelMaskFor(img, orig)
+                    if self.expectModelMasks and mask is None:
+                        continue
+                    patch = src.getModelPatch(img, modelMask=mask, **kw)
+                    if patch is not None:
+                        patch.addTo(buf)
+                buf -= img.getImage()
+                buf *= img.getInvError()
+                chisq.append(sumsq(buf))
+            return -0.5 * math.fsum(chisq)
+
+        def run(srcs, KK):
+            bufs = [np.empty(m0.shape, self.modtype) for m0 in mod0]
+            return [lnlike(srcs, bufs, k) for k in KK]
+
+        if threads is None or threads <= 1 or len(K) <= 1:
+            p0src = [src.getParams() for src in thawed]
+            try:
+                lnl = run(thawed, K)
+            finally:
+                for src, p in zip(thawed, p0src):
+                    src.setParams(p)
+        else:
+            from multiprocessing.pool import ThreadPool
+            chunks = np.array_split(K, min(threads, len(K)))
+            pool = ThreadPool(len(chunks))
+            try:
+                R = pool.map(lambda KK: run([src.copy() for src in thawed],
+                                            KK), chunks)
+            finally:
+                pool.close()
+            lnl = [l for r in R for l in r]
+        lnp[K] += lnl
+        lnp[np.isnan(lnp)] = -np.inf
+        return lnp
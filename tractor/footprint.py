@@ -0,0 +1,252 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`footprint.py`
+==============
+
+Footprint planning: choosing, once per source per image, the pixels
+that source's model needs to be rendered in.
+
+By default, each render of a source decides its own extent -- the PSF
+radius for point sources, `_getUnitFluxPatchSize` for galaxies --
+which is generous for faint sources, and can change as the source's
+parameters change.  Here we render each source once at full extent
+and find the smallest square, centered on the source, outside which
+its model falls below a surface-brightness (or noise) threshold, or
+which contains all but a given fraction of its flux.  The results are
+`ModelMask` objects, so that rendering and derivatives then use the
+same fixed footprints::
+
+    tractor.setModelMasks(planFootprints(tractor, nsigma=0.1))
+
+`ModelMaskPlanner` (see `Tractor.planModelMasks`) keeps such masks up
+to date during optimization, re-planning only sources that move or
+grow.
+'''
+from __future__ import print_function
+
+import numpy as np
+
+from tractor.patch import ModelMask
+
+
+def getImageNoise(img):
+    '''
+    Returns the median per-pixel noise (in image counts) of Image
+    *img*, ignoring pixels with zero inverse-error.
+    '''
+    ie = img.getInvError()
+    ie = ie[ie > 0]
+    if len(ie) == 0:
+        return 0.
+    return 1. / np.median(ie)
+
+
+def getSourceFootprint(img, src, minsb=None, fluxfrac=None, minradius=1):
+    '''
+    Returns a `ModelMask`: the smallest square of pixels, centered on
+    the peak of the model of source *src* in Image *img* and clipped
+    to the image, that meets the given criteria; or None if the source
+    does not touch the image.
+
+    *minsb*: surface brightness (in image counts per pixel) below which
+    the model may be truncated.
+
+    *fluxfrac*: the fraction of the source's flux that may fall outside
+    the footprint.
+
+    If both are given, the footprint meets both; if neither, it is the
+    full extent of the source's model.  The footprint's half-size is
+    at least *minradius* pixels.  Sources with zero flux are planned
+    from their unit-flux profiles, ignoring *minsb*.
+    '''
+    patch = src.getModelPatch(img, minsb=0.)
+    if patch is None or patch.patch is None:
+        # Zero flux: plan from the unit-flux profile.
+        minsb = None
+        patch = None
+        for p in src.getUnitFluxModelPatches(img, minval=0.):
+            if p is None or p.patch is None:
+                continue
+            if patch is None:
+                patch = p
+            else:
+                patch = patch + p
+        if patch is None:
+            return None
+    P = np.abs(patch.patch)
+    if not np.any(P > 0):
+        return None
+
+    # Chebyshev distance of each pixel from the peak
+    ph, pw = P.shape
+    iy, ix = np.unravel_index(np.argmax(P), P.shape)
+    d = np.maximum(np.abs(np.arange(pw) - ix)[np.newaxis, :],
+                   np.abs(np.arange(ph) - iy)[:, np.newaxis])
+    radii = []
+    if minsb is not None:
+        above = d[P >= minsb]
+        radii.append(above.max() if len(above) else 0)
+    if fluxfrac is not None:
+        total = np.sum(P)
+        outside = total - np.cumsum(np.bincount(d.ravel(), weights=P.ravel()))
+        I = np.flatnonzero(outside <= fluxfrac * total)
+        # (none with fluxfrac=0, or through round-off: take the whole patch)
+        radii.append(I[0] if len(I) else d.max())
+    if len(radii):
+        r = max(radii)
+    else:
+        r = d.max()
+    r = int(max(r, minradius))
+
+    cx = patch.x0 + ix
+    cy = patch.y0 + iy
+    H, W = img.shape
+    x0 = max(0, cx - r)
+    y0 = max(0, cy - r)
+    x1 = min(W, cx + r + 1)
+    y1 = min(H, cy + r + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return ModelMask(x0, y0, x1 - x0, y1 - y0)
+
+
+def planFootprints(tractor, minsb=None, nsigma=None, fluxfrac=None,
+                   minradius=1):
+    '''
+    Plans footprints (see `getSourceFootprint`) for all sources in all
+    images of *tractor*.  Returns a list with one dict per image,
+    mapping sources to `ModelMask` objects, as taken by
+    `Tractor.setModelMasks`.  Sources that do not touch an image are
+    omitted from its dict.
+
+    *nsigma*: truncate the models below this multiple of each image's
+    median per-pixel noise (see `getImageNoise`); combined with
+    *minsb*, the larger threshold is used.
+    '''
+    masks = []
+    for img in tractor.getImages():
+        sb = minsb
+        if nsigma is not None:
+            sig = nsigma * getImageNoise(img)
+            if sb is None or sig > sb:
+                sb = sig
+        mm = {}
+        for src in tractor.getCatalog():
+            if src is None:
+                continue
+            m = getSourceFootprint(img, src, minsb=sb, fluxfrac=fluxfrac,
+                                   minradius=minradius)
+            if m is not None:
+                mm[src] = m
+        masks.append(mm)
+    return masks
+
+
+class ModelMaskPlanner(object):
+    '''
+    Keeps a `Tractor`'s model masks planned (see `planFootprints`) as
+    its sources change during optimization.
+
+    Each source's footprint is recorded along with its pixel position,
+    total counts and (where it has one) radius at the time it was
+    planned.  `update` re-plans only the sources that have since moved
+    by more than *movetol* pixels, or whose counts or radius have grown
+    by more than a fraction *growtol*, plus any sources new to the
+    catalog; all other masks -- and so the sizes of the patches
+    rendered through them -- stay fixed.
+
+    Usually created through `Tractor.planModelMasks`.
+    '''
+    def __init__(self, minsb=None, nsigma=None, fluxfrac=None, minradius=1,
+                 movetol=1., growtol=0.2):
+        self.minsb = minsb
+        self.nsigma = nsigma
+        self.fluxfrac = fluxfrac
+        self.minradius = minradius
+        self.movetol = movetol
+        self.growtol = growtol
+        # per image: { src: (x, y, counts, radius) }
+        self.state = None
+
+    def _getThreshold(self, img):
+        sb = self.minsb
+        if self.nsigma is not None:
+            sig = self.nsigma * getImageNoise(img)
+            if sb is None or sig > sb:
+                sb = sig
+        return sb
+
+    def _getSizes(self, img, src):
+        counts = 0.
+        if hasattr(src, 'getBrightnesses'):
+            counts = sum([abs(img.getPhotoCal().brightnessToCounts(b))
+                          for b in src.getBrightnesses()])
+        radius = 0.
+        if hasattr(src, 'getRadius'):
+            radius = src.getRadius()
+        return counts, radius
+
+    def plan(self, tractor):
+        '''
+        Plans masks for all sources in all images of *tractor* and
+        installs them as its model masks.
+        '''
+        self.state = None
+        self.update(tractor)
+        return tractor.modelMasks
+
+    def update(self, tractor):
+        '''
+        Re-plans the masks of sources that have moved or grown beyond
+        the tolerances, or are new; returns the number re-planned.
+        '''
+        masks = tractor.modelMasks
+        if (self.state is None or masks is None or
+                len(masks) != len(tractor.getImages())):
+            self.state = [{} for img in tractor.getImages()]
+            masks = [{} for img in tractor.getImages()]
+            # (not through setModelMasks, which stops the planning)
+            tractor.modelMasks = masks
+            tractor.expectModelMasks = True
+        cat = tractor.getCatalog()
+        srcs = [src for src in cat if src is not None]
+        nplanned = 0
+        for img, state, mm in zip(tractor.getImages(), self.state, masks):
+            x, y = tractor.getPixelPositions(img, srcs)
+            sb = None
+            for src, sx, sy in zip(srcs, x, y):
+                counts, radius = self._getSizes(img, src)
+                old = state.get(src, None)
+                if old is not None:
+                    ox, oy, ocounts, oradius = old
+                    moved = np.hypot(sx - ox, sy - oy) > self.movetol
+                    grown = (counts > ocounts * (1. + self.growtol) or
+                             radius > oradius * (1. + self.growtol))
+                    if not (moved or grown):
+                        continue
+                if sb is None:
+                    sb = self._getThreshold(img)
+                m = getSourceFootprint(img, src, minsb=sb,
+                                       fluxfrac=self.fluxfrac,
+                                       minradius=self.minradius)
+                nplanned += 1
+                if m is None:
+                    mm.pop(src, None)
+                else:
+                    mm[src] = m
+                # Keep the largest counts and radius seen, so that
+                # masks are not re-planned as sources oscillate.
+                if old is not None:
+                    counts = max(counts, old[2])
+                    radius = max(radius, old[3])
+                state[src] = (sx, sy, counts, radius)
+            if len(state) > len(srcs):
+                # Forget sources removed from the catalog.
+                keep = set(srcs)
+                for src in list(state.keys()):
+                    if not src in keep:
+                        del state[src]
+                        mm.pop(src, None)
+        return nplanned
@@ -184,7 +184,10 @@ class Galaxy(MultiParams, SingleProfileSource):
                 if patchx is None or patchx.getImage() is None:
                     derivs.append(None)
                     continue
-                dx = (patchx - patch0) * (counts / pstep)
+                # (in place: patchx is ours, and has patch0's extent)
+                patchx -= patch0
+                patchx *= (counts / pstep)
+                dx = patchx
                 dx.setName('d(%s)/d(pos%i)' % (self.dname, i))
                 derivs.append(dx)
 
@@ -223,7 +226,9 @@ class Galaxy(MultiParams, SingleProfileSource):
                     print('  to', self.shape.getParams()[i])
                     derivs.append(None)
                     continue
-                dx = (patchx - patch0) * (counts / gstep)
+                patchx -= patch0
+                patchx *= (counts / gstep)
+                dx = patchx
                 dx.setName('d(%s)/d(%s)' % (self.dname, gnames[i]))
                 derivs.append(dx)
         return derivs
@@ -0,0 +1,431 @@
+// Gaussian components are evaluated where the exponent (including the
+// -0.5) is at least GM_QMIN; as for c_gauss_2d_masked.
+#define GM_QMIN -30.
+
+// With GCC on x86-64 Linux, the renderer is compiled for AVX2+FMA and
+// AVX-512 too, and the best version the CPU supports is chosen at load
+// time.
+#if defined(__GNUC__) && !defined(__clang__) && (__GNUC__ >= 11) && \
+    defined(__x86_64__) && defined(__linux__)
+#define GM_TARGET_CLONES \
+    __attribute__((target_clones("arch=x86-64-v4", "arch=x86-64-v3", "default")))
+#else
+#define GM_TARGET_CLONES
+#endif
+
+// exp(x) for -50 <= x <= 0, written so that loops over it vectorize:
+// Cody-Waite reduction by multiples of ln(2), a degree-12 Taylor
+// polynomial on [-ln(2)/2, ln(2)/2] (relative error ~ 2e-16), and the
+// power of two built directly in the exponent bits.
+static inline double gm_exp(double x) {
+    // 1.5 * 2**52: adding it rounds to an integer, in the low bits
+    const double magic = 6755399441055744.0;
+    const double ln2_hi = 6.93147180369123816490e-01;
+    const double ln2_lo = 1.90821492927058770002e-10;
+    double t, n, r, p, s;
+    int64_t bits, magicbits;
+    t = x * 1.44269504088896340736 + magic;
+    n = t - magic;
+    r = (x - n * ln2_hi) - n * ln2_lo;
+    p = 1.0 + r * (1.0 + r * (1./2 + r * (1./6 + r * (1./24 + r * (1./120 +
+        r * (1./720 + r * (1./5040 + r * (1./40320 + r * (1./362880 +
+        r * (1./3628800 + r * (1./39916800 + r * (1./479001600))))))))))));
+    memcpy(&bits, &t, sizeof(double));
+    memcpy(&magicbits, &magic, sizeof(double));
+    // 2**n
+    bits = ((bits - magicbits) + 1023) << 52;
+    memcpy(&s, &bits, sizeof(double));
+    return p * s;
+}
+
+// Renders one source's mixture (K components: amp, mean (K x 2), var
+// (K x 2 x 2)), offset by (fx,fy), into the W x H box at (x0,y0):
+// "result", and (if not NULL) the derivatives with respect to the
+// mixture's position, "xderiv" and "yderiv" (both or neither).  Pixels
+// where "mask" (if not NULL) is zero are set to zero.
+//
+// The pixel loops vectorize when built with -fopenmp and
+// -fno-trapping-math.
+GM_TARGET_CLONES
+static void gm_render_one(int K, const double* amp, const double* mean,
+                          const double* var, double fx, double fy,
+                          int x0, int y0, int W, int H,
+                          const uint8_t* mask, double* result,
+                          double* xderiv, double* yderiv) {
+    const double tpd = 4. * M_PI * M_PI;
+    int k, dy;
+
+    memset(result, 0, (size_t)W * H * sizeof(double));
+    if (xderiv)
+        memset(xderiv, 0, (size_t)W * H * sizeof(double));
+    if (yderiv)
+        memset(yderiv, 0, (size_t)W * H * sizeof(double));
+    // (no components: nothing to add, and no zero-length arrays below)
+    if (K <= 0)
+        return;
+
+    double II[3*K];
+    double scales[K];
+
+    for (k=0; k<K; k++) {
+        const double* V = var + 4*k;
+        double* I = II + 3*k;
+        double v1 = (V[1] + V[2]) * 0.5;
+        double det = V[0]*V[3] - v1*v1;
+        // we fold the -0.5 in the Gaussian exponent, and the 2 in the
+        // 2*dx*dy term, in here
+        double isc = -0.5 / det;
+        I[0] =  V[3] * isc;
+        I[1] = -v1 * isc * 2.0;
+        I[2] =  V[0] * isc;
+        scales[k] = amp[k] / sqrt(tpd * det);
+        if (!(isfinite(I[0]) && isfinite(I[1]) && isfinite(I[2]) &&
+              isfinite(scales[k]) && det > 0 && I[0] < 0 && I[2] < 0)) {
+            scales[k] = 0.;
+            I[0] = I[2] = -1.;
+            I[1] = 0.;
+        }
+    }
+
+    for (dy=0; dy<H; dy++) {
+        double* out = result + (size_t)dy * W;
+        double* xd = xderiv ? xderiv + (size_t)dy * W : NULL;
+        double* yd = yderiv ? yderiv + (size_t)dy * W : NULL;
+        int dx;
+        for (k=0; k<K; k++) {
+            const double* I = II + 3*k;
+            const double sc = scales[k];
+            const double mx = x0 - fx - mean[2*k+0];
+            const double ry = y0 + dy - fy - mean[2*k+1];
+            const double a = I[2] * ry * ry;
+            const double b = I[1] * ry;
+            double rc, qmax, h;
+            int lo, hi;
+            if (sc == 0.)
+                continue;
+            // Along the row, q(rx) = I[0] rx^2 + b rx + a, with
+            // I[0] < 0, is at least GM_QMIN for rx in [rc-h, rc+h].
+            rc = -b / (2. * I[0]);
+            qmax = a + 0.5 * b * rc;
+            if (!(qmax >= GM_QMIN))
+                continue;
+            h = sqrt((qmax - GM_QMIN) / -I[0]);
+            if (rc - h - mx > W || rc + h - mx < 0)
+                continue;
+            lo = MAX(0, (int)ceil(rc - h - mx));
+            hi = MIN(W, (int)floor(rc + h - mx) + 1);
+            if (!xd) {
+#ifdef _OPENMP
+#pragma omp simd
+#endif
+                for (dx=lo; dx<hi; dx++) {
+                    double rx = mx + dx;
+                    double q = I[0] * rx * rx + b * rx + a;
+                    q = (q > GM_QMIN) ? q : GM_QMIN;
+                    out[dx] += sc * gm_exp(q);
+                }
+            } else {
+#ifdef _OPENMP
+#pragma omp simd
+#endif
+                for (dx=lo; dx<hi; dx++) {
+                    double rx = mx + dx;
+                    double q = I[0] * rx * rx + b * rx + a;
+                    double g;
+                    q = (q > GM_QMIN) ? q : GM_QMIN;
+                    g = sc * gm_exp(q);
+                    out[dx] += g;
+                    // (derivatives with respect to the mean, not x,y)
+                    xd[dx] -= g * (2. * I[0] * rx + I[1] * ry);
+                    yd[dx] -= g * (2. * I[2] * ry + I[1] * rx);
+                }
+            }
+        }
+        if (mask) {
+            const uint8_t* m = mask + (size_t)dy * W;
+            for (dx=0; dx<W; dx++) {
+                if (m[dx])
+                    continue;
+                out[dx] = 0.;
+                if (xd)
+                    xd[dx] = 0.;
+                if (yd)
+                    yd[dx] = 0.;
+            }
+        }
+    }
+}
+
+// Renders N sources' mixtures-of-Gaussians in one call.
+//
+// ob_amp, ob_mean, ob_var: the components of all the sources,
+//   packed: Ktot, Ktot x 2, Ktot x 2 x 2 (doubles).
+// ob_kstart: (int) N+1: source i has components [kstart[i], kstart[i+1]).
+// ob_fxy: N x 2: (fx,fy) offsets of each source's means.
+// ob_boxes: (int) N x 4: (x0, y0, w, h) box in which to render each source.
+// ob_masks: None, or (bool) the w x h masks of the sources, packed
+//   (raveled and concatenated) as the outputs are.
+// ob_scale: N: factor by which to multiply each model when
+//   accumulating into ob_image.
+// ob_image: None, or a 2-d float32 or float64 image into which to add
+//   the scaled models; the boxes must lie within it.
+// ob_patches: None, or the (unscaled) models, packed: sum of w*h doubles.
+// ob_xderiv, ob_yderiv: None, or the derivatives of the (unscaled)
+//   models with respect to the sources' positions (fx, fy), packed
+//   (both or neither).
+//
+// Sources are rendered in parallel, using up to "nthreads" threads
+// (when built with OpenMP; nthreads <= 0 means the OpenMP default);
+// they are added into the image in order.
+// Returns 0 on success, -2 if memory allocation fails, -1 on other errors.
+static int c_gauss_2d_multi(PyObject* ob_amp,
+                            PyObject* ob_mean,
+                            PyObject* ob_var,
+                            PyObject* ob_kstart,
+                            PyObject* ob_fxy,
+                            PyObject* ob_boxes,
+                            PyObject* ob_masks,
+                            PyObject* ob_scale,
+                            PyObject* ob_image,
+                            PyObject* ob_patches,
+                            PyObject* ob_xderiv,
+                            PyObject* ob_yderiv,
+                            int nthreads) {
+    npy_intp N, Ktot, NP, i;
+    npy_intp* pstart = NULL;
+    double* scratch = NULL;
+    int result = -1;
+
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    PyArray_Descr* itype = PyArray_DescrFromType(NPY_INT);
+    PyArray_Descr* btype = PyArray_DescrFromType(NPY_BOOL);
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+
+    PyArrayObject *np_amp = NULL, *np_mean = NULL, *np_var = NULL,
+        *np_kstart = NULL, *np_fxy = NULL, *np_boxes = NULL, *np_masks = NULL,
+        *np_scale = NULL, *np_image = NULL, *np_patches = NULL,
+        *np_xderiv = NULL, *np_yderiv = NULL;
+
+    double *amp, *mean, *var, *fxy, *scale, *patches;
+    double *xderiv = NULL, *yderiv = NULL;
+    int *kstart, *boxes;
+    uint8_t* masks = NULL;
+
+    Py_INCREF(dtype);
+    np_amp = (PyArrayObject*)PyArray_FromAny(ob_amp, dtype, 1, 1, req, NULL);
+    Py_INCREF(dtype);
+    np_mean = (PyArrayObject*)PyArray_FromAny(ob_mean, dtype, 2, 2, req, NULL);
+    Py_INCREF(dtype);
+    np_var = (PyArrayObject*)PyArray_FromAny(ob_var, dtype, 3, 3, req, NULL);
+    Py_INCREF(itype);
+    np_kstart = (PyArrayObject*)PyArray_FromAny(ob_kstart, itype, 1, 1, req, NULL);
+    Py_INCREF(dtype);
+    np_fxy = (PyArrayObject*)PyArray_FromAny(ob_fxy, dtype, 2, 2, req, NULL);
+    Py_INCREF(itype);
+    np_boxes = (PyArrayObject*)PyArray_FromAny(ob_boxes, itype, 2, 2, req, NULL);
+    Py_INCREF(dtype);
+    np_scale = (PyArrayObject*)PyArray_FromAny(ob_scale, dtype, 1, 1, req, NULL);
+    if (!np_amp || !np_mean || !np_var || !np_kstart || !np_fxy ||
+        !np_boxes || !np_scale) {
+        ERR("amp, mean, var, kstart, fxy, boxes, or scale wasn't the type expected");
+        goto cleanup;
+    }
+    if (ob_masks != Py_None) {
+        Py_INCREF(btype);
+        np_masks = (PyArrayObject*)PyArray_FromAny(ob_masks, btype, 1, 1, req, NULL);
+        if (!np_masks) {
+            ERR("masks wasn't the type expected");
+            goto cleanup;
+        }
+    }
+    if (ob_image != Py_None) {
+        PyArray_Descr* imtype = NULL;
+        if (PyArray_Check(ob_image) &&
+            PyArray_TYPE((PyArrayObject*)ob_image) == NPY_FLOAT32)
+            imtype = PyArray_DescrFromType(NPY_FLOAT32);
+        else
+            imtype = PyArray_DescrFromType(NPY_DOUBLE);
+        np_image = (PyArrayObject*)PyArray_FromAny(ob_image, imtype, 2, 2, reqout, NULL);
+        if (!np_image) {
+            ERR("image wasn't the type expected");
+            goto cleanup;
+        }
+    }
+    if (ob_patches != Py_None) {
+        Py_INCREF(dtype);
+        np_patches = (PyArrayObject*)PyArray_FromAny(ob_patches, dtype, 1, 1, reqout, NULL);
+    }
+    if (ob_xderiv != Py_None) {
+        Py_INCREF(dtype);
+        np_xderiv = (PyArrayObject*)PyArray_FromAny(ob_xderiv, dtype, 1, 1, reqout, NULL);
+    }
+    if (ob_yderiv != Py_None) {
+        Py_INCREF(dtype);
+        np_yderiv = (PyArrayObject*)PyArray_FromAny(ob_yderiv, dtype, 1, 1, reqout, NULL);
+    }
+    if (((ob_patches != Py_None) && !np_patches) ||
+        ((ob_xderiv != Py_None) && !np_xderiv) ||
+        ((ob_yderiv != Py_None) && !np_yderiv)) {
+        ERR("patches, xderiv, or yderiv wasn't the type expected");
+        goto cleanup;
+    }
+    if (!np_xderiv != !np_yderiv) {
+        ERR("xderiv and yderiv must both be given, or neither");
+        goto cleanup;
+    }
+
+    Ktot = PyArray_DIM(np_amp, 0);
+    N = PyArray_DIM(np_fxy, 0);
+    if ((PyArray_DIM(np_mean, 0) != Ktot) ||
+        (PyArray_DIM(np_mean, 1) != 2) ||
+        (PyArray_DIM(np_var, 0) != Ktot) ||
+        (PyArray_DIM(np_var, 1) != 2) ||
+        (PyArray_DIM(np_var, 2) != 2) ||
+        (PyArray_DIM(np_kstart, 0) != N+1) ||
+        (PyArray_DIM(np_fxy, 1) != 2) ||
+        (PyArray_DIM(np_boxes, 0) != N) ||
+        (PyArray_DIM(np_boxes, 1) != 4) ||
+        (PyArray_DIM(np_scale, 0) != N)) {
+        ERR("amp, mean, var, kstart, fxy, boxes, scale must be Ktot, Ktot x 2, Ktot x 2 x 2, N+1, N x 2, N x 4, N");
+        goto cleanup;
+    }
+
+    amp    = PyArray_DATA(np_amp);
+    mean   = PyArray_DATA(np_mean);
+    var    = PyArray_DATA(np_var);
+    kstart = PyArray_DATA(np_kstart);
+    fxy    = PyArray_DATA(np_fxy);
+    boxes  = PyArray_DATA(np_boxes);
+    scale  = PyArray_DATA(np_scale);
+
+    // Offsets of the sources in the packed arrays
+    pstart = malloc((N+1) * sizeof(npy_intp));
+    if (!pstart) {
+        ERR("failed to allocate %li offsets\n", (long)(N+1));
+        result = -2;
+        goto cleanup;
+    }
+    pstart[0] = 0;
+    for (i=0; i<N; i++) {
+        int* box = boxes + 4*i;
+        if (box[2] < 0 || box[3] < 0) {
+            ERR("box %i: negative size\n", (int)i);
+            goto cleanup;
+        }
+        if (kstart[i] < 0 || kstart[i] > kstart[i+1] || kstart[i+1] > Ktot) {
+            ERR("kstart[%i] = %i, %i: out of range\n", (int)i, kstart[i],
+                kstart[i+1]);
+            goto cleanup;
+        }
+        if (np_image &&
+            (box[0] < 0 || box[1] < 0 ||
+             box[0] + box[2] > PyArray_DIM(np_image, 1) ||
+             box[1] + box[3] > PyArray_DIM(np_image, 0))) {
+            ERR("box %i: (%i,%i) + (%i,%i) outside image\n", (int)i,
+                box[0], box[1], box[2], box[3]);
+            goto cleanup;
+        }
+        pstart[i+1] = pstart[i] + (npy_intp)box[2] * box[3];
+    }
+    NP = pstart[N];
+    if ((np_masks && PyArray_DIM(np_masks, 0) != NP) ||
+        (np_patches && PyArray_DIM(np_patches, 0) != NP) ||
+        (np_xderiv && PyArray_DIM(np_xderiv, 0) != NP) ||
+        (np_yderiv && PyArray_DIM(np_yderiv, 0) != NP)) {
+        ERR("masks, patches, xderiv, yderiv must have %li pixels\n", (long)NP);
+        goto cleanup;
+    }
+
+    if (np_masks)
+        masks = PyArray_DATA(np_masks);
+    if (np_xderiv)
+        xderiv = PyArray_DATA(np_xderiv);
+    if (np_yderiv)
+        yderiv = PyArray_DATA(np_yderiv);
+    if (np_patches)
+        patches = PyArray_DATA(np_patches);
+    else {
+        scratch = malloc(MAX(NP, 1) * sizeof(double));
+        if (!scratch) {
+            ERR("failed to allocate %li pixels\n", (long)NP);
+            result = -2;
+            goto cleanup;
+        }
+        patches = scratch;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    {
+#ifdef _OPENMP
+        int nt = (nthreads > 0) ? nthreads : omp_get_max_threads();
+#pragma omp parallel for schedule(dynamic) num_threads(nt)
+#endif
+        for (i=0; i<N; i++) {
+            int* box = boxes + 4*i;
+            npy_intp p0 = pstart[i];
+            int k0 = kstart[i];
+            gm_render_one(kstart[i+1] - k0, amp + k0, mean + 2*k0,
+                          var + 4*k0, fxy[2*i], fxy[2*i+1],
+                          box[0], box[1], box[2], box[3],
+                          masks ? masks + p0 : NULL, patches + p0,
+                          xderiv ? xderiv + p0 : NULL,
+                          yderiv ? yderiv + p0 : NULL);
+        }
+
+        if (np_image) {
+            int W = (int)PyArray_DIM(np_image, 1);
+            int isfloat = (PyArray_TYPE(np_image) == NPY_FLOAT32);
+            void* img = PyArray_DATA(np_image);
+            for (i=0; i<N; i++) {
+                int* box = boxes + 4*i;
+                double* p = patches + pstart[i];
+                double s = scale[i];
+                int dy, dx;
+                for (dy=0; dy<box[3]; dy++) {
+                    size_t off = (size_t)(box[1] + dy) * W + box[0];
+                    double* prow = p + (size_t)dy * box[2];
+                    if (isfloat) {
+                        float* row = (float*)img + off;
+                        for (dx=0; dx<box[2]; dx++)
+                            row[dx] += s * prow[dx];
+                    } else {
+                        double* row = (double*)img + off;
+                        for (dx=0; dx<box[2]; dx++)
+                            row[dx] += s * prow[dx];
+                    }
+                }
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+    result = 0;
+
+ cleanup:
+    free(pstart);
+    free(scratch);
+    if (np_image)
+        PyArray_ResolveWritebackIfCopy(np_image);
+    if (np_patches)
+        PyArray_ResolveWritebackIfCopy(np_patches);
+    if (np_xderiv)
+        PyArray_ResolveWritebackIfCopy(np_xderiv);
+    if (np_yderiv)
+        PyArray_ResolveWritebackIfCopy(np_yderiv);
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_kstart);
+    Py_XDECREF(np_fxy);
+    Py_XDECREF(np_boxes);
+    Py_XDECREF(np_masks);
+    Py_XDECREF(np_scale);
+    Py_XDECREF(np_image);
+    Py_XDECREF(np_patches);
+    Py_XDECREF(np_xderiv);
+    Py_XDECREF(np_yderiv);
+    Py_DECREF(dtype);
+    Py_DECREF(itype);
+    Py_DECREF(btype);
+    return result;
+}
@@ -79,10 +79,19 @@ class Image(MultiParams):
                               name=self.name,
                               time=time)
 
-    def subimage(self, x0, x1, y0, y1):
+    def subimage(self, x0, x1, y0, y1, copy=True):
+        '''
+        Returns an Image of the pixels [y0:y1, x0:x1] of this image,
+        with shifted calibration objects.  If *copy* is False, its data
+        and inverse-error arrays are views into this image's.
+        '''
         slc = (slice(y0, y1), slice(x0, x1))
-        subtim = Image(data=self.data[slc].copy(),
-                       inverr=self.inverr[slc].copy(),
+        data = self.data[slc]
+        inverr = self.inverr[slc]
+        if copy:
+            data = data.copy()
+            inverr = inverr.copy()
+        subtim = Image(data=data, inverr=inverr,
                        wcs=self.wcs.shifted(x0, y0),
                        psf=self.psf.getShifted(x0, y0),
                        sky=self.sky.shifted(x0, y0),
@@ -0,0 +1,233 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`lbfgsb_optimizer.py`
+=====================
+
+An `Optimizer` that maximizes the log-probability with scipy's
+L-BFGS-B quasi-Newton method, using its exact gradient.
+'''
+from __future__ import print_function
+import math
+
+import numpy as np
+
+from tractor.engine import logverb
+from tractor.lsqr_optimizer import LsqrOptimizer
+from tractor.utils import sumsq
+
+
+class LbfgsbOptimizer(LsqrOptimizer):
+    '''
+    Maximizes the log-probability with L-BFGS-B.
+
+    Each evaluation computes the log-probability and its gradient in
+    one pass: the gradient of the log-likelihood is J^T chi, with J
+    the (inverse-error weighted) model derivatives from
+    `Tractor.getDerivs`, plus the gradient of the priors from
+    `getLogPriorDerivatives`.  No matrix is formed or solved, so the
+    cost per iteration is linear in the number of parameters -- useful
+    for blobs with hundreds of parameters.
+
+    Parameters are bounded by their `getLowerBounds` and
+    `getUpperBounds`, and, within each call to `optimize`, by their
+    `getMaxStep` (as in `ConstrainedOptimizer`); `optimize_loop`
+    re-runs L-BFGS-B until it converges away from the step limits.
+
+    Variances and forced photometry use the `LsqrOptimizer` methods.
+    '''
+
+    def __init__(self, hessian_terms=10, maxiter=100):
+        '''
+        *hessian_terms*: number of corrections L-BFGS-B uses to
+        approximate the Hessian.
+
+        *maxiter*: maximum number of L-BFGS-B iterations per call to
+        `optimize`.
+        '''
+        super(LbfgsbOptimizer, self).__init__()
+        self.hessian_terms = hessian_terms
+        self.maxiter = maxiter
+        self.stepLimited = False
+        self.hit_limit = False
+        self.last_step_hit_limit = False
+        self.converged = False
+
+    def getLogProbGradient(self, tractor, priors=True):
+        '''
+        Returns (log-probability, gradient with respect to the thawed
+        parameters of *tractor*) at the current parameters.  The
+        gradient is None if the log-probability is not finite.
+        '''
+        lnp = 0.
+        if priors:
+            lnp = tractor.getLogPrior()
+            if not np.isfinite(lnp):
+                return lnp, None
+        # d(lnL)/d(model) = chi * inverr
+        resids = {}
+        chisq = []
+        for img in tractor.getImages():
+            chi = tractor.getChiImage(img=img)
+            chisq.append(sumsq(chi))
+            chi *= img.getInvError()
+            resids[img] = chi
+        lnp += -0.5 * math.fsum(chisq)
+        if not np.isfinite(lnp):
+            return lnp, None
+
+        allderivs = tractor.getDerivs()
+        grad = np.zeros(len(allderivs))
+        for i, derivs in enumerate(allderivs):
+            for deriv, img in derivs:
+                H, W = img.shape
+                if not deriv.clipTo(W, H):
+                    continue
+                r = resids[img][deriv.getSlice(img)]
+                grad[i] += np.sum(deriv.patch * r, dtype=np.float64)
+
+        if priors:
+            X = tractor.getLogPriorDerivatives()
+            if X is not None:
+                # "chi-like" form: log-prior = -0.5 |b - A dp|^2
+                rA, cA, vA, pb, mub = X
+                if len(pb):
+                    b = np.hstack(pb)
+                    for r, c, v in zip(rA, cA, vA):
+                        grad[c] += np.dot(v, b[r])
+        return lnp, grad
+
+    def optimize(self, tractor, priors=True, shared_params=True,
+                 variance=False, just_variance=False, maxiter=None, **nil):
+        '''
+        Runs L-BFGS-B, within the parameters' bounds and step limits.
+
+        Returns (delta-logprob, parameter update X, 1.), plus the
+        variance if *variance*; or just the variance if
+        *just_variance*.
+        '''
+        var = None
+        if variance or just_variance:
+            allderivs = tractor.getDerivs()
+            X = self.getUpdateDirection(tractor, allderivs, priors=priors,
+                                        shared_params=shared_params,
+                                        variance=True)
+            if len(X) == 0:
+                var = None
+            else:
+                X, var = X
+            if just_variance:
+                return var
+
+        R = self._optimize(tractor, priors=priors,
+                           shared_params=shared_params, maxiter=maxiter)
+        if variance:
+            return R + (var,)
+        return R
+
+    def _optimize(self, tractor, priors=True, shared_params=True,
+                  maxiter=None):
+        from scipy.optimize import fmin_l_bfgs_b
+
+        if maxiter is None:
+            maxiter = self.maxiter
+        p0 = np.array(tractor.getParams())
+        N = len(p0)
+        self.converged = True
+        if N == 0:
+            return 0., np.zeros(0), 0.
+
+        # Optimize the unique parameters (x), scaled by their step sizes;
+        # "I" maps them back to the (possibly shared) thawed parameters.
+        if shared_params:
+            tractor.setParams(np.arange(N))
+            p1 = tractor.getParams()
+            tractor.setParams(p0)
+            U, J, I = np.unique(p1, return_index=True, return_inverse=True)
+        else:
+            J = I = np.arange(N)
+        scales = np.abs(np.array(tractor.getStepSizes(), float)[J])
+        scales[scales == 0] = 1.
+        x0 = p0[J] / scales
+
+        lowers = tractor.getLowerBounds()
+        uppers = tractor.getUpperBounds()
+        maxsteps = tractor.getMaxStep()
+        bounds = []
+        steplimits = []
+        for j, s in zip(J, scales):
+            lo, hi = lowers[j], uppers[j]
+            m = maxsteps[j]
+            steplo = stephi = False
+            if m is not None:
+                if lo is None or p0[j] - m > lo:
+                    lo = p0[j] - m
+                    steplo = True
+                if hi is None or p0[j] + m < hi:
+                    hi = p0[j] + m
+                    stephi = True
+            bounds.append((None if lo is None else lo / s,
+                           None if hi is None else hi / s))
+            steplimits.append((steplo, stephi))
+
+        lnp0 = tractor.getLogProb()
+
+        def objective(x):
+            tractor.setParams((x * scales)[I])
+            lnp, grad = self.getLogProbGradient(tractor, priors=priors)
+            if grad is None:
+                return np.inf, np.zeros(len(x))
+            grad = np.bincount(I, weights=grad, minlength=len(x)) * scales
+            # (relative to lnp0, for numerical precision)
+            return -(lnp - lnp0), -grad
+
+        x1, f1, info = fmin_l_bfgs_b(objective, x0, bounds=bounds,
+                                     m=self.hessian_terms, maxiter=maxiter)
+        logverb('L-BFGS-B:', info['nit'], 'iterations,', info['funcalls'],
+                'evaluations:', info['task'])
+        self.converged = (info['warnflag'] == 0)
+
+        p1 = (x1 * scales)[I]
+        tractor.setParams(p1)
+        lnp1 = tractor.getLogProb()
+        if not (lnp1 > lnp0):
+            tractor.setParams(p0)
+            self.stepLimited = False
+            return 0., np.zeros(N), 0.
+
+        # Did we stop against a bound?
+        self.stepLimited = False
+        self.last_step_hit_limit = False
+        for x, (lo, hi), (steplo, stephi) in zip(x1, bounds, steplimits):
+            for b, steplim in [(lo, steplo), (hi, stephi)]:
+                if b is None or abs(x - b) > 1e-8 * max(1., abs(b)):
+                    continue
+                if steplim:
+                    self.stepLimited = True
+                else:
+                    self.last_step_hit_limit = True
+                    self.hit_limit = True
+        return lnp1 - lnp0, p1 - p0, 1.
+
+    def optimize_loop(self, tractor, dchisq=0., steps=50,
+                      dchisq_limited=1e-6, **kwargs):
+        R = {}
+        self.hit_limit = False
+        self.last_step_hit_limit = False
+        converged = False
+        for step in range(steps):
+            self.stepLimited = False
+            dlnp, X, alpha = self.optimize(tractor, **kwargs)
+            # (each step runs L-BFGS-B to convergence, unless it
+            # reaches a step limit or the iteration limit)
+            if not self.stepLimited and (self.converged or dlnp <= dchisq):
+                converged = True
+                break
+            if self.stepLimited and dlnp <= dchisq_limited:
+                converged = True
+                break
+        R.update(steps=step, converged=converged)
+        R.update(hit_limit=self.last_step_hit_limit,
+                 ever_hit_limit=self.hit_limit)
+        return R
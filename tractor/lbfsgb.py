@@ -1,19 +1,31 @@
 from __future__ import print_function
+import numpy as np
 
 
 class TractorLBFGSBMixin(object):
     def optimize_lbfgsb(self, hessian_terms=10, plotfn=None):
+        '''
+        Minimizes with L-BFGS-B, with the exact gradient from
+        `LbfgsbOptimizer.getLogProbGradient`.  (See also
+        `LbfgsbOptimizer`, which plugs in as the Tractor's optimizer.)
+        '''
+        from tractor.lbfgsb_optimizer import LbfgsbOptimizer
+        opt = LbfgsbOptimizer()
 
         XX = []
         OO = []
 
         def objective(x, tractor, stepsizes, lnp0):
-            res = lnp0 - tractor(x * stepsizes)
+            tractor.setParams(x * stepsizes)
+            lnp, grad = opt.getLogProbGradient(tractor)
+            res = lnp0 - lnp
             print('LBFGSB objective:', res)
             if plotfn:
                 XX.append(x.copy())
                 OO.append(res)
-            return res
+            if grad is None:
+                return res, np.zeros(len(x))
+            return res, -grad * stepsizes
 
         from scipy.optimize import fmin_l_bfgs_b
 
@@ -26,8 +38,7 @@ class TractorLBFGSBMixin(object):
         print('Calling L-BFGS-B ...')
         X = fmin_l_bfgs_b(objective, p0 / stepsizes, fprime=None,
                           args=(self, stepsizes, lnp0),
-                          approx_grad=True, bounds=None, m=hessian_terms,
-                          epsilon=1e-8, iprint=0)
+                          bounds=None, m=hessian_terms)
         p1, lnp1, d = X
         print(d)
         print('lnp0:', lnp0)
@@ -3,7 +3,7 @@ import numpy as np
 from astrometry.util.ttime import Time
 from tractor.engine import logverb, isverbose, logmsg
 from tractor.optimize import Optimizer
-from tractor.utils import listmax
+from tractor.utils import listmax, sumsq
 
 
 class LsqrOptimizer(Optimizer):
@@ -246,7 +246,7 @@ class LsqrOptimizer(Optimizer):
         chis = []
         for nil, nil, nil, chi, roi in ims:
             chis.append(chi)
-            chisq += (chi.astype(np.float64)**2).sum()
+            chisq += sumsq(chi)
         lnp += -0.5 * chisq
         return lnp, chis, ims
 
@@ -264,7 +264,6 @@ class LsqrOptimizer(Optimizer):
         #   for (p,im) in d:
         #       print('patch mean', np.mean(p.patch))
         #logverb('Finding optimal update direction...')
-        #t0 = Time()
         X = self.getUpdateDirection(tractor, allderivs, damp=damp,
                                     priors=priors,
                                     scale_columns=scale_columns,
@@ -287,8 +286,12 @@ class LsqrOptimizer(Optimizer):
             return 0, X, 0.
         #logverb('X: len', len(X), '; non-zero entries:', np.count_nonzero(X))
         logverb('Finding optimal step size...')
-        #t0 = Time()
+        prof = self._getProfiler(tractor)
+        if prof is not None:
+            t0 = prof.start()
         (dlogprob, alpha) = self.tryUpdates(tractor, X, alphas=alphas)
+        if prof is not None:
+            prof.stop(t0, 'linesearch')
         #tstep = Time() - t0
         #logverb('Finished opt2.')
         #logverb('  alpha =', alpha)
@@ -302,13 +305,15 @@ class LsqrOptimizer(Optimizer):
 
     def optimize_loop(self, tractor, dchisq=0., steps=50, **kwargs):
         R = {}
+        converged = False
         for step in range(steps):
             dlnp, X, alpha = self.optimize(tractor, **kwargs)
             # print('Opt step: dlnp', dlnp,
             #      ', '.join([str(src) for src in tractor.getCatalog()]))
             if dlnp <= dchisq:
+                converged = True
                 break
-        R.update(steps=step)
+        R.update(steps=step, converged=converged)
         return R
 
     def getUpdateDirection(self, tractor, allderivs, damp=0., priors=True,
@@ -348,6 +353,10 @@ class LsqrOptimizer(Optimizer):
         # Parameters to optimize go in the columns of matrix A
         # Pixels go in the rows.
 
+        prof = self._getProfiler(tractor)
+        if prof is not None:
+            t0 = prof.start()
+
         if shared_params:
             # Find shared parameters
             p0 = tractor.getParams()
@@ -423,7 +432,7 @@ class LsqrOptimizer(Optimizer):
             rows = np.hstack(RR)
             VV = np.hstack(VV)
             WW = np.hstack(WW)
-            vals = VV * WW
+            vals = (VV * WW).astype(tractor.modtype, copy=False)
 
             # shouldn't be necessary since we check len(nz)>0 above
             # if len(vals) == 0:
@@ -442,7 +451,7 @@ class LsqrOptimizer(Optimizer):
             rows = rows[I]
             vals = vals[I]
             # L2 norm
-            scale = np.sqrt(np.dot(vals,vals))
+            scale = np.sqrt(sumsq(vals))
             colscales[col] = scale
             if scales_only:
                 continue
@@ -556,7 +565,7 @@ class LsqrOptimizer(Optimizer):
         from scipy.sparse import csr_matrix
         from scipy.sparse.linalg import lsqr
 
-        spvals = np.hstack(spvals)
+        spvals = np.hstack(spvals).astype(tractor.modtype, copy=False)
         if not np.all(np.isfinite(spvals)):
             print('Warning: infinite derivatives; bailing out')
             return None
@@ -599,6 +608,10 @@ class LsqrOptimizer(Optimizer):
         if get_A_matrix:
             return A
 
+        if prof is not None:
+            prof.stop(t0, 'matrix')
+            t0 = prof.start()
+
         lsqropts = dict(show=isverbose(), damp=damp)
 
         # Run lsqr()
@@ -621,6 +634,8 @@ class LsqrOptimizer(Optimizer):
             bail = True
         # finally:
         np.seterr(**oldsettings)
+        if prof is not None:
+            prof.stop(t0, 'solve')
 
         del A
         del b
@@ -7,7 +7,12 @@
 #include <numpy/arrayobject.h>
 #include <math.h>
 #include <assert.h>
+#include <string.h>
+#include <stdint.h>
 #include <sys/param.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 /*
  static int n_exp = 0;
@@ -493,6 +498,152 @@ bailout:
     return rtn;
 }
 
+static int c_gauss_2d_psf_derivs(int x0, int x1, int y0, int y1,
+                                 PyObject* ob_gamp, PyObject* ob_gmean,
+                                 PyObject* ob_gvar,
+                                 PyObject* ob_pamp, PyObject* ob_pmean,
+                                 PyObject* ob_pvar,
+                                 PyObject* ob_derivs) {
+    /*
+     Derivatives of the (unmasked) rendering of a source mixture
+     (gamp, gmean, gvar) -- in pixel space, with counts folded into
+     gamp -- convolved by a PSF mixture (pamp, pmean, pvar; K
+     components), with respect to the PSF parameters, on the grid
+     [x0,x1) x [y0,y1).
+
+     Adds to "derivs", (6K, NY, NX), in the parameter order of
+     MogParams: amp_k (K), (meanx_k, meany_k) (2K),
+     (varxx_k, varyy_k, varxy_k) (3K).
+     */
+    int i, k, NG, K;
+    const int D = 2;
+    double *gamp, *gmean, *gvar, *pamp, *pmean, *pvar, *derivs;
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+    PyArrayObject *np_gamp=NULL, *np_gmean=NULL, *np_gvar=NULL;
+    PyArrayObject *np_pamp=NULL, *np_pmean=NULL, *np_pvar=NULL;
+    PyArrayObject *np_derivs=NULL;
+    int rtn = -1;
+    int NX = x1 - x0;
+    int NY = y1 - y0;
+    int npix = NX * NY;
+
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    np_gamp   = (PyArrayObject*)PyArray_FromAny(ob_gamp,  dtype, 1, 1, req, NULL);
+    np_gmean  = (PyArrayObject*)PyArray_FromAny(ob_gmean, dtype, 2, 2, req, NULL);
+    np_gvar   = (PyArrayObject*)PyArray_FromAny(ob_gvar,  dtype, 3, 3, req, NULL);
+    np_pamp   = (PyArrayObject*)PyArray_FromAny(ob_pamp,  dtype, 1, 1, req, NULL);
+    np_pmean  = (PyArrayObject*)PyArray_FromAny(ob_pmean, dtype, 2, 2, req, NULL);
+    np_pvar   = (PyArrayObject*)PyArray_FromAny(ob_pvar,  dtype, 3, 3, req, NULL);
+    np_derivs = (PyArrayObject*)PyArray_FromAny(ob_derivs, dtype, 3, 3, reqout, NULL);
+
+    if (!(np_gamp && np_gmean && np_gvar && np_pamp && np_pmean && np_pvar &&
+          np_derivs)) {
+        ERR("c_gauss_2d_psf_derivs: inputs weren't the types expected");
+        goto bailout;
+    }
+    NG = (int)PyArray_DIM(np_gamp, 0);
+    K  = (int)PyArray_DIM(np_pamp, 0);
+    if ((PyArray_DIM(np_gmean, 0) != NG) || (PyArray_DIM(np_gmean, 1) != D) ||
+        (PyArray_DIM(np_gvar, 0) != NG) || (PyArray_DIM(np_gvar, 1) != D) ||
+        (PyArray_DIM(np_gvar, 2) != D)) {
+        ERR("gmean, gvar must be NG x D, NG x D x D");
+        goto bailout;
+    }
+    if ((PyArray_DIM(np_pmean, 0) != K) || (PyArray_DIM(np_pmean, 1) != D) ||
+        (PyArray_DIM(np_pvar, 0) != K) || (PyArray_DIM(np_pvar, 1) != D) ||
+        (PyArray_DIM(np_pvar, 2) != D)) {
+        ERR("pmean, pvar must be K x D, K x D x D");
+        goto bailout;
+    }
+    if ((PyArray_DIM(np_derivs, 0) != 6*K) ||
+        (PyArray_DIM(np_derivs, 1) != NY) ||
+        (PyArray_DIM(np_derivs, 2) != NX)) {
+        ERR("derivs must be 6K x NY x NX");
+        goto bailout;
+    }
+
+    gamp   = PyArray_DATA(np_gamp);
+    gmean  = PyArray_DATA(np_gmean);
+    gvar   = PyArray_DATA(np_gvar);
+    pamp   = PyArray_DATA(np_pamp);
+    pmean  = PyArray_DATA(np_pmean);
+    pvar   = PyArray_DATA(np_pvar);
+    derivs = PyArray_DATA(np_derivs);
+
+    for (k=0; k<K; k++) {
+        double* damp = derivs + (size_t)k * npix;
+        double* dmx  = derivs + (size_t)(K + 2*k    ) * npix;
+        double* dmy  = derivs + (size_t)(K + 2*k + 1) * npix;
+        double* dvxx = derivs + (size_t)(3*K + 3*k    ) * npix;
+        double* dvyy = derivs + (size_t)(3*K + 3*k + 1) * npix;
+        double* dvxy = derivs + (size_t)(3*K + 3*k + 2) * npix;
+        for (i=0; i<NG; i++) {
+            // the convolved component
+            double* GV = gvar + i*D*D;
+            double* PV = pvar + k*D*D;
+            double vxx = GV[0] + PV[0];
+            double vxy = GV[1] + PV[1];
+            double vyy = GV[3] + PV[3];
+            double mx = gmean[i*D+0] + pmean[k*D+0];
+            double my = gmean[i*D+1] + pmean[k*D+1];
+            double det = vxx*vyy - vxy*vxy;
+            double ia, ib, ic, norm;
+            int ix, iy, j;
+            if (!(det > 0))
+                continue;
+            // inverse variance
+            ia =  vyy / det;
+            ib = -vxy / det;
+            ic =  vxx / det;
+            norm = 1. / (2. * M_PI * sqrt(det));
+            j = 0;
+            for (iy=y0; iy<y1; iy++) {
+                double dy = iy - my;
+                for (ix=x0; ix<x1; ix++, j++) {
+                    double dx = ix - mx;
+                    double ux = ia * dx + ib * dy;
+                    double uy = ib * dx + ic * dy;
+                    double dsq = dx * ux + dy * uy;
+                    double G, A;
+                    if (dsq >= 100)
+                        continue;
+                    G = gamp[i] * norm * exp(-0.5 * dsq);
+                    A = pamp[k] * G;
+                    damp[j] += G;
+                    // d/d(mean) of N(x; mean, V) = N * V^-1 (x - mean)
+                    dmx[j] += A * ux;
+                    dmy[j] += A * uy;
+                    // d/d(V) = N/2 * (V^-1 (x-mean)(x-mean)^T V^-1 - V^-1);
+                    // "varxy" sets both off-diagonal elements.
+                    dvxx[j] += 0.5 * A * (ux * ux - ia);
+                    dvyy[j] += 0.5 * A * (uy * uy - ic);
+                    dvxy[j] += A * (ux * uy - ib);
+                }
+            }
+        }
+    }
+    rtn = 0;
+
+bailout:
+    Py_XDECREF(np_gamp);
+    Py_XDECREF(np_gmean);
+    Py_XDECREF(np_gvar);
+    Py_XDECREF(np_pamp);
+    Py_XDECREF(np_pmean);
+    Py_XDECREF(np_pvar);
+    if (np_derivs)
+        PyArray_ResolveWritebackIfCopy(np_derivs);
+    Py_XDECREF(np_derivs);
+    return rtn;
+}
+
 static int c_gauss_2d_approx(int x0, int x1, int y0, int y1,
                              double fx, double fy,
                              double minval,
@@ -1091,5 +1242,22 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
 #include "gauss_masked.c"
 
 
+static int c_gauss_2d_multi(PyObject* ob_amp,
+                            PyObject* ob_mean,
+                            PyObject* ob_var,
+                            PyObject* ob_kstart,
+                            PyObject* ob_fxy,
+                            PyObject* ob_boxes,
+                            PyObject* ob_masks,
+                            PyObject* ob_scale,
+                            PyObject* ob_image,
+                            PyObject* ob_patches,
+                            PyObject* ob_xderiv,
+                            PyObject* ob_yderiv,
+                            int nthreads);
+
+#include "gauss_multi.c"
+
+
 %}
 
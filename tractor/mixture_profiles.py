@@ -7,10 +7,8 @@ if __name__ == '__main__':
     import matplotlib.cm as cm
 import numpy as np
 
-try:
-    from tractor import mp_fourier
-except:
-    mp_fourier = None
+# the C extension, imported on first use; see _get_mp_fourier
+mp_fourier = -1
 
 from tractor.patch import Patch
 
@@ -43,6 +41,16 @@ def get_exp_mixture():
 def get_dev_mixture():
     return MixtureOfGaussians(dev_amp, np.zeros((dev_amp.size, 2)), dev_var)
 
+def _get_mp_fourier():
+    global mp_fourier
+    if mp_fourier == -1:
+        try:
+            from tractor import mp_fourier
+        except:
+            mp_fourier = None
+    return mp_fourier
+
+
 class MixtureOfGaussians(object):
 
     # symmetrize is an unnecessary step in principle, but in practice?
@@ -210,7 +218,7 @@ class MixtureOfGaussians(object):
         If zero_mean is *True*, ignore the *mean* of this mixture of Gaussians.
         
         '''
-        if mp_fourier and use_mp_fourier and zero_mean:
+        if use_mp_fourier and zero_mean and _get_mp_fourier():
             f = np.zeros((len(w), len(v)), np.float64)
             mp_fourier.gaussian_fourier_transform_zero_mean(
                 self.amp, self.var, v, w, f)
@@ -352,9 +360,9 @@ class MixtureOfGaussians(object):
 
         rtn = c_gauss_2d_masked(int(x0), int(y0), int(w), int(h),
                                 float(fx), float(fy),
-                                self.amp.astype(np.float32),
-                                self.mean.astype(np.float32),
-                                self.var.astype(np.float32),
+                                np.ascontiguousarray(self.amp, np.float32),
+                                np.ascontiguousarray(self.mean, np.float32),
+                                np.ascontiguousarray(self.var, np.float32),
                                 result, xderiv, yderiv, mask)
 
         # print('gauss_2d_masked returned.')
@@ -461,6 +469,87 @@ def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False):
     return p
 
 
+def render_mixtures(mixtures, offsets, boxes, masks=None, scales=None,
+                    image=None, patches=True, derivs=False, threads=0):
+    '''
+    Renders many 2-d mixtures in one call to the C extension (which
+    runs over the sources in parallel when built with OpenMP).
+
+    `mixtures`: list of N MixtureOfGaussians
+    `offsets`: N x 2: (fx, fy) position offset of each mixture
+    `boxes`: N ModelMask objects (or (x0, y0, w, h) tuples): the pixels
+        in which to render each mixture
+    `masks`: None, or a list of N boolean arrays (or None) of the boxes'
+        shapes: pixels to render; the others are zero
+    `scales`: factors by which to multiply the models added to *image*
+    `image`: if not None, the (float32 or float64) image to add the
+        scaled models into; the boxes must lie within it
+    `patches`: return the (unscaled) models, as a list of Patches?
+    `derivs`: also return lists of Patches: the models' derivatives
+        with respect to the offsets.
+    `threads`: number of threads; 0 for the OpenMP default.
+
+    Returns: the list of Patches, or None if not *patches*; if
+    *derivs*, a tuple (patches, x derivatives, y derivatives).
+    '''
+    from tractor.mix import c_gauss_2d_multi
+
+    N = len(mixtures)
+    kstart = np.zeros(N + 1, np.int32)
+    kstart[1:] = np.cumsum([mix.K for mix in mixtures])
+    if N:
+        amp = np.hstack([mix.amp for mix in mixtures]).astype(float)
+        mean = np.vstack([mix.mean for mix in mixtures]).astype(float)
+        var = np.vstack([mix.var for mix in mixtures]).astype(float)
+    else:
+        amp = np.zeros(0)
+        mean = np.zeros((0, 2))
+        var = np.zeros((0, 2, 2))
+    B = np.zeros((N, 4), np.int32)
+    for i, b in enumerate(boxes):
+        if isinstance(b, tuple):
+            B[i, :] = b
+        else:
+            B[i, :] = (b.x0, b.y0, b.w, b.h)
+    pstart = np.zeros(N + 1, int)
+    pstart[1:] = np.cumsum(B[:, 2] * B[:, 3])
+    NP = pstart[-1]
+
+    allmasks = None
+    if masks is not None and any([m is not None for m in masks]):
+        allmasks = np.ones(NP, bool)
+        for i, m in enumerate(masks):
+            if m is not None:
+                allmasks[pstart[i]: pstart[i + 1]] = m.ravel()
+    if scales is None:
+        scales = np.ones(N)
+    out = xd = yd = None
+    if patches or derivs:
+        out = np.empty(NP)
+    if derivs:
+        xd = np.empty(NP)
+        yd = np.empty(NP)
+    rtn = c_gauss_2d_multi(amp, mean, var, kstart,
+                           np.array(offsets, float).reshape((N, 2)), B,
+                           allmasks, np.array(scales, float), image,
+                           out, xd, yd, int(threads))
+    if rtn == -2:
+        raise MemoryError('c_gauss_2d_multi: failed to allocate memory')
+    if rtn != 0:
+        raise RuntimeError('c_gauss_2d_multi failed')
+
+    def split(arr):
+        return [Patch(x0, y0, arr[p0: p1].reshape((h, w)))
+                for (x0, y0, w, h), p0, p1 in zip(B, pstart[:-1], pstart[1:])]
+
+    res = None
+    if patches or derivs:
+        res = split(out)
+    if derivs:
+        return res, split(xd), split(yd)
+    return res
+
+
 def model_to_patch(model, scale, posmin, posmax):
     xl = np.arange(posmin[0], posmax[0] + 1., 1.)
     nx = xl.size
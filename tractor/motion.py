@@ -55,6 +55,102 @@ class PMRaDec(RaDecPos):
     #    return [None]*self.numberOfParams()
 
 
+_parallax_dxyz = None
+
+
+def _getParallaxVectors():
+    '''
+    Returns the change in unit-sphere xyz per arcsec of parallax when
+    the Sun is at theta = 0 and theta = pi/2.
+    '''
+    global _parallax_dxyz
+    if _parallax_dxyz is None:
+        from astrometry.util.starutil_numpy import radectoxyz, arcsecperrad, axistilt
+        # rd2xyz(0,0) is a unit vector; 1/arcsecperrad is (a good
+        # approximation to) the distance on the unit sphere spanned by
+        # an angle of 1 arcsec.  It's about 1e-5, so adding it to a
+        # unit vector gives (very nearly) the displaced direction.
+        # - imprecise angle of obliquity
+        # - implicitly assumes circular orbit
+        dxyz1 = radectoxyz(0., 0.)[0] / arcsecperrad
+        dxyz2 = radectoxyz(90., axistilt)[0] / arcsecperrad
+        _parallax_dxyz = (dxyz1, dxyz2)
+    return _parallax_dxyz
+
+
+def getMovingPositions(ra, dec, pmra, pmdec, parallax, dt, suntheta,
+                       derivs=False):
+    '''
+    Computes the positions of moving point sources, vectorized: the
+    arguments are scalars or numpy arrays that broadcast together,
+    eg, one source at many epochs or many sources at one epoch.
+
+    *ra*, *dec*: reference position, in degrees
+    *pmra*, *pmdec*: proper motion, in degrees per year
+    *parallax*: in arcsec
+    *dt*: time since the reference epoch, in years
+    *suntheta*: the Sun angle (see `TAITime.getSunTheta`), in radians
+
+    Returns (ra, dec) arrays in degrees; if *derivs*, also an array
+    with an extra two dimensions, (..., 2, 5): the derivatives of
+    (ra, dec) with respect to (ra, dec, pmra, pmdec, parallax).
+    '''
+    dxyz1, dxyz2 = _getParallaxVectors()
+    ra, dec, pmra, pmdec, parallax, dt, suntheta = np.broadcast_arrays(
+        *[np.asarray(a, dtype=float)
+          for a in (ra, dec, pmra, pmdec, parallax, dt, suntheta)])
+    r = np.deg2rad(ra + dt * pmra)
+    d = np.deg2rad(dec + dt * pmdec)
+    cosr, sinr = np.cos(r), np.sin(r)
+    cosd, sind = np.cos(d), np.sin(d)
+    cost, sint = np.cos(suntheta), np.sin(suntheta)
+    # d(xyz)/d(parallax)
+    ex = dxyz1[0] * cost + dxyz2[0] * sint
+    ey = dxyz1[1] * cost + dxyz2[1] * sint
+    ez = dxyz1[2] * cost + dxyz2[2] * sint
+    x = cosd * cosr + parallax * ex
+    y = cosd * sinr + parallax * ey
+    z = sind + parallax * ez
+    # (x,y,z) is not quite a unit vector; atan2 takes care of that.
+    rho2 = x**2 + y**2
+    rho = np.sqrt(rho2)
+    rout = np.rad2deg(np.arctan2(y, x)) % 360.
+    dout = np.rad2deg(np.arctan2(z, rho))
+    if not derivs:
+        return rout, dout
+
+    n2 = rho2 + z**2
+    D = np.zeros(r.shape + (2, 5))
+    # d(xyz)/d(ra), d(xyz)/d(dec) [per radian], d(xyz)/d(parallax)
+    for k, (vx, vy, vz) in [(0, (-cosd * sinr, cosd * cosr, 0.)),
+                            (1, (-sind * cosr, -sind * sinr, cosd)),
+                            (4, (ex, ey, ez))]:
+        D[..., 0, k] = (x * vy - y * vx) / rho2
+        D[..., 1, k] = (rho2 * vz - z * (x * vx + y * vy)) / (rho * n2)
+    # ra,dec: degrees per degree; parallax: degrees per arcsec
+    D[..., :, 4] = np.rad2deg(D[..., :, 4])
+    # proper motions: degrees per (degree per year)
+    D[..., :, 2] = D[..., :, 0] * dt[..., np.newaxis]
+    D[..., :, 3] = D[..., :, 1] * dt[..., np.newaxis]
+    return rout, dout, D
+
+
+def getPositionsAtTime(srcs, t, derivs=False):
+    '''
+    Returns the positions of the MovingPointSources *srcs* at
+    `TAITime` *t*, as (ra, dec) arrays, plus derivatives if *derivs*;
+    see `getMovingPositions`.
+    '''
+    ra = np.array([src.pos.ra for src in srcs])
+    dec = np.array([src.pos.dec for src in srcs])
+    pmra = np.array([src.pm.pmra for src in srcs])
+    pmdec = np.array([src.pm.pmdec for src in srcs])
+    parallax = np.array([src.parallax.getValue() for src in srcs])
+    dt = np.array([src._getDt(t) for src in srcs])
+    return getMovingPositions(ra, dec, pmra, pmdec, parallax, dt,
+                              t.getSunTheta(), derivs=derivs)
+
+
 class MovingPointSource(PointSource):
     def __init__(self, pos, brightness, pm, parallax, epoch=0.):
         # Assume types...
@@ -81,39 +177,25 @@ class MovingPointSource(PointSource):
                 repr(self.brightness) + ', ' + repr(self.pm) + ', ' +
                 repr(self.parallax) + ')')
 
+    def _getDt(self, t):
+        return (t - self.epoch).toYears()
+
     def getPositionAtTime(self, t):
-        from astrometry.util.starutil_numpy import radectoxyz, arcsecperrad, axistilt, xyztoradec
-
-        dt = (t - self.epoch).toYears()
-        # Assume "pos" is an RaDecPos
-        p = self.pos + dt * self.pm
-        suntheta = t.getSunTheta()
-
-        # print 'dt', dt, 'pos', self.pos, 'pm', self.pm, 'dt*pm:', dt * self.pm
-        # print 'p0: (%.8f, %.8f)' % (self.pos.ra, self.pos.dec)
-        # print 'p1: (%.8f, %.8f)' % (p.ra, p.dec)
-
-        xyz = radectoxyz(p.ra, p.dec)
-        xyz = xyz[0]
-        # d(celestial coords)/d(parallax)
-        # - takes numerical derivatives when it could take analytic ones
-        # output is in [degrees / arcsec].  Yep.    Crazy but true.
-        # HACK: fmods dRA when it should do something continuous.
-        # rd2xyz(0,0) is a unit vector; 1/arcsecperrad is (a good approximation to)
-        # the distance on the unit sphere spanned by an angle of 1 arcsec.
-        # We take a step of that length and return the change in RA,Dec.
-        # It's about 1e-5 so we don't renormalize the xyz unit vector.
-        dxyz1 = radectoxyz(0., 0.) / arcsecperrad
-        dxyz1 = dxyz1[0]
-        # - imprecise angle of obliquity
-        # - implicitly assumes circular orbit
-        # output is in [degrees / arcsec].  Yep.    Crazy but true.
-        dxyz2 = radectoxyz(90., axistilt) / arcsecperrad
-        dxyz2 = dxyz2[0]
-        xyz += self.parallax.getValue() * (dxyz1 * np.cos(suntheta) +
-                                           dxyz2 * np.sin(suntheta))
-        r, d = xyztoradec(xyz)
-        return RaDecPos(r, d)
+        r, d = self.getPositionsAtTimes([t])
+        return RaDecPos(r[0], d[0])
+
+    def getPositionsAtTimes(self, times, derivs=False):
+        '''
+        Returns the positions of this source at each `TAITime` in
+        *times*, as (ra, dec) arrays, plus derivatives if *derivs*; see
+        `getMovingPositions`.
+        '''
+        dt = np.array([self._getDt(t) for t in times])
+        suntheta = np.array([t.getSunTheta() for t in times])
+        return getMovingPositions(self.pos.ra, self.pos.dec,
+                                  self.pm.pmra, self.pm.pmdec,
+                                  self.parallax.getValue(), dt, suntheta,
+                                  derivs=derivs)
 
     def getUnitFluxModelPatch(self, img, minval=0., modelMask=None, **kwargs):
         pos = self.getPositionAtTime(img.getTime())
@@ -126,67 +208,75 @@ class MovingPointSource(PointSource):
         '''
         MovingPointSource derivatives.
 
+        The position, proper motion and parallax derivatives are the
+        model's derivatives with respect to pixel position, times the
+        analytic derivatives of the position at the image's epoch (see
+        `getMovingPositions`), times the local WCS Jacobian.
+
         returns [ Patch, Patch, ... ] of length numberOfParams().
         '''
-
         t = img.getTime()
-        pos0 = self.getPositionAtTime(t)
-        (px0, py0) = img.getWcs().positionToPixel(pos0, self)
-        patch0 = img.getPsf().getPointSourcePatch(px0, py0, modelMask=modelMask)
+        wcs = img.getWcs()
+        psf = img.getPsf()
+        r, d, dpos = self.getPositionsAtTimes([t], derivs=True)
+        pos0 = RaDecPos(r[0], d[0])
+        dpos = dpos[0]
+        (px0, py0) = wcs.positionToPixel(pos0, self)
         counts0 = img.getPhotoCal().brightnessToCounts(self.brightness)
+
+        fitpos = not (self.isParamFrozen('pos') and self.isParamFrozen('pm')
+                      and self.isParamFrozen('parallax'))
+        patchdx, patchdy = None, None
+        if fitpos:
+            patches = psf.getPointSourcePatch(px0, py0, modelMask=modelMask,
+                                              derivs=True)
+            if isinstance(patches, tuple):
+                patch0, patchdx, patchdy = patches
+            else:
+                patch0 = patches
+        else:
+            patch0 = psf.getPointSourcePatch(px0, py0, modelMask=modelMask)
+        if patch0 is None:
+            return [None] * self.numberOfParams()
+
+        if fitpos:
+            if patchdx is None:
+                # Central differences in pixel space
+                h = 0.01
+                patchdx, patchdy = [
+                    (psf.getPointSourcePatch(px0 + dx, py0 + dy,
+                                             modelMask=modelMask) -
+                     psf.getPointSourcePatch(px0 - dx, py0 - dy,
+                                             modelMask=modelMask)) * (0.5 / h)
+                    for dx, dy in [(h, 0.), (0., h)]]
+            # d(pixel)/d(ra,dec), by central differences
+            dd = 1e-6
+            J = np.zeros((2, 2))
+            for j, (dr, ddec) in enumerate([(dd, 0.), (0., dd)]):
+                x1, y1 = wcs.positionToPixel(
+                    RaDecPos(pos0.ra + dr, pos0.dec + ddec), self)
+                x0, y0 = wcs.positionToPixel(
+                    RaDecPos(pos0.ra - dr, pos0.dec - ddec), self)
+                J[:, j] = [(x1 - x0) / (2. * dd), (y1 - y0) / (2. * dd)]
+            dpix = np.dot(J, dpos)
+
         derivs = []
 
-        # print 'MovingPointSource.getParamDerivs:'
-        # print 'initial pixel pos', px0, py0
-
-        # Position
-
-        # FIXME -- could just compute positional derivatives once and
-        # reuse them, but have to be careful about frozen-ness -- eg,
-        # if RA were frozen but not Dec.
-        # OR, could compute dx,dy and then use CD matrix to convert
-        # dpos to derivatives.
-        # pderivs = []
-        # if ((not self.isParamFrozen('pos')) or
-        #   (not self.isParamFrozen('pm')) or
-        #   (not self.isParamFrozen('parallax'))):
-        #
-        #   psteps = pos0.getStepSizes(img)
-        #   pvals = pos0.getParams()
-        #   for i,pstep in enumerate(psteps):
-        #       oldval = pos0.setParam(i, pvals[i] + pstep)
-        #       (px,py) = img.getWcs().positionToPixel(pos0, self)
-        #       patchx = img.getPsf().getPointSourcePatch(px, py)
-        #       pos0.setParam(i, oldval)
-        #       dx = (patchx - patch0) * (counts0 / pstep)
-        #       dx.setName('d(ptsrc)/d(pos%i)' % i)
-        #       pderivs.append(dx)
-        # if not self.isParamFrozen('pos'):
-        #   derivs.extend(pderivs)
-
-        def _add_posderivs(p, name):
-            # uses "globals": t, patch0, counts0
-            psteps = p.getStepSizes(img)
-            pvals = p.getParams()
-            for i, pstep in enumerate(psteps):
-                oldval = p.setParam(i, pvals[i] + pstep)
-                tpos = self.getPositionAtTime(t)
-                (px, py) = img.getWcs().positionToPixel(tpos, self)
-
-                # print 'stepping param', name, i, '-->', p, '--> pos', tpos, 'pix pos', px,py
-                patchx = img.getPsf().getPointSourcePatch(px, py, modelMask=modelMask)
-                p.setParam(i, oldval)
-                dx = (patchx - patch0) * (counts0 / pstep)
-                dx.setName('d(ptsrc)/d(%s%i)' % (name, i))
-                # print 'deriv', dx.patch.min(), dx.patch.max()
-                derivs.append(dx)
-
-        # print 'Finding RA,Dec derivatives'
+        def _add_posderivs(p, name, k0):
+            if hasattr(p, 'getThawedParamIndices'):
+                I = p.getThawedParamIndices()
+            else:
+                I = [0]
+            for i in I:
+                dx, dy = dpix[:, k0 + i]
+                deriv = (patchdx * dx + patchdy * dy) * counts0
+                deriv.setName('d(ptsrc)/d(%s%i)' % (name, i))
+                derivs.append(deriv)
+
         if not self.isParamFrozen('pos'):
-            _add_posderivs(self.pos, 'pos')
+            _add_posderivs(self.pos, 'pos', 0)
 
         # Brightness
-        # print 'Finding Brightness derivatives'
         if not self.isParamFrozen('brightness'):
             bsteps = self.brightness.getStepSizes(img)
             bvals = self.brightness.getParams()
@@ -198,17 +288,10 @@ class MovingPointSource(PointSource):
                 df.setName('d(ptsrc)/d(bright%i)' % i)
                 derivs.append(df)
 
-        # print 'Finding Proper Motion derivatives'
         if not self.isParamFrozen('pm'):
-            #   # ASSUME 'pm' is the same type as 'pos'
-            #   dt = (t - self.epoch).toYears()
-            #   for d in pderivs:
-            #       dd = d * dt
-            #       derivs.append(dd)
-            _add_posderivs(self.pm, 'pm')
-
-        # print 'Finding Parallax derivatives'
+            _add_posderivs(self.pm, 'pm', 2)
+
         if not self.isParamFrozen('parallax'):
-            _add_posderivs(self.parallax, 'parallax')
+            _add_posderivs(self.parallax, 'parallax', 4)
 
         return derivs
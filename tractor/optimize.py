@@ -5,6 +5,15 @@ from tractor.engine import logverb, OptResult, logmsg
 
 
 class Optimizer(object):
+    # see profiler.Profiler
+    profiler = None
+
+    def _getProfiler(self, tractor):
+        # The profiler attached to this optimizer, or else to *tractor*
+        if self.profiler is not None:
+            return self.profiler
+        return getattr(tractor, 'profiler', None)
+
     def optimize(self, tractor, alphas=None, damp=0, priors=True,
                  scale_columns=True, shared_params=True, variance=False,
                  just_variance=False):
@@ -55,10 +64,15 @@ class Optimizer(object):
         Nsourceparams = tractor.catalog.numberOfParams()
         srcs = list(tractor.catalog.getThawedSources())
 
+        prof = self._getProfiler(tractor)
+
         # Render unit-flux models for each source.
-        #t0 = Time()
+        if prof is not None:
+            t0 = prof.start()
         (umodels, umodtosource, umodsforsource
          ) = self._get_umodels(tractor, srcs, imgs, minsb, rois, **kwargs)
+        if prof is not None:
+            prof.stop(t0, 'umodels')
         for umods in umodels:
             assert(len(umods) == Nsourceparams)
         #tmods = Time() - t0
@@ -127,21 +141,25 @@ class Optimizer(object):
 
         if variance:
             # Inverse variance
-            #t0 = Time()
+            if prof is not None:
+                t0 = prof.start()
             result.IV = self._get_iv(sky, skyvariance, Nsky, skyderivs, Nsourceparams,
                                      imlist, umodels, scales)
-            #logverb('forced phot: variance:', Time() - t0)
+            if prof is not None:
+                prof.stop(t0, 'variance')
 
         imsBest = getattr(result, 'ims1', None)
         if fitstats and imsBest is None:
             print('Warning: fit stats not computed because imsBest is None')
             result.fitstats = None
         elif fitstats:
-            #t0 = Time()
+            if prof is not None:
+                t0 = prof.start()
             result.fitstats = self._get_fitstats(
                 tractor.catalog, imsBest, srcs, imlist, umodsforsource,
                 umodels, scales, nilcounts, extras=fitstat_extras)
-            #logverb('forced phot: fit stats:', Time() - t0)
+            if prof is not None:
+                prof.stop(t0, 'fitstats')
         return result
 
     def _get_umodels(self, tractor, srcs, imgs, minsb, rois, **kwargs):
@@ -329,7 +347,7 @@ class Optimizer(object):
                     if yhi is None or y0 + uh > yhi:
                         yhi = y0 + uh
                     # accumulate this unit-flux model into srcmod
-                    (um * counts).addTo(srcmod)
+                    um.addTo(srcmod, scale=counts)
                 # Divide by total flux, not flux within this image; sum <= 1.
                 if xlo is None or xhi is None or ylo is None or yhi is None:
                     continue
@@ -496,7 +514,7 @@ class Optimizer(object):
                 assert(np.isfinite(counts))
                 assert(np.all(np.isfinite(um.patch)))
                 # print 'Adding umod', um, 'with counts', counts, 'to mod', mod.shape
-                (um * counts).addTo(mod)
+                um.addTo(mod, scale=counts)
 
             ie = img.getInvError()
             im = img.getImage()
@@ -395,16 +395,24 @@ class Patch(object):
     def addTo(self, img, scale=1.):
         if self.patch is None:
             return
+        cdef int ih, iw, ph, pw, px0, py0, x0, y0, x1, y1
         (ih, iw) = img.shape
-        (ph, pw) = self.shape
-        (outx, inx) = get_overlapping_region(
-            self.x0, self.x0 + pw - 1, 0, iw - 1)
-        (outy, iny) = get_overlapping_region(
-            self.y0, self.y0 + ph - 1, 0, ih - 1)
-        if inx == [] or iny == []:
+        (ph, pw) = self.patch.shape
+        px0 = self.x0
+        py0 = self.y0
+        # overlapping region, in image coordinates
+        x0 = intmax(px0, 0)
+        y0 = intmax(py0, 0)
+        x1 = intmin(px0 + pw, iw)
+        y1 = intmin(py0 + ph, ih)
+        if x0 >= x1 or y0 >= y1:
             return
-        p = self.patch[iny, inx]
-        img[outy, outx] += p * scale
+        p = self.patch[y0 - py0: y1 - py0, x0 - px0: x1 - px0]
+        out = img[y0:y1, x0:x1]
+        if scale == 1.:
+            out += p
+        else:
+            out += p * scale
 
         # if False:
         #   tmpimg = np.zeros_like(img)
@@ -444,6 +452,7 @@ class Patch(object):
         if self.patch is not None:
             self.patch /= f
         return self
+    __itruediv__ = __idiv__
 
     # Implement *, / for numeric types
     def __mul__(self, f):
@@ -455,6 +464,7 @@ class Patch(object):
         if self.patch is None:
             return Patch(self.x0, self.y0, None)
         return Patch(self.x0, self.y0, self.patch / f)
+    __truediv__ = __div__
 
     def performArithmetic(self, other, opname, otype=float):
         assert(isinstance(other, Patch))
@@ -497,3 +507,26 @@ class Patch(object):
 
     def __sub__(self, other):
         return self.performArithmetic(other, '__isub__')
+
+    # Implement +=, -= in place when "other" lies within this patch
+    # (and the result would not lose precision); otherwise, as + and -,
+    # produce a new patch covering the union.
+    def performInPlace(self, other, opname):
+        assert(isinstance(other, Patch))
+        if (self.patch is not None and other.patch is not None and
+                other.x0 >= self.x0 and other.y0 >= self.y0 and
+                other.x1 <= self.x1 and other.y1 <= self.y1 and
+                np.result_type(self.patch, other.patch) == self.patch.dtype and
+                self.patch.flags.writeable):
+            (oh, ow) = other.patch.shape
+            sub = self.patch[other.y0 - self.y0: other.y0 - self.y0 + oh,
+                             other.x0 - self.x0: other.x0 - self.x0 + ow]
+            getattr(sub, opname)(other.patch)
+            return self
+        return self.performArithmetic(other, opname)
+
+    def __iadd__(self, other):
+        return self.performInPlace(other, '__iadd__')
+
+    def __isub__(self, other):
+        return self.performInPlace(other, '__isub__')
@@ -0,0 +1,167 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`profiler.py`
+=============
+
+Timing and call counts for the stages of the Tractor engine.
+
+A `Profiler` attached to a `Tractor` records the wall-clock and CPU
+time and the number of calls of each stage -- model rendering,
+derivatives, matrix assembly, the solve, line search, fit stats --
+broken down by source and by image where that makes sense::
+
+    with Profiler(tractor) as prof:
+        tractor.optimize_loop()
+    print(prof.format())
+    print(prof.format(by='source'))
+
+Attached to an `Optimizer` instead, only the optimizer's own stages
+are recorded.  Callers can time their own stages (eg, I/O) with
+`Profiler.stage`.  Stage times are inclusive: a stage that triggers
+another (eg, matrix assembly computing chi images, and so rendering)
+includes its time.
+
+When no profiler is attached, the engine pays one attribute lookup per
+instrumented call.
+'''
+from __future__ import print_function
+
+import time
+
+
+class _Stage(object):
+    # context manager returned by Profiler.stage
+    def __init__(self, prof, name, src, img):
+        self.prof = prof
+        self.name = name
+        self.src = src
+        self.img = img
+
+    def __enter__(self):
+        self.t0 = self.prof.start()
+        return self
+
+    def __exit__(self, *args):
+        self.prof.stop(self.t0, self.name, src=self.src, img=self.img)
+
+
+class Profiler(object):
+    '''
+    Records wall-clock time, CPU time and call counts per stage, and
+    per stage and source, and per stage and image.
+
+    *target*: a `Tractor` or `Optimizer` to attach to while the
+    profiler is used as a context manager; see `attach`.
+    '''
+    def __init__(self, target=None):
+        self.target = target
+        self.reset()
+
+    def reset(self):
+        '''
+        Discards all recorded timings.
+        '''
+        # stage -> [ncalls, wall, cpu]
+        self.stages = {}
+        # (stage, source) -> [ncalls, wall, cpu]
+        self.sources = {}
+        # (stage, image) -> [ncalls, wall, cpu]
+        self.images = {}
+
+    def attach(self, target):
+        '''
+        Starts recording the stages of *target*, a `Tractor` or
+        `Optimizer`.
+        '''
+        target.profiler = self
+
+    def detach(self, target):
+        '''
+        Stops recording the stages of *target*.
+        '''
+        if getattr(target, 'profiler', None) is self:
+            target.profiler = None
+
+    def __enter__(self):
+        if self.target is not None:
+            self.attach(self.target)
+        return self
+
+    def __exit__(self, *args):
+        if self.target is not None:
+            self.detach(self.target)
+
+    def start(self):
+        '''
+        Returns a token to be passed to `stop` at the end of a stage.
+        '''
+        return (time.perf_counter(), time.process_time())
+
+    def stop(self, t0, stage, src=None, img=None):
+        '''
+        Records one call of *stage*, started when `start` returned
+        *t0*, for source *src* and image *img* (if given).
+        '''
+        wall = time.perf_counter() - t0[0]
+        cpu = time.process_time() - t0[1]
+        keys = [(self.stages, stage)]
+        if src is not None:
+            keys.append((self.sources, (stage, src)))
+        if img is not None:
+            keys.append((self.images, (stage, img)))
+        for d, key in keys:
+            st = d.get(key, None)
+            if st is None:
+                d[key] = [1, wall, cpu]
+            else:
+                st[0] += 1
+                st[1] += wall
+                st[2] += cpu
+
+    def stage(self, name, src=None, img=None):
+        '''
+        Returns a context manager that records the code it wraps as a
+        call of stage *name*::
+
+            with prof.stage('io', img=tim):
+                tim.data = fitsio.read(fn)
+        '''
+        return _Stage(self, name, src, img)
+
+    def getStats(self, by=None):
+        '''
+        Returns the recorded timings as a dict of dicts with keys
+        "ncalls", "wall" and "cpu" (in seconds).
+
+        *by*: None for a dict keyed by stage name; "source" or "image"
+        for dicts keyed by (stage name, source or image object).
+        '''
+        d = dict(source=self.sources, image=self.images).get(by, self.stages)
+        return dict([(k, dict(ncalls=n, wall=w, cpu=c))
+                     for k, (n, w, c) in d.items()])
+
+    def format(self, by=None):
+        '''
+        Returns the timings (see `getStats`) as a printable table,
+        most expensive first.
+        '''
+        stats = self.getStats(by=by)
+        rows = []
+        for k, st in stats.items():
+            if by is None:
+                name = k
+            else:
+                stage, thing = k
+                tname = getattr(thing, 'name', None)
+                if tname is None:
+                    tname = str(thing)
+                name = '%s: %s' % (stage, tname)
+            rows.append((st['wall'], name, st))
+        rows.sort(key=lambda r: -r[0])
+        lines = ['%-40s %8s %10s %10s' % ('stage', 'ncalls', 'wall', 'cpu')]
+        for wall, name, st in rows:
+            lines.append('%-40s %8i %10.4f %10.4f' %
+                         (name[:40], st['ncalls'], st['wall'], st['cpu']))
+        return '\n'.join(lines)
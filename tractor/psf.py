@@ -3,6 +3,7 @@ from __future__ import division
 
 import sys
 import functools
+import hashlib
 
 import numpy as np
 
@@ -109,13 +110,21 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
 
     def clear_cache(self):
         self.fftcache = {}
+        self._hashimg = None
 
     @property
     def shape(self):
         return (self.H, self.W)
 
     def hashkey(self):
-        return ('PixelizedPSF', tuple(self.img.ravel()))
+        # Hash the pixels by a digest, computed once per "img" array
+        # (call clear_cache() after modifying "img" in place).
+        if getattr(self, '_hashimg', None) is not self.img:
+            self._hashdigest = hashlib.sha1(
+                np.ascontiguousarray(self.img).tobytes()).hexdigest()
+            self._hashimg = self.img
+        return ('PixelizedPSF', self.img.shape, self.img.dtype.str,
+                self.sampling, self._hashdigest)
 
     def copy(self):
         return self.__class__(self.img.copy())
@@ -442,6 +451,19 @@ class GaussianMixturePSF(MogParams, ducks.ImageCalibration):
     def getRadius(self):
         return self.radius
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        '''
+        Returns the derivatives of the model image with respect to this
+        PSF's (thawed) parameters, computed analytically for point
+        sources and galaxies (see `getMogPsfDerivatives`).  If any
+        source can't be handled, returns False for all of them, so the
+        Tractor will compute them by finite differences.
+        '''
+        derivs = getMogPsfDerivatives(tractor, img, srcs, self.mog)
+        if derivs is None:
+            return [False] * self.numberOfParams()
+        return [derivs[i] for i in self.getThawedParamIndices()]
+
     # returns a Patch object.
     def getPointSourcePatch(self, px, py, minval=0., radius=None,
                             derivs=False, minradius=None, modelMask=None,
@@ -584,6 +606,63 @@ class GaussianMixturePSF(MogParams, ducks.ImageCalibration):
         tpsf = GaussianMixturePSF(w, mu, var)
         return tpsf
 
+    @staticmethod
+    def fromStamps(stamps, N=3, P0=None, xy0=None, alpha=0.,
+                   emsteps=1000, tol=0., init=None, threads=None):
+        '''
+        Fits a GaussianMixturePSF to each of a list (or 3-d array) of
+        same-sized stamps, as `fromStamp` does, in a single call.
+
+        optional P0 = (w,mu,var): initial parameter guess, for all stamps.
+
+        optional xy0 = int x0,y0 origin of the stamps.
+
+        optional init = list of ints: if init[i] >= 0, the fit for
+        stamp i starts from the result for stamp init[i] (which must
+        be < i), rather than from P0.  Useful for warm-starting from a
+        neighbouring stamp on a grid.
+
+        optional tol: stop each fit once no parameter changes by more
+        than *tol* in an EM step (rather than always taking *emsteps*
+        steps).
+
+        threads: number of threads to use (if the emfit module was
+        built with OpenMP); default: all.
+
+        Returns a list of GaussianMixturePSF objects.
+        '''
+        from tractor.emfit import em_fit_2d_reg_batch
+        from tractor.fitpsf import em_init_params
+        if P0 is not None:
+            w, mu, var = P0
+        else:
+            w, mu, var = em_init_params(N, None, None, None)
+        stamps = np.array(stamps, dtype=float)
+        n, H, W = stamps.shape
+        K = len(w)
+        ws = np.tile(np.asarray(w, float), (n, 1))
+        mus = np.tile(np.asarray(mu, float), (n, 1, 1))
+        vars = np.tile(np.asarray(var, float), (n, 1, 1, 1))
+        if init is None:
+            init = -np.ones(n, np.intc)
+        else:
+            init = np.array(init, np.intc)
+            assert(init.shape == (n,))
+
+        if xy0 is None:
+            xm, ym = -(W // 2), -(H // 2)
+        else:
+            xm, ym = xy0
+
+        stamps /= stamps.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        stamps = np.maximum(stamps, 0)
+
+        em_fit_2d_reg_batch(stamps, xm, ym, ws, mus, vars, init, alpha,
+                            emsteps, tol, (threads or 0))
+
+        return [GaussianMixturePSF(w, mu, var)
+                for w, mu, var in zip(ws, mus, vars)]
+
 
 class HybridPixelizedPSF(HybridPSF):
     '''
@@ -702,6 +781,38 @@ class GaussianMixtureEllipsePSF(GaussianMixturePSF):
     def toMog(self):
         return GaussianMixturePSF(self.mog.amp, self.mog.mean, self.mog.var)
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        derivs = getMogPsfDerivatives(tractor, img, srcs, self.mog)
+        if derivs is None:
+            return [False] * self.numberOfParams()
+        K = self.mog.K
+        # Chain rule from the variance to the ellipse parameters; the
+        # (2x2) Jacobian of the covariance is found by central
+        # differences.
+        alld = derivs[:3 * K]
+        step = 1e-6
+        for k, e in enumerate(self.ellipses):
+            dvar = derivs[3 * K + 3 * k: 3 * K + 3 * (k + 1)]
+            p0 = e.getAllParams()
+            for j in range(3):
+                e1 = e.copy()
+                p = list(p0)
+                p[j] += step
+                e1.setAllParams(p)
+                vhi = self.ellipseToVariance(e1)
+                p[j] -= 2. * step
+                e1.setAllParams(p)
+                vlo = self.ellipseToVariance(e1)
+                dv = (vhi - vlo) / (2. * step)
+                if dvar[0] is None:
+                    alld.append(None)
+                    continue
+                alld.append(Patch(dvar[0].x0, dvar[0].y0,
+                                  dv[0, 0] * dvar[0].patch +
+                                  dv[1, 1] * dvar[1].patch +
+                                  dv[0, 1] * dvar[2].patch))
+        return [alld[i] for i in self.getThawedParamIndices()]
+
     def mogAt(self, x, y):
         return self.toMog()
 
@@ -859,6 +970,28 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
         hk = ('NCircularGaussianPSF', tuple(self.sigmas), tuple(self.weights))
         return hk
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        mog = self.getMixtureOfGaussians()
+        derivs = getMogPsfDerivatives(tractor, img, srcs, mog)
+        if derivs is None:
+            return [False] * self.numberOfParams()
+        K = mog.K
+        # sigmas: var = sigma**2 in both xx and yy; weights: amps.
+        dsigmas = []
+        for k, sig in enumerate(self.mysigmas):
+            dxx, dyy = derivs[3 * K + 3 * k], derivs[3 * K + 3 * k + 1]
+            if dxx is None:
+                dsigmas.append(None)
+                continue
+            dsigmas.append(Patch(dxx.x0, dxx.y0,
+                                 2. * sig * (dxx.patch + dyy.patch)))
+        alld = [dsigmas, derivs[:K]]
+        rtn = []
+        for i in self.getThawedParamIndices():
+            rtn.extend([alld[i][j]
+                        for j in self.subs[i].getThawedParamIndices()])
+        return rtn
+
     def copy(self):
         return NCircularGaussianPSF(list([s for s in self.sigmas]),
                                     list([w for w in self.weights]))
@@ -909,6 +1042,87 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
         mix.mean = oldmean
         return p
 
+def getMogPsfDerivatives(tractor, img, srcs, mog):
+    '''
+    Returns the derivatives of the model image (of sources *srcs* in
+    Image *img*) with respect to the parameters of the PSF mixture of
+    Gaussians *mog*, as a list of Patches (or None where no source
+    touches), in MogParams order: K amplitudes, K (x,y) means, K
+    (xx,yy,xy) variances.
+
+    The derivatives are computed analytically, one pass over each
+    source's footprint (its ModelMask, or the extent of its model
+    patch), for point sources and galaxies rendered as mixtures of
+    Gaussians.  Returns None if any source is of another kind.
+    '''
+    from tractor.galaxy import ProfileGalaxy
+    from tractor.mix import c_gauss_2d_psf_derivs
+
+    K = mog.K
+    pamp = np.array(mog.amp, float)
+    pmean = np.array(mog.mean, float)
+    pvar = np.array(mog.var, float)
+    wcs = img.getWcs()
+    photocal = img.getPhotoCal()
+    parts = []
+    for src in srcs:
+        if src is None:
+            continue
+        px, py = wcs.positionToPixel(src.getPosition(), src)
+        if type(src) is PointSource:
+            amp = np.ones(1)
+            mean = np.array([[px, py]])
+            var = np.zeros((1, 2, 2))
+        elif isinstance(src, ProfileGalaxy):
+            amix = src._getAffineProfile(img, px, py)
+            if amix is None:
+                return None
+            amp, mean, var = amix.amp, amix.mean, amix.var
+        else:
+            return None
+        counts = photocal.brightnessToCounts(src.getBrightness())
+        if counts == 0:
+            continue
+        # The source's footprint
+        mask = tractor._getModelMaskFor(img, src)
+        if mask is None:
+            if tractor.expectModelMasks:
+                continue
+            mod = tractor.getModelPatch(img, src)
+            if mod is None or mod.patch is None:
+                continue
+            x0, y0 = mod.x0, mod.y0
+            h, w = mod.shape
+        else:
+            x0, y0 = mask.x0, mask.y0
+            h, w = mask.shape
+        d = np.zeros((6 * K, h, w))
+        rtn = c_gauss_2d_psf_derivs(int(x0), int(x0 + w), int(y0), int(y0 + h),
+                                    np.array(amp, float) * counts,
+                                    np.array(mean, float),
+                                    np.array(var, float),
+                                    pamp, pmean, pvar, d)
+        if rtn != 0:
+            raise RuntimeError('c_gauss_2d_psf_derivs failed')
+        if mask is not None and mask.mask is not None:
+            d *= mask.mask
+        parts.append((x0, y0, d))
+
+    if len(parts) == 0:
+        return [None] * (6 * K)
+    # Sum over sources, in the bounding box of their footprints
+    x0 = min([x for x, y, d in parts])
+    y0 = min([y for x, y, d in parts])
+    x1 = max([x + d.shape[2] for x, y, d in parts])
+    y1 = max([y + d.shape[1] for x, y, d in parts])
+    if len(parts) == 1:
+        D = parts[0][2]
+    else:
+        D = np.zeros((6 * K, y1 - y0, x1 - x0))
+        for x, y, d in parts:
+            D[:, y - y0: y - y0 + d.shape[1], x - x0: x - x0 + d.shape[2]] += d
+    return [Patch(x0, y0, D[i]) for i in range(6 * K)]
+
 def getCircularMog(amps, sigmas):
     K = len(amps)
     amps = np.array(amps).astype(np.float32)
@@ -23,7 +23,6 @@ from tractor.psf import GaussianMixturePSF, PixelizedPSF
 from tractor import mixture_profiles as mp
 from tractor import ducks
 
-from astrometry.util.fits import fits_table
 
 
 class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
@@ -132,6 +131,11 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
         psf = self.psfAt(px, py)
         return psf.getMixtureOfGaussians()
 
+    # Keyword arguments of _fitParamGrid that the batched
+    # GaussianMixturePSF.fromStamps fit supports; with any others, the
+    # stamps are fit one at a time with fromStamp.
+    batchFitKwargs = ('xy0', 'alpha', 'emsteps', 'tol', 'threads')
+
     def _fitParamGrid(self, fitfunc=None, trim=0, **kwargs):
         # all MoG fit parameters (we need to make them shaped (ny,nx)
         # for spline fitting)
@@ -139,6 +143,35 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
         # x,y coords at which we will evaluate the PSF.
         YY = np.linspace(0, self.H, self.ny)
         XX = np.linspace(0, self.W, self.nx)
+
+        if (fitfunc is None and self.psfclass is GaussianMixturePSF and
+                all([k in self.batchFitKwargs for k in kwargs])):
+            # Fit all the stamps in one call, each one starting from
+            # the fit for the stamp to its left (or, at the start of a
+            # row, the start of the previous row).
+            ims = []
+            init = []
+            for iy, y in enumerate(YY):
+                for ix, x in enumerate(XX):
+                    im = self.instantiateAt(x, y)
+                    if trim > 0:
+                        im = im[trim:-trim, trim:-trim]
+                    ims.append(im)
+                    if ix > 0:
+                        init.append(len(ims) - 2)
+                    elif iy > 0:
+                        init.append(len(ims) - 1 - self.nx)
+                    else:
+                        init.append(-1)
+            psfs = GaussianMixturePSF.fromStamps(ims, N=self.K, init=init,
+                                                 **kwargs)
+            pp = np.array([psf.getAllParams() for psf in psfs]).reshape(
+                self.ny, self.nx, -1)
+            self.fitSavedData(pp, XX, YY)
+            if self.savesplinedata:
+                self.splinedata = (pp, XX, YY)
+            return
+
         # fit params at start of this row
         px0 = None
         for y in YY:
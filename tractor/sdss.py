@@ -330,6 +330,13 @@ def _get_sources(run, camcol, field, bandname='r', sdss=None, release='DR7',
         objs.rename('phi_exp', 'phi_exp_deg')
         objs.rename('r_dev', 'theta_dev')
         objs.rename('r_exp', 'theta_exp')
+    else:
+        sources, isources = get_tractor_sources_table(
+            objs, bandname=bandname, bands=bands, extrabands=extrabands,
+            badmag=badmag, nanomaggies=nanomaggies,
+            fixedComposites=fixedComposites,
+            forcePointSources=forcePointSources, useObjcType=useObjcType,
+            classmap=classmap, ellipse=ellipse)
 
     # SDSS and Tractor have different opinions on which way this rotation goes
     objs.phi_dev_deg *= -1.
@@ -339,6 +346,37 @@ def _get_sources(run, camcol, field, bandname='r', sdss=None, release='DR7',
     objs.theta_dev = np.maximum(objs.theta_dev, 1. / 30.)
     objs.theta_exp = np.maximum(objs.theta_exp, 1. / 30.)
 
+    if isdr7:
+        sources, isources = _get_sources_dr7(
+            objs, tsf, bandnum, bands, extrabands, nanomaggies,
+            fixedComposites, forcePointSources, useObjcType, classmap,
+            ellipse)
+
+    if not (getobjs or getobjinds or getsourceobjs):
+        return sources
+
+    if len(isources) < len(objs):
+        objs = objs[np.array(isources)]
+
+    rtn = [sources]
+    if getobjs:
+        rtn.append(allobjs)
+    if getobjinds:
+        rtn.append(objs.index if len(objs) else np.array([]))
+    if getsourceobjs:
+        rtn.append(objs)
+    return rtn
+
+
+def _get_sources_dr7(objs, tsf, bandnum, bands, extrabands, nanomaggies,
+                     fixedComposites, forcePointSources, useObjcType,
+                     classmap, ellipse):
+    # DR7 "tsObj" files have luptitudes, which are converted to counts
+    # per band via the tsField calibration, so this path is still
+    # row-by-row.  See get_tractor_sources_table() for DR8+.
+    from .sdss_dr7 import _dr7_getBrightness
+    bandnames = bands
+
     if forcePointSources:
         Lstar = np.ones(len(objs), float)
         Lgal = np.zeros(len(objs), float)
@@ -353,75 +391,34 @@ def _get_sources(run, camcol, field, bandname='r', sdss=None, release='DR7',
             Lstar = (objs.prob_psf[:, bandnum] == 1) * 1.0
             Lgal = (objs.prob_psf[:, bandnum] == 0) * 1.0
 
-        if isdr7:
-            fracdev = objs.fracpsf[:, bandnum]
-        else:
-            fracdev = objs.fracdev[:, bandnum]
+        fracdev = objs.fracpsf[:, bandnum]
         Ldev = Lgal * fracdev
         Lexp = Lgal * (1. - fracdev)
 
-    if isdr7:
-        from .sdss_dr7 import _dr7_getBrightness
-        if nanomaggies:
-            raise RuntimeError('Nanomaggies not supported for DR7 (yet)')
-
-        def lup2bright(lups):
-            counts = [tsf.luptitude_to_counts(lup, j)
-                      for j, lup in enumerate(lups)]
-            counts = np.array(counts)
-            bright = _dr7_getBrightness(counts, tsf, bandnames, extrabands)
-            return bright
-        flux2bright = lup2bright
-        starflux = objs.psfcounts
-        compflux = objs.counts_model
-        devflux = objs.counts_dev
-        expflux = objs.counts_exp
-
-        def comp2bright(lups, Ldev, Lexp):
-            counts = [tsf.luptitude_to_counts(lup, j)
-                      for j, lup in enumerate(lups)]
-            counts = np.array(counts)
-            dcounts = counts * Ldev
-            ecounts = counts * Lexp
-            dbright = _dr7_getBrightness(dcounts, tsf, bands, extrabands)
-            ebright = _dr7_getBrightness(ecounts, tsf, bands, extrabands)
-            return dbright, ebright
-    else:
-        def nmgy2bright(flux):
-            if len(bandnums):
-                flux = flux[bandnums]
-            else:
-                flux = flux[np.array([bandnum])]
-            bb = bandnames + extrabands
-            if nanomaggies:
-                if len(extrabands):
-                    if len(bandnums) == 0:
-                        # Only "extrabands", no SDSS bands.
-                        flux = np.zeros(len(extrabands)) + flux[0]
-                    else:
-                        flux = np.append(flux, np.zeros(len(extrabands)))
-                bright = NanoMaggies(order=bb, **dict(zip(bb, flux)))
-            else:
-                I = (flux > 0)
-                mag = np.zeros_like(flux) + badmag
-                mag[I] = sdss.nmgy_to_mag(flux[I])
-                if len(extrabands):
-                    mag = np.append(mag, np.zeros(len(extrabands)) + badmag)
-                bright = Mags(order=bb, **dict(zip(bb, mag)))
-            return bright
-
-        def comp2bright(flux, Ldev, Lexp):
-            dflux = flux * Ldev
-            eflux = flux * Lexp
-            dbright = nmgy2bright(dflux)
-            ebright = nmgy2bright(eflux)
-            return dbright, ebright
-
-        flux2bright = nmgy2bright
-        starflux = objs.psfflux
-        compflux = objs.cmodelflux
-        devflux = objs.devflux
-        expflux = objs.expflux
+    if nanomaggies:
+        raise RuntimeError('Nanomaggies not supported for DR7 (yet)')
+
+    def lup2bright(lups):
+        counts = [tsf.luptitude_to_counts(lup, j)
+                  for j, lup in enumerate(lups)]
+        counts = np.array(counts)
+        bright = _dr7_getBrightness(counts, tsf, bandnames, extrabands)
+        return bright
+    flux2bright = lup2bright
+    starflux = objs.psfcounts
+    compflux = objs.counts_model
+    devflux = objs.counts_dev
+    expflux = objs.counts_exp
+
+    def comp2bright(lups, Ldev, Lexp):
+        counts = [tsf.luptitude_to_counts(lup, j)
+                  for j, lup in enumerate(lups)]
+        counts = np.array(counts)
+        dcounts = counts * Ldev
+        ecounts = counts * Lexp
+        dbright = _dr7_getBrightness(dcounts, tsf, bands, extrabands)
+        ebright = _dr7_getBrightness(ecounts, tsf, bands, extrabands)
+        return dbright, ebright
 
     sources = []
     nstars, ndev, nexp, ncomp = 0, 0, 0, 0
@@ -434,11 +431,6 @@ def _get_sources(run, camcol, field, bandname='r', sdss=None, release='DR7',
             pos = RaDecPos(objs.ra[i], objs.dec[i])
             flux = starflux[i, :]
             bright = flux2bright(flux)
-            # This should work, I just don't feel like testing it now...
-            # if brightPointSourceThreshold:
-            #   ps = SdssPointSource(pos, bright, thresh=brightPointSourceThreshold)
-            # else:
-            #   ps = PointSource(pos, bright)
             sources.append(ptsrcclass(pos, bright))
             nstars += 1
             isources.append(i)
@@ -496,21 +488,168 @@ def _get_sources(run, camcol, field, bandname='r', sdss=None, release='DR7',
 
     print('Created', ndev, 'deV,', nexp, 'exp,', ncomp, 'composite',)
     print('(total %i) galaxies and %i stars' % (ndev + nexp + ncomp, nstars))
+    return sources, isources
 
-    if not (getobjs or getobjinds or getsourceobjs):
-        return sources
 
-    if nstars + ndev + nexp + ncomp < len(objs):
-        objs = objs[np.array(isources)]
+def get_tractor_sources_table(objs, bandname='r', bands=None,
+                              extrabands=None, badmag=25, nanomaggies=False,
+                              fixedComposites=False, forcePointSources=False,
+                              useObjcType=False, classmap={},
+                              ellipse=GalaxyShape):
+    '''
+    Creates tractor.Source objects from a DR8+ "photoObj"-like table
+    of positions, fluxes (in nanomaggies), shapes and types.
 
-    rtn = [sources]
-    if getobjs:
-        rtn.append(allobjs)
-    if getobjinds:
-        rtn.append(objs.index if len(objs) else np.array([]))
-    if getsourceobjs:
-        rtn.append(objs)
-    return rtn
+    *objs* can be an astrometry.util.fits.fits_table or a numpy
+    structured array (eg, from fitsio), with (lower-case) columns
+
+      ra, dec,
+      psfflux, cmodelflux, devflux, expflux, fracdev, prob_psf,
+      theta_dev, ab_dev, phi_dev_deg, theta_exp, ab_exp, phi_exp_deg,
+      objc_type (only if *useObjcType*),
+
+    where all but ra, dec and objc_type have shape (N, 5) (one column
+    per SDSS band).  Shapes are in SDSS conventions (the position
+    angle is flipped and the radius floored here); the table is not
+    modified.
+
+    All the star / deV / exp / composite selection, flux selection
+    and magnitude conversion is done on whole columns; what remains
+    per row is constructing the Source objects themselves.
+
+    See _get_sources() for the meaning of the other arguments.
+
+    Returns (sources, I), where *I* are the indices into *objs* of
+    the rows that produced each source.
+    '''
+    from astrometry.sdss import band_names, band_index
+
+    if isinstance(objs, np.ndarray):
+        def getcol(c):
+            return objs[c]
+    else:
+        getcol = objs.get
+
+    if bands is None:
+        bands = band_names()
+    if extrabands is None:
+        extrabands = []
+    bandnum = band_index(bandname)
+    bandnums = np.array([band_index(b) for b in bands], int)
+    if len(bandnums) == 0:
+        bandnums = np.array([bandnum])
+    bb = list(bands) + list(extrabands)
+
+    ra = getcol('ra')
+    dec = getcol('dec')
+    N = len(ra)
+
+    if forcePointSources:
+        isstar = np.ones(N, bool)
+        Ldev = Lexp = np.zeros(N)
+    else:
+        if useObjcType:
+            objc_type = getcol('objc_type')
+            isstar = (objc_type == 6)
+            Lgal = (objc_type == 3) * 1.0
+        else:
+            prob_psf = getcol('prob_psf')[:, bandnum]
+            isstar = (prob_psf == 1)
+            Lgal = (prob_psf == 0) * 1.0
+        fracdev = getcol('fracdev')[:, bandnum]
+        Ldev = Lgal * fracdev
+        Lexp = Lgal * (1. - fracdev)
+    hasdev = np.logical_not(isstar) * (Ldev > 0)
+    hasexp = np.logical_not(isstar) * (Lexp > 0)
+    iscomp = hasdev * hasexp
+    isdev = hasdev * np.logical_not(hasexp)
+    isexp = hasexp * np.logical_not(hasdev)
+
+    # Select the flux measurement to use for each row.
+    flux = np.zeros((N, len(bandnums)))
+    for sel, col in [(isstar, 'psfflux'), (iscomp, 'cmodelflux'),
+                     (isdev, 'devflux'), (isexp, 'expflux')]:
+        if np.any(sel):
+            flux[sel, :] = getcol(col)[sel, :][:, bandnums]
+
+    def bright_values(flux):
+        # Returns the brightness values for each row, as a list of lists
+        if nanomaggies:
+            if len(bands) == 0:
+                # Only "extrabands", no SDSS bands.
+                vals = np.zeros((N, len(extrabands))) + flux[:, :1]
+            else:
+                vals = np.hstack((flux, np.zeros((N, len(extrabands)))))
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vals = np.where(flux > 0,
+                                NanoMaggies.nanomaggiesToMag(flux), badmag)
+            vals = np.hstack((vals, np.zeros((N, len(extrabands))) + badmag))
+            vals = vals[:, :len(bb)]
+        return vals.tolist()
+
+    brightclass = NanoMaggies if nanomaggies else Mags
+
+    def bright(vals):
+        return brightclass(order=bb, **dict(zip(bb, vals)))
+
+    vals = bright_values(flux)
+    if iscomp.any() and not fixedComposites:
+        # composites get separate deV and exp brightnesses
+        dvals = bright_values(flux * Ldev[:, np.newaxis])
+        evals = bright_values(flux * Lexp[:, np.newaxis])
+
+    # SDSS and Tractor have different opinions on which way this
+    # rotation goes; MAGIC minimum size of galaxy.
+    def shapes(kind, sel):
+        if not np.any(sel):
+            return [None] * N
+        re = np.maximum(getcol('theta_' + kind)[:, bandnum], 1. / 30.)
+        ab = getcol('ab_' + kind)[:, bandnum]
+        phi = -1. * getcol('phi_%s_deg' % kind)[:, bandnum]
+        return [ellipse(r, a, p) if s else None
+                for r, a, p, s in zip(re.tolist(), ab.tolist(),
+                                      phi.tolist(), sel)]
+    dshapes = shapes('dev', hasdev)
+    eshapes = shapes('exp', hasexp)
+    fracdevs = (Ldev / np.maximum(Ldev + Lexp, 1e-300)).tolist()
+
+    ptsrcclass = classmap.get(PointSource, PointSource)
+
+    # Row kinds: 0=skip, 1=star, 2=dev, 3=exp, 4=composite
+    kind = (isstar * 1 + isdev * 2 + isexp * 3 + iscomp * 4)
+    I = np.flatnonzero(kind)
+    if len(I) < N and not useObjcType:
+        for i in np.flatnonzero(kind == 0):
+            print('Skipping object with Ldev = %g, Lexp = %g' %
+                  (Ldev[i], Lexp[i]))
+
+    ras = ra.tolist()
+    decs = dec.tolist()
+    kinds = kind.tolist()
+    sources = []
+    for i in I.tolist():
+        pos = RaDecPos(ras[i], decs[i])
+        k = kinds[i]
+        if k == 1:
+            src = ptsrcclass(pos, bright(vals[i]))
+        elif k == 2:
+            src = DevGalaxy(pos, bright(vals[i]), dshapes[i])
+        elif k == 3:
+            src = ExpGalaxy(pos, bright(vals[i]), eshapes[i])
+        elif fixedComposites:
+            src = FixedCompositeGalaxy(pos, bright(vals[i]), fracdevs[i],
+                                       eshapes[i], dshapes[i])
+        else:
+            src = CompositeGalaxy(pos, bright(evals[i]), eshapes[i],
+                                  bright(dvals[i]), dshapes[i])
+        sources.append(src)
+
+    print('Created', np.sum(isdev), 'deV,', np.sum(isexp), 'exp,',
+          np.sum(iscomp), 'composite',)
+    print('(total %i) galaxies and %i stars' %
+          (np.sum(isdev) + np.sum(isexp) + np.sum(iscomp), np.sum(isstar)))
+    return sources, I
 
 
 def get_tractor_sources_dr8(*args, **kwargs):
@@ -543,10 +682,10 @@ def get_tractor_sources_cas_dr9(table, bandname='r', bands=None,
     '''
     table: filename or astrometry.util.fits.fits_table() object
     '''
-    from astrometry.sdss import band_names
-    from astrometry.util.fits import fits_table
+    from astrometry.sdss import band_names, DR9
+    from astrometry.util.fits import fits_table, tabledata
 
-    if isinstance(table, basestring):
+    if isinstance(table, str):
         cas = fits_table(table)
     else:
         cas = table
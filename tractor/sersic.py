@@ -20,16 +20,48 @@ from tractor.engine import *
 from tractor.utils import *
 from tractor.cache import *
 from tractor.galaxy import *
+from tractor.patch import ModelMask
 
 class SersicMixture(object):
+    '''
+    Mixture-of-Gaussians approximations to Sersic profiles, fit on a
+    grid of Sersic indices and interpolated between.
+
+    At startup, the per-range splines of the fit amplitudes and
+    log-variances are tabulated, with their derivatives, on a grid of
+    spacing `tablestep` in Sersic index (a fixed number of components
+    per row, zero-padded), so that profiles come from one vectorized
+    cubic Hermite interpolation -- which reproduces the splines, since
+    their knots lie on the grid -- with analytic derivatives with
+    respect to the Sersic index.  Profiles are memoized.
+    '''
     singleton = None
 
+    # Spacing of the table in Sersic index; the fits' grid points
+    # and range boundaries are multiples of this.
+    tablestep = 0.005
+
     @staticmethod
     def getProfile(sindex):
         if SersicMixture.singleton is None:
             SersicMixture.singleton = SersicMixture()
         return SersicMixture.singleton._getProfile(sindex)
 
+    @staticmethod
+    def getProfileDerivative(sindex, dvar=0.01):
+        '''
+        Returns a MixtureOfGaussians whose rendering is the derivative,
+        with respect to the Sersic index, of the rendering of the
+        profile for *sindex*: the amplitude derivatives at the
+        components' variances, plus, for each component whose variance
+        changes, a pair of components at variances (1 +- *dvar*) times
+        its own, weighted to give the (central-difference) derivative
+        with respect to its variance.
+        '''
+        if SersicMixture.singleton is None:
+            SersicMixture.singleton = SersicMixture()
+        return SersicMixture.singleton._getProfileDerivative(sindex, dvar)
+
     def __init__(self):
         from scipy.interpolate import InterpolatedUnivariateSpline, interp1d
         # GalSim: supports n=0.3 to 6.2.
@@ -284,67 +316,112 @@ class SersicMixture(object):
         (lo,hi,a,v) = self.fits[-1]
         self.highest = hi
 
+        self._buildTable()
+        self.cache = Cache(maxsize=1000)
+
+    def _buildTable(self):
+        # Tabulate the spline values and derivatives at both ends of
+        # each grid interval, from the fit range containing the
+        # interval (the fits are discontinuous at range boundaries).
+        # Each row of the table holds [f0, h f0', f1, h f1'] for the K
+        # amplitudes, K log-variances and the core fraction.
+        h = self.tablestep
+        n0 = int(np.round(self.lowest / h))
+        n1 = int(np.round(self.highest / h))
+        nodes = np.arange(n0, n1 + 1) * h
+        N = len(nodes) - 1
+        K = max([len(a) for lo,hi,a,v in self.fits])
+        self.tab_n0 = nodes[0]
+        self.tab_ncomp = np.zeros(N, int)
+        self.tab = np.zeros((N, 4, 2 * K + 1))
+        mid = (nodes[:-1] + nodes[1:]) / 2.
+        for lo, hi, amp_funcs, logvar_funcs in self.fits:
+            I = np.flatnonzero((mid > lo) * (mid < hi))
+            self.tab_ncomp[I] = len(amp_funcs)
+            for end, nn in enumerate([nodes[I], nodes[I + 1]]):
+                for nu in [0, 1]:
+                    row = 2 * end + nu
+                    scale = h if nu else 1.
+                    for k, (af, vf) in enumerate(zip(amp_funcs,
+                                                     logvar_funcs)):
+                        self.tab[I, row, k] = scale * af(nn, nu=nu)
+                        self.tab[I, row, K + k] = scale * vf(nn, nu=nu)
+                    self.tab[I, row, 2 * K] = scale * self.core_func(nn, nu=nu)
+
+    def _interpolate(self, sindex):
+        # Returns (amps, damps, vars, dvars) arrays of shape (N, K+1)
+        # (zero-padded; the last component is the core), plus the
+        # number of (non-core) components of each and whether it has a
+        # core, for the array of Sersic indices *sindex*.  The
+        # derivatives are zero outside the table.
+        sindex = np.atleast_1d(np.asarray(sindex, float))
+        h = self.tablestep
+        inside = (sindex > self.lowest) * (sindex < self.highest)
+        x = (np.clip(sindex, self.lowest, self.highest) - self.tab_n0) / h
+        # (nudged so that range boundaries go to the range above)
+        j = np.clip(np.floor(x + 1e-6).astype(int), 0,
+                    len(self.tab_ncomp) - 1)
+        t = x - j
+        t2 = t * t
+        t3 = t2 * t
+        # cubic Hermite basis functions, and their derivatives
+        Hw = np.array([2 * t3 - 3 * t2 + 1, t3 - 2 * t2 + t,
+                       -2 * t3 + 3 * t2, t3 - t2]).T
+        dHw = np.array([6 * t2 - 6 * t, 3 * t2 - 4 * t + 1,
+                        -6 * t2 + 6 * t, 3 * t2 - 2 * t]).T
+        dHw *= (inside / h)[:, np.newaxis]
+        T = self.tab[j]
+        f = np.einsum('nk,nkw->nw', Hw, T)
+        df = np.einsum('nk,nkw->nw', dHw, T)
+
+        K = (T.shape[2] - 1) // 2
+        ncomp = self.tab_ncomp[j]
+        valid = (np.arange(K)[np.newaxis, :] < ncomp[:, np.newaxis])
+        a = f[:, :K] * valid
+        da = df[:, :K] * valid
+        core = (sindex > 1.)
+        c = (f[:, 2 * K] * core)[:, np.newaxis]
+        dc = (df[:, 2 * K] * core)[:, np.newaxis]
+        # normalize, leaving 'c' for the core
+        S = np.sum(a, axis=1)[:, np.newaxis]
+        dS = np.sum(da, axis=1)[:, np.newaxis]
+        w = a / S
+        dw = (da - w * dS) / S
+        amps = np.hstack((w * (1. - c), c))
+        damps = np.hstack((dw * (1. - c) - w * dc, dc))
+        var = np.zeros_like(amps)
+        var[:, :K] = np.exp(f[:, K:2 * K]) * valid
+        dvar = np.zeros_like(amps)
+        dvar[:, :K] = var[:, :K] * df[:, K:2 * K]
+        return amps, damps, var, dvar, ncomp, core
+
+    def _lookup(self, sindex):
+        sindex = float(sindex)
+        r = self.cache.get(sindex, None)
+        if r is None:
+            amps, damps, var, dvar, ncomp, core = self._interpolate(sindex)
+            # drop the padding (and the core, for sindex <= 1)
+            K = ncomp[0]
+            I = np.arange(K)
+            if core[0]:
+                I = np.append(I, amps.shape[1] - 1)
+            r = (amps[0, I], damps[0, I], var[0, I], dvar[0, I])
+            self.cache.put(sindex, r)
+        return r
+
     def _getProfile(self, sindex):
-        matches = []
-        # clamp
-        if sindex <= self.lowest:
-            matches.append(self.fits[0])
-            #(lo,hi,a,v) = self.fits[0]
-            #amp_funcs = a
-            #logvar_funcs = v
-            sindex = self.lowest
-        elif sindex >= self.highest:
-            matches.append(self.fits[-1])
-            #(lo,hi,a,v) = self.fits[-1]
-            #amp_funcs = a
-            #logvar_funcs = v
-            sindex = self.highest
-        else:
-            for f in self.fits:
-                lo,hi,a,v = f
-                if sindex >= lo and sindex < hi:
-                    matches.append(f)
-                    #print('Sersic index', sindex, '-> range', lo, hi)
-                    #amp_funcs = a
-                    #logvar_funcs = v
-                    #break
-
-        if len(matches) == 2:
-            # Two ranges overlap.  Ramp between them.
-            # Assume self.fits is ordered in increasing Sersic index
-            m0,m1 = matches
-            lo0,hi0,a0,v0 = m0
-            lo1,hi1,a1,v1 = m1
-            assert(lo0 < lo1)
-            assert(lo1 < hi0) # overlap is in here
-            ramp_lo = lo1
-            ramp_hi = hi0
-            assert(ramp_lo < ramp_hi)
-            assert(ramp_lo <= sindex)
-            assert(sindex < ramp_hi)
-            ramp_frac = (sindex - ramp_lo) / (ramp_hi - ramp_lo)
-            #print('Sersic index', sindex, ': ramping between ranges', (lo0,hi0), 'and', (lo1,hi1), '; ramp', (ramp_lo, ramp_hi), 'fraction', ramp_frac)
-            amps0 = np.array([f(sindex) for f in a0])
-            amps0 /= amps0.sum()
-            amps1 = np.array([f(sindex) for f in a1])
-            amps1 /= amps1.sum()
-            amps = np.append((1.-ramp_frac)*amps0, ramp_frac*amps1)
-            varr = np.exp(np.array([f(sindex) for f in v0 + v1]))
-        else:
-            assert(len(matches) == 1)
-            lo,hi,amp_funcs,logvar_funcs = matches[0]
-            amps = np.array([f(sindex) for f in amp_funcs])
-            amps /= amps.sum()
-            varr = np.exp(np.array([f(sindex) for f in logvar_funcs]))
-
-        # Core
-        if sindex > 1.:
-            core = self.core_func(sindex)
-            amps *= (1. - core) / amps.sum()
-            amps = np.append(amps, core)
-            varr = np.append(varr, 0.)
-
-        return mp.MixtureOfGaussians(amps, np.zeros((len(amps), 2)), varr)
+        amps, damps, var, dvar = self._lookup(sindex)
+        return mp.MixtureOfGaussians(amps, np.zeros((len(amps), 2)), var)
+
+    def _getProfileDerivative(self, sindex, dvar):
+        amps, damps, var, dv = self._lookup(sindex)
+        I = np.flatnonzero(dv != 0)
+        # d/dv G(v) ~ (G(v (1+e)) - G(v (1-e))) / (2 e v)
+        w = amps[I] * dv[I] / (2. * dvar * var[I])
+        allamps = np.hstack((damps, w, -w))
+        allvar = np.hstack((var, var[I] * (1. + dvar), var[I] * (1. - dvar)))
+        return mp.MixtureOfGaussians(allamps, np.zeros((len(allamps), 2)),
+                                     allvar)
 
 class SersicIndex(ScalarParam):
     stepsize = 0.01
@@ -366,6 +443,9 @@ class SersicIndex(ScalarParam):
 
 class SersicGalaxy(HoggGalaxy):
     nre = 8.
+    # profile to render in place of the Sersic profile (while
+    # computing derivatives)
+    _profile = None
 
     @staticmethod
     def getNamedParams():
@@ -391,6 +471,8 @@ class SersicGalaxy(HoggGalaxy):
         return 'SersicGalaxy'
 
     def getProfile(self):
+        if self._profile is not None:
+            return self._profile
         return SersicMixture.getProfile(self.sersicindex.val)
 
     def copy(self):
@@ -418,39 +500,29 @@ class SersicGalaxy(HoggGalaxy):
             return derivs
         counts = img.getPhotoCal().brightnessToCounts(self.brightness)
 
-        # derivatives wrt Sersic index
-        steps = self.sersicindex.getStepSizes()
+        # derivative wrt Sersic index: render the derivative of the
+        # profile (see SersicMixture.getProfileDerivative) on the same
+        # pixels as patch0.
         if not self.isParamFrozen('sersicindex'):
             inames = self.sersicindex.getParamNames()
-            oldvals = self.sersicindex.getParams()
-            ups = self.sersicindex.getUpperBounds()
-            for i,step in enumerate(steps):
-                # Assume step is positive, and check whether stepping
-                # would exceed the upper bound.
-                newval = oldvals[i] + step
-                if newval > ups[i]:
-                    step *= -1.
-                    newval = oldvals[i] + step
-
-                oldval = self.sersicindex.setParam(i, newval)
-                patchx = self.getUnitFluxModelPatch(
-                    img, px=px0, py=py0, modelMask=modelMask, **kwargs)
-                self.sersicindex.setParam(i, oldval)
-                if patchx is None:
-                    print('patchx is None:')
-                    print('  ', self)
-                    print('  stepping galaxy sersicindex',
-                          self.sersicindex.getParamNames()[i])
-                    print('  stepped', step)
-                    print('  to', self.sersicindex.getParams()[i])
-                    derivs.append(None)
-
-                dx = (patchx - patch0) * (counts / step)
-                dx.setName('d(%s)/d(%s)' % (self.dname, inames[i]))
-                derivs.append(dx)
+            if modelMask is None:
+                ph, pw = patch0.shape
+                modelMask = ModelMask(patch0.x0, patch0.y0, pw, ph)
+            self._profile = SersicMixture.getProfileDerivative(
+                self.sersicindex.val)
+            try:
+                dx = self._realGetUnitFluxModelPatch(
+                    img, px0, py0, 0., modelMask=modelMask, **kwargs)
+            finally:
+                self._profile = None
+            if dx is None:
+                derivs.append(None)
+                return derivs
+            dx *= counts
+            dx.setName('d(%s)/d(%s)' % (self.dname, inames[0]))
+            derivs.append(dx)
         return derivs
 
-
 if __name__ == '__main__':
     from basics import *
     from ellipses import *
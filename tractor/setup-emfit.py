@@ -1,8 +1,16 @@
+import os
+import sys
 from distutils.core import setup, Extension
 from numpy.distutils.misc_util import get_numpy_include_dirs
 
 numpy_inc = get_numpy_include_dirs()
 
+# OpenMP, for em_fit_2d_reg_batch.  (As in the top-level setup.py.)
+em_kwargs = {}
+if sys.platform.startswith('linux') and os.environ.get('CC') != 'icc':
+    em_kwargs.update(extra_compile_args=['-fopenmp'],
+                     extra_link_args=['-fopenmp'])
+
 c_swig_module = Extension('_emfit',
                           sources=['emfit.i'],
                           include_dirs=numpy_inc,
@@ -10,7 +18,7 @@ c_swig_module = Extension('_emfit',
                           undef_macros=['NDEBUG'],
                           # extra_compile_args=['-O0','-g'],
                           #extra_link_args=['-O0', '-g'],
-                          )
+                          **em_kwargs)
 
 setup(name='EM fit of Gaussian mixture',
       version='1.0',
@@ -34,7 +34,26 @@ class SFDMap(object):
         'WISE W4': 0.00910,
     }
 
-    def __init__(self, ngp_filename=None, sgp_filename=None, dustdir=None):
+    # FITS BITPIX -> numpy dtype, for memory-mapping the maps
+    mmap_dtypes = {-32: '>f4', -64: '>f8'}
+
+    def __init__(self, ngp_filename=None, sgp_filename=None, dustdir=None,
+                 mmap=False, tilesize=None, ntiles=1000, chunksize=1000000):
+        '''
+        *mmap*: memory-map the SFD maps rather than reading them into
+        memory.  The maps are then shared (through the page cache)
+        between processes, pickling an SFDMap re-opens the maps rather
+        than copying them, and `ebv` computes pixel positions directly
+        from the maps' Lambert projection parameters.
+
+        *tilesize*: if set, keep an LRU cache of up to *ntiles*
+        in-memory *tilesize* x *tilesize*-pixel tiles of the maps, and
+        interpolate from those.  Repeated queries over a small area
+        (eg, a brick) then touch only a few tiles.
+
+        *chunksize*: in *mmap* mode, `ebv` processes positions in chunks
+        of this size, to bound the memory used by temporary arrays.
+        '''
         if dustdir is None:
             dustdir = os.environ.get('DUST_DIR', None)
         if dustdir is not None:
@@ -53,45 +72,137 @@ class SFDMap(object):
         if not os.path.exists(sgp_filename):
             raise RuntimeError(
                 'Error: SFD map does not exist: %s' % sgp_filename)
-        self.north = fitsio.read(ngp_filename)
-        self.south = fitsio.read(sgp_filename)
-        self.northwcs = anwcs_t(ngp_filename, 0)
-        self.southwcs = anwcs_t(sgp_filename, 0)
+        self.filenames = (ngp_filename, sgp_filename)
+        self.mmap = mmap
+        if mmap:
+            self._open_mmap()
+        else:
+            self.north = fitsio.read(ngp_filename)
+            self.south = fitsio.read(sgp_filename)
+            self.northwcs = anwcs_t(ngp_filename, 0)
+            self.southwcs = anwcs_t(sgp_filename, 0)
+        self.chunksize = chunksize
+        self.tilesize = tilesize
+        self.tilecache = None
+        if tilesize is not None:
+            from tractor.cache import Cache
+            self.tilecache = Cache(maxsize=ntiles)
+
+    def _open_mmap(self):
+        # Memory-map the (uncompressed, primary-HDU) SFD maps, and pull
+        # out the parameters of their Lambert (ZEA) projections.
+        self.north = self.south = None
+        self.northwcs = self.southwcs = None
+        self.zea = []
+        maps = []
+        for fn in self.filenames:
+            F = fitsio.FITS(fn)
+            hdu = F[0]
+            hdr = hdu.read_header()
+            offsets = hdu.get_offsets()
+            if isinstance(offsets, dict):
+                start = offsets['data_start']
+            else:
+                start = offsets[1]
+            F.close()
+            bitpix = hdr['BITPIX']
+            if not bitpix in SFDMap.mmap_dtypes:
+                raise RuntimeError('Error: cannot memory-map SFD map %s '
+                                   'with BITPIX=%i' % (fn, bitpix))
+            shape = (hdr['NAXIS2'], hdr['NAXIS1'])
+            maps.append(np.memmap(fn, dtype=SFDMap.mmap_dtypes[bitpix],
+                                  mode='r', offset=start, shape=shape))
+            # Lambert projection centered on the pole: LAM_NSGP = +1 for
+            # the north, -1 for the south; LAM_SCAL = radius (in
+            # pixels) of the b=0 circle.
+            self.zea.append((hdr.get('LAM_NSGP', 1),
+                             hdr.get('LAM_SCAL', shape[1] // 2),
+                             hdr['CRPIX1'] - 1., hdr['CRPIX2'] - 1.))
+        self.north, self.south = maps
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        if self.mmap:
+            # Re-open the memory maps after unpickling (eg, in a
+            # multiprocessing worker) rather than pickling the maps.
+            for k in ['north', 'south', 'zea']:
+                del d[k]
+        if self.tilecache is not None:
+            d['tilecache'] = None
+            d['ntiles'] = self.tilecache.maxsize
+        return d
+
+    def __setstate__(self, d):
+        ntiles = d.pop('ntiles', None)
+        self.__dict__.update(d)
+        if self.mmap:
+            self._open_mmap()
+        if ntiles is not None:
+            from tractor.cache import Cache
+            self.tilecache = Cache(maxsize=ntiles)
 
     @staticmethod
     def bilinear_interp_nonzero(image, x, y):
         H, W = image.shape
         x0 = np.floor(x).astype(int)
         y0 = np.floor(y).astype(int)
+        x1 = np.clip(x0 + 1, 0, W - 1)
+        y1 = np.clip(y0 + 1, 0, H - 1)
         # Bilinear interpolate, but not outside the bounds (where ebv=0)
         fx = np.clip(x - x0, 0., 1.)
-        ebvA = image[y0, x0]
-        ebvB = image[y0, np.clip(x0 + 1, 0, W - 1)]
-        ebv1 = (1. - fx) * ebvA + fx * ebvB
-        ebv1[ebvA == 0] = ebvB[ebvA == 0]
-        ebv1[ebvB == 0] = ebvA[ebvB == 0]
-
-        ebvA = image[np.clip(y0 + 1, 0, H - 1), x0]
-        ebvB = image[np.clip(y0 + 1, 0, H - 1), np.clip(x0 + 1, 0, W - 1)]
-        ebv2 = (1. - fx) * ebvA + fx * ebvB
-        ebv2[ebvA == 0] = ebvB[ebvA == 0]
-        ebv2[ebvB == 0] = ebvA[ebvB == 0]
-
         fy = np.clip(y - y0, 0., 1.)
-        ebv = (1. - fy) * ebv1 + fy * ebv2
-        ebv[ebv1 == 0] = ebv2[ebv1 == 0]
-        ebv[ebv2 == 0] = ebv1[ebv2 == 0]
+
+        def interp_nonzero(a, b, f):
+            return np.where(b == 0, a,
+                            np.where(a == 0, b, (1. - f) * a + f * b))
+        ebv1 = interp_nonzero(image[y0, x0], image[y0, x1], fx)
+        ebv2 = interp_nonzero(image[y1, x0], image[y1, x1], fx)
+        return interp_nonzero(ebv1, ebv2, fy)
+
+    def _interp(self, image, hemi, x, y):
+        # Interpolate *image* (hemisphere index *hemi*) at zero-indexed
+        # pixel positions *x*,*y*, through the tile cache if enabled.
+        if self.tilecache is None:
+            return SFDMap.bilinear_interp_nonzero(image, x, y)
+        H, W = image.shape
+        T = self.tilesize
+        x = np.clip(x, 0., W - 1.)
+        y = np.clip(y, 0., H - 1.)
+        ntx = (W + T - 1) // T
+        tile = ((np.floor(y).astype(int) // T) * ntx +
+                (np.floor(x).astype(int) // T))
+        # Group positions by tile
+        I = np.argsort(tile, kind='mergesort')
+        tiles, starts = np.unique(tile[I], return_index=True)
+        ends = np.append(starts[1:], len(I))
+        ebv = np.zeros(len(x))
+        for t, i0, i1 in zip(tiles, starts, ends):
+            J = I[i0:i1]
+            ty0 = (t // ntx) * T
+            tx0 = (t % ntx) * T
+            key = (hemi, t)
+            pix = self.tilecache.get(key, None)
+            if pix is None:
+                # Tiles include one extra row and column (where
+                # available) for the bilinear interpolation.
+                pix = np.array(image[ty0: ty0 + T + 1, tx0: tx0 + T + 1])
+                self.tilecache.put(key, pix)
+            ebv[J] = SFDMap.bilinear_interp_nonzero(pix, x[J] - tx0,
+                                                    y[J] - ty0)
         return ebv
 
     def ebv(self, ra, dec):
+        if self.mmap:
+            return self._ebv_mmap(ra, dec)
         l, b = radectolb(ra, dec)
         ebv = np.zeros_like(l)
         N = (b >= 0)
-        for wcs, image, cut in [(self.northwcs, self.north, N),
-                                (self.southwcs, self.south, np.logical_not(N))]:
+        for hemi, (wcs, image, cut) in enumerate(
+                [(self.northwcs, self.north, N),
+                 (self.southwcs, self.south, np.logical_not(N))]):
             # Our WCS routines are mis-named... the SFD WCSes convert
             #   X,Y <-> L,B.
-            if sum(cut) == 0:
+            if not np.any(cut):
                 continue
             ok, x, y = wcs.radec2pixelxy(l[cut], b[cut])
             #assert(np.all(ok == 0))
@@ -100,7 +211,40 @@ class SFDMap(object):
             assert(np.all(x <= (W + 0.5)))
             assert(np.all(y >= 0.5))
             assert(np.all(y <= (H + 0.5)))
-            ebv[cut] = SFDMap.bilinear_interp_nonzero(image, x - 1., y - 1.)
+            ebv[cut] = self._interp(image, hemi, x - 1., y - 1.)
+        return ebv
+
+    def _ebv_mmap(self, ra, dec):
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        ebv = np.zeros(len(ra))
+        for i0 in range(0, len(ra), self.chunksize):
+            I = slice(i0, i0 + self.chunksize)
+            l, b = radectolb(ra[I], dec[I])
+            ebv[I] = self._ebv_lb(np.atleast_1d(l), np.atleast_1d(b))
+        return ebv
+
+    def _ebv_lb(self, l, b):
+        # The SFD maps are Lambert projections centered on the galactic
+        # poles; see the SFD README:
+        #   x = S sqrt(1 - n sin(b)) cos(l) + cx
+        #   y = -S n sqrt(1 - n sin(b)) sin(l) + cy
+        ebv = np.zeros(len(l))
+        N = (b >= 0)
+        l = np.deg2rad(l)
+        sinb = np.sin(np.deg2rad(b))
+        for hemi, (image, zea, cut) in enumerate(
+                [(self.north, self.zea[0], N),
+                 (self.south, self.zea[1], np.logical_not(N))]):
+            I = np.flatnonzero(cut)
+            if len(I) == 0:
+                continue
+            n, scale, cx, cy = zea
+            H, W = image.shape
+            r = scale * np.sqrt(np.maximum(0., 1. - n * sinb[I]))
+            x = np.clip(cx + r * np.cos(l[I]), 0., W - 1.)
+            y = np.clip(cy - n * r * np.sin(l[I]), 0., H - 1.)
+            ebv[I] = self._interp(image, hemi, x, y)
         return ebv
 
     def extinction(self, filts, ra, dec, get_ebv=False):
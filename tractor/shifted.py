@@ -151,6 +151,11 @@ class ScaledWcs(ParamsWrapper, ducks.ImageCalibration):
         return ((x + 0.5) * self.factor - 0.5,
                 (y + 0.5) * self.factor - 0.5)
 
+    def positionsToPixels(self, ra, dec):
+        x, y = self.wcs.positionsToPixels(ra, dec)
+        return ((x + 0.5) * self.factor - 0.5,
+                (y + 0.5) * self.factor - 0.5)
+
 
 class ShiftedWcs(ParamsWrapper, ducks.ImageCalibration):
     '''
@@ -185,6 +190,10 @@ class ShiftedWcs(ParamsWrapper, ducks.ImageCalibration):
         x, y = self.wcs.positionToPixel(pos, src=src)
         return (x - self.x0, y - self.y0)
 
+    def positionsToPixels(self, ra, dec):
+        x, y = self.wcs.positionsToPixels(ra, dec)
+        return (x - self.x0, y - self.y0)
+
     def pixelToPosition(self, x, y, src=None):
         pos = self.wcs.pixelToPosition(x + self.x0, y + self.y0, src=src)
         return pos
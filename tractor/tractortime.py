@@ -34,9 +34,16 @@ class TAITime(ScalarParam, ArithmeticParams):
         return self.getValue() / (24. * 3600.)
 
     def getSunTheta(self):
+        # Cached, since this is evaluated for every source in every
+        # image; keyed by the time value in case it has been changed.
+        t = self.getValue()
+        cached = self.__dict__.get('_suntheta', None)
+        if cached is not None and cached[0] == t:
+            return cached[1]
         mjd = self.toMjd()
         th = 2. * np.pi * (mjd - TAITime.equinox) / TAITime.daysperyear
         th = np.fmod(th, 2. * np.pi)
+        self._suntheta = (t, th)
         return th
 
     def toYears(self):
@@ -55,6 +55,27 @@ def listmax(X, default=0):
     return np.max(mx)
 
 
+def sumsq(X, blocksize=65536):
+    '''
+    Returns the sum of squares of the elements of array *X*, as a
+    float, accurate to double precision whatever the type of *X*.
+
+    Single-precision arrays are squared (exactly) in double precision
+    in blocks of *blocksize* elements, so no double-precision copy of
+    *X* is made, and the block sums are combined with compensated
+    (`math.fsum`) summation.
+    '''
+    import math
+    X = np.asarray(X).ravel()
+    if X.dtype == np.float64:
+        return float(np.dot(X, X))
+    sums = []
+    for i in range(0, len(X), blocksize):
+        x = X[i: i + blocksize].astype(np.float64)
+        sums.append(np.dot(x, x))
+    return math.fsum(sums)
+
+
 def getClassName(obj):
     name = getattr(obj.__class__, 'classname', None)
     if name is not None:
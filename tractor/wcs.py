@@ -30,6 +30,12 @@ class NullWCS(BaseParams, ducks.WCS):
     def positionToPixel(self, pos, src=None):
         return pos.x + self.dx, pos.y + self.dy
 
+    def positionsToPixels(self, x, y):
+        '''
+        Like `positionToPixel`, for arrays of `PixPos` *x*, *y*.
+        '''
+        return np.atleast_1d(x) + self.dx, np.atleast_1d(y) + self.dy
+
     def pixelToPosition(self, x, y, src=None):
         return x - self.dx, y - self.dy
 
@@ -46,7 +52,7 @@ class NullWCS(BaseParams, ducks.WCS):
         return self.pixscale
 
     def shifted(self, x, y):
-        return self.copy()
+        return NullWCS(pixscale=self.pixscale, dx=self.dx - x, dy=self.dy - y)
 
 
 class WcslibWcs(BaseParams, ducks.ImageCalibration):
@@ -154,6 +160,12 @@ class ConstantFitsWcs(ParamList, ducks.WCS):
     offset).
     '''
 
+    # If not None, a dict of (ra, dec) -> (x, y) pixel positions, for
+    # the current WCS state, consulted by positionToPixel.  The Tractor
+    # sets this while rendering model images; see
+    # Tractor.getPixelPositions.
+    pixcache = None
+
     def __init__(self, wcs):
         '''
         Creates a new ``ConstantFitsWcs`` given an underlying WCS object.
@@ -205,6 +217,10 @@ class ConstantFitsWcs(ParamList, ducks.WCS):
         Converts an :class:`tractor.RaDecPos` to a pixel position.
         Returns: tuple of floats ``(x, y)``
         '''
+        if self.pixcache is not None:
+            xy = self.pixcache.get((pos.ra, pos.dec), None)
+            if xy is not None:
+                return xy
         X = self.wcs.radec2pixelxy(pos.ra, pos.dec)
         # handle X = (ok,x,y) and X = (x,y) return values
         if len(X) == 3:
@@ -215,6 +231,25 @@ class ConstantFitsWcs(ParamList, ducks.WCS):
         # MAGIC: subtract 1 to convert from FITS to zero-indexed pixels.
         return x - 1 - self.x0, y - 1 - self.y0
 
+    def positionsToPixels(self, ra, dec):
+        '''
+        Converts numpy arrays *ra*, *dec* to arrays of pixel positions
+        ``x, y``, with one call to the wrapped WCS.
+        '''
+        ra = np.atleast_1d(ra).astype(float)
+        dec = np.atleast_1d(dec).astype(float)
+        if len(ra) == 0:
+            return np.zeros(0), np.zeros(0)
+        X = self.wcs.radec2pixelxy(ra, dec)
+        if len(X) == 3:
+            ok, x, y = X
+        else:
+            assert(len(X) == 2)
+            x, y = X
+        # MAGIC: subtract 1 to convert from FITS to zero-indexed pixels.
+        return (np.atleast_1d(x) - 1 - self.x0,
+                np.atleast_1d(y) - 1 - self.y0)
+
     def pixelToPosition(self, x, y, src=None):
         '''
         Converts floats ``x``, ``y`` to a
@@ -235,6 +270,9 @@ class ConstantFitsWcs(ParamList, ducks.WCS):
     def cdInverseAtPixel(self, x, y):
         return self.cd_inverse
 
+    def cdInverseAtPixels(self, x, y):
+        return np.tile(self.cd_inverse, (len(np.atleast_1d(x)), 1, 1))
+
     def pixel_scale(self):
         return self.pixscale
 
@@ -292,7 +330,7 @@ class TanWcs(ConstantFitsWcs, ducks.ImageCalibration):
         self.x0 = 0
         self.y0 = 0
 
-        if isinstance(wcs, basestring):
+        if isinstance(wcs, str):
             from astrometry.util.util import Tan
             wcs = Tan(wcs, hdu)
 
@@ -300,6 +338,10 @@ class TanWcs(ConstantFitsWcs, ducks.ImageCalibration):
         # ParamList keeps its params in a list; we don't want to do that.
         del self.vals
 
+    def hashkey(self):
+        # Unlike the ConstantFitsWcs, our WCS parameters can change.
+        return ('TanWcs', id(self.wcs)) + tuple(self._getThings())
+
     def copy(self):
         from astrometry.util.util import Tan
         wcs = self.__class__(Tan(self.wcs))
@@ -369,6 +411,106 @@ class TanWcs(ConstantFitsWcs, ducks.ImageCalibration):
         ss = [dcrval, dcrval, 1., 1., dcd, dcd, dcd, dcd, 1., 1.]
         return list(self._getLiquidArray(ss))
 
+    def getParamDerivatives(self, tractor, img, srcs):
+        '''
+        Returns the derivatives of the model image with respect to the
+        thawed WCS parameters, as a list of Patches.
+
+        These are built by the chain rule: for each source, the
+        derivatives of its model patch with respect to its pixel
+        position, times the derivatives of its pixel position with
+        respect to the WCS parameters.  (As when the Tractor takes
+        finite differences, the CD matrix used to map galaxy shapes
+        into pixel space is not updated.)  Returns False for all
+        parameters, to get finite differences, if any source is not a
+        point source or galaxy.
+        '''
+        from tractor.pointsource import PointSource
+        from tractor.galaxy import ProfileGalaxy
+        from tractor.patch import Patch
+
+        n = self.numberOfParams()
+        if n == 0:
+            return []
+        srcs = [src for src in srcs if src is not None]
+        for src in srcs:
+            if not (type(src) is PointSource or
+                    isinstance(src, ProfileGalaxy)):
+                return [False] * n
+        assert(img.getWcs() is self)
+
+        p0 = self.getParams()
+        steps = self.getStepSizes()
+        # d(pixel position) / d(WCS params) for all sources, by
+        # central differences
+        ra = np.array([src.getPosition().ra for src in srcs])
+        dec = np.array([src.getPosition().dec for src in srcs])
+        dxy = np.zeros((len(srcs), n, 2))
+        for i in range(n):
+            self.setParam(i, p0[i] + steps[i])
+            x1, y1 = self.positionsToPixels(ra, dec)
+            self.setParam(i, p0[i] - steps[i])
+            x0, y0 = self.positionsToPixels(ra, dec)
+            self.setParam(i, p0[i])
+            dxy[:, i, 0] = (x1 - x0) / (2. * steps[i])
+            dxy[:, i, 1] = (y1 - y0) / (2. * steps[i])
+
+        derivs = [np.zeros(img.getModelShape(), tractor.modtype)
+                  for i in range(n)]
+        for j, src in enumerate(srcs):
+            terms = self._getPixelDerivativeTerms(tractor, img, src)
+            for patch, wx, wy in terms:
+                for i in range(n):
+                    scale = wx * dxy[j, i, 0] + wy * dxy[j, i, 1]
+                    if scale != 0:
+                        patch.addTo(derivs[i], scale=scale)
+
+        names = self.getParamNames()
+        patches = []
+        for name, deriv in zip(names, derivs):
+            p = Patch(0, 0, deriv)
+            p.setName('d(wcs)/d(%s)' % name)
+            patches.append(p)
+        return patches
+
+    def _getPixelDerivativeTerms(self, tractor, img, src, step=0.01):
+        '''
+        Returns a list of (patch, wx, wy) such that the derivatives of
+        the model patch of *src* with respect to its pixel position
+        are sum(wx * patch) and sum(wy * patch).  These are analytic
+        for point sources whose PSF supplies derivatives, and central
+        differences (of *step* pixels) otherwise.
+        '''
+        from tractor.pointsource import PointSource
+        mask = tractor._getModelMaskFor(img, src)
+        if tractor.expectModelMasks and mask is None:
+            return []
+        if type(src) is PointSource:
+            counts = img.getPhotoCal().brightnessToCounts(src.getBrightness())
+            if counts == 0:
+                return []
+            patches = src.getUnitFluxModelPatch(img, derivs=True,
+                                                modelMask=mask)
+            if patches is None:
+                return []
+            if isinstance(patches, tuple):
+                _, patchdx, patchdy = patches
+                return [(patchdx, counts, 0.), (patchdy, 0., counts)]
+
+        terms = []
+        x0, y0 = self.x0, self.y0
+        try:
+            for dx, dy in [(step, 0.), (-step, 0.), (0., step), (0., -step)]:
+                # Decreasing the pixel offset moves sources up in pixel space.
+                self.x0, self.y0 = x0 - dx, y0 - dy
+                mod = tractor.getModelPatch(img, src)
+                if mod is None:
+                    continue
+                terms.append((mod, dx / (2. * step**2), dy / (2. * step**2)))
+        finally:
+            self.x0, self.y0 = x0, y0
+        return terms
+
 
 class PixPos(ParamList):
     '''
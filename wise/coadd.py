@@ -0,0 +1,314 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+Resampling of individual (eg, WISE L1b) frames onto a target WCS, and
+co-adding of the resampled frames.
+
+A `ResampleMap` holds the pixel mapping between one frame and the target
+WCS -- nearest-neighbour indices plus the sub-pixel offsets needed for
+Lanczos-3 interpolation -- so the (slow) WCS transformations are done once
+per (frame, target) pair, and then reused for the image, inverse-variance,
+model and mask.  Resampled frames are kept as vectors over the overlapping
+target pixels only, and a `Coadd` accumulates them in place.
+'''
+from __future__ import print_function
+
+import numpy as np
+
+from astrometry.util.resample import resample_with_wcs, OverlapError
+
+
+def _input_positions(targetwcs, wcs, Xo, Yo, spline=True, step=25):
+    '''
+    Returns (ok, fx, fy): the (zero-indexed, floating-point) input-frame
+    positions of target pixels (*Xo*, *Yo*).
+
+    If *spline*, the WCS transformations are evaluated only on a grid with
+    spacing *step* target pixels covering (*Xo*, *Yo*), and interpolated
+    from there.
+    '''
+    if spline:
+        from scipy.interpolate import RectBivariateSpline
+        # Grid nodes spanning the pixels plus one node either side, and at
+        # least the four nodes a cubic spline needs.
+        gx = Xo.min() + step * np.arange(
+            -1, max(2, int(np.ceil((Xo.max() - Xo.min()) / float(step)))) + 2)
+        gy = Yo.min() + step * np.arange(
+            -1, max(2, int(np.ceil((Yo.max() - Yo.min()) / float(step)))) + 2)
+        gxx, gyy = np.meshgrid(gx.astype(float), gy.astype(float))
+        rr, dd = targetwcs.pixelxy2radec(gxx.ravel() + 1., gyy.ravel() + 1.)
+        ok, gfx, gfy = wcs.radec2pixelxy(rr, dd)
+        if np.all(ok):
+            shape = (len(gy), len(gx))
+            fx = RectBivariateSpline(gy, gx, gfx.reshape(shape) - 1.).ev(Yo, Xo)
+            fy = RectBivariateSpline(gy, gx, gfy.reshape(shape) - 1.).ev(Yo, Xo)
+            return np.ones(len(Xo), bool), fx, fy
+        # (grid points off the input projection: do it exactly)
+    rr, dd = targetwcs.pixelxy2radec(Xo + 1., Yo + 1.)
+    ok, fx, fy = wcs.radec2pixelxy(rr, dd)
+    return np.asarray(ok, bool), fx - 1., fy - 1.
+
+
+class ResampleMap(object):
+    '''
+    The mapping from target pixels (*Yo*, *Xo*) to input-frame pixels
+    (*Yi*, *Xi*), where the input pixel position is (*Xi* + *dx*,
+    *Yi* + *dy*), with *Xi*, *Yi* the nearest pixel (so |*dx*|, |*dy*| <=
+    0.5).
+
+    This object holds only numpy arrays, so it is cheap to pickle (eg,
+    to return from a multiprocessing worker, or to save in a stage
+    pickle).
+    '''
+    def __init__(self, targetwcs, wcs, spline=True, reverse=False):
+        '''
+        *targetwcs*, *wcs*: astrometry.net WCS objects of the target and
+        input frame.
+
+        If *spline*, the input-frame positions are interpolated from a
+        coarse grid rather than computed for every target pixel.  The
+        nearest pixels and sub-pixel offsets both come from these same
+        positions.
+
+        If *reverse*, also computes the nearest-neighbour mapping from the
+        target back to the input frame, for `reverse()`.
+
+        Raises OverlapError if the images do not overlap.
+        '''
+        self.shape = (int(targetwcs.get_height()), int(targetwcs.get_width()))
+        self.inshape = (int(wcs.get_height()), int(wcs.get_width()))
+        # (only used to find the overlapping target pixels)
+        Yo, Xo, nil, nil, nil = resample_with_wcs(targetwcs, wcs, [], [],
+                                                  spline=spline)
+        ok, fx, fy = _input_positions(targetwcs, wcs, Xo, Yo, spline=spline)
+        Xi = np.round(fx).astype(np.int32)
+        Yi = np.round(fy).astype(np.int32)
+        h, w = self.inshape
+        K = np.flatnonzero(ok * (Xi >= 0) * (Xi < w) * (Yi >= 0) * (Yi < h))
+        if len(K) == 0:
+            raise OverlapError()
+        self.Yo = Yo[K].astype(np.int32)
+        self.Xo = Xo[K].astype(np.int32)
+        self.Yi = Yi[K]
+        self.Xi = Xi[K]
+        self.dx = (fx[K] - Xi[K]).astype(np.float32)
+        self.dy = (fy[K] - Yi[K]).astype(np.float32)
+        self.rev = None
+        if reverse:
+            try:
+                yo, xo, yi, xi, nil = resample_with_wcs(wcs, targetwcs, [], [])
+                self.rev = (yo.astype(np.int32), xo.astype(np.int32),
+                            yi.astype(np.int32), xi.astype(np.int32))
+            except OverlapError:
+                self.rev = ()
+
+    def __len__(self):
+        return len(self.Yo)
+
+    def input_extent(self, margin=3):
+        '''
+        Returns (x0, x1, y0, y1), the (clipped) region of the input frame
+        touched by the mapping, plus *margin* pixels (the Lanczos kernel
+        radius).
+        '''
+        h, w = self.inshape
+        return (max(0, self.Xi.min() - margin),
+                min(w, self.Xi.max() + margin + 1),
+                max(0, self.Yi.min() - margin),
+                min(h, self.Yi.max() + margin + 1))
+
+    def nearest(self, img):
+        '''
+        Returns the nearest-neighbour resampling of input-frame image *img*,
+        a vector over the overlapping target pixels.
+        '''
+        return img[self.Yi, self.Xi]
+
+    def lanczos(self, imgs, x0=0, y0=0):
+        '''
+        Returns the Lanczos-3 resampling of each of the input-frame images
+        in list *imgs*, as float32 vectors over the overlapping target
+        pixels.
+
+        The images may be cut-outs of the frame, with pixel (0,0) at frame
+        pixel (*x0*, *y0*).
+        '''
+        from astrometry.util.util import lanczos3_interpolate
+        ix, iy = self.Xi, self.Yi
+        if x0 or y0:
+            ix = ix - np.int32(x0)
+            iy = iy - np.int32(y0)
+        rims = [np.zeros(len(self), np.float32) for img in imgs]
+        lanczos3_interpolate(ix, iy, self.dx, self.dy, rims,
+                             [img.astype(np.float32) for img in imgs])
+        return rims
+
+    def expand(self, vals, dtype=np.float32, out=None):
+        '''
+        Returns a full target-sized image containing vector *vals* (eg,
+        from `nearest()` or `lanczos()`) and zeros elsewhere.
+        '''
+        if out is None:
+            out = np.zeros(self.shape, dtype)
+        out[self.Yo, self.Xo] = vals
+        return out
+
+    def gather(self, img):
+        '''
+        Returns target-sized image *img* at the overlapping target pixels.
+        '''
+        return img[self.Yo, self.Xo]
+
+    def reverse(self, img, dtype=np.float32):
+        '''
+        Returns target-sized image *img* resampled (nearest-neighbour) back
+        to the input frame, or None if the reverse mapping is empty.
+        Requires the map to have been created with *reverse=True*.
+        '''
+        if self.rev is None:
+            raise RuntimeError('ResampleMap created without reverse=True')
+        if len(self.rev) == 0:
+            return None
+        yo, xo, yi, xi = self.rev
+        rimg = np.zeros(self.inshape, dtype)
+        rimg[yo, xo] = img[yi, xi]
+        return rimg
+
+
+class ResampledFrame(object):
+    '''
+    One frame resampled onto the target WCS, sky-subtracted and scaled.
+    The vectors *rimg* (Lanczos), *nnimg* (nearest-neighbour) and *mask*
+    (invvar > 0) are over the overlapping pixels of `map`.
+    '''
+    def expand(self, vals, dtype=np.float32):
+        return self.map.expand(vals, dtype=dtype)
+
+    @property
+    def w(self):
+        return 1. / self.sig1**2
+
+
+def resample_frame(img, invvar, wcs, targetwcs, sky=0., scale=1., sig1=1.,
+                   required=None, spline=True, reverse=False, name=None):
+    '''
+    Resamples frame *img* onto *targetwcs*, returning a ResampledFrame
+    with pixel values (img - sky) * scale, or None if the frame does not
+    overlap the target or patching its masked pixels fails.
+
+    Masked pixels (*invvar* == 0) are patched before Lanczos interpolation;
+    *required* is the mask of pixels that must be patched.
+    '''
+    from astrometry.util.miscutils import patch_image
+    try:
+        rmap = ResampleMap(targetwcs, wcs, spline=spline, reverse=reverse)
+    except OverlapError:
+        return None
+
+    # Patch masked pixels so we can interpolate -- only in the part of the
+    # frame that the Lanczos kernels touch.
+    x0, x1, y0, y1 = rmap.input_extent()
+    slc = slice(y0, y1), slice(x0, x1)
+    patchimg = img[slc].astype(np.float32)
+    ok = patch_image(patchimg, invvar[slc] > 0,
+                     required=(None if required is None else required[slc]))
+    if not ok:
+        print('WARNING: patching failed.  Image size', patchimg.shape)
+        if required is not None:
+            print('Wanted to patch', np.count_nonzero(required[slc]),
+                  'pixels')
+        return None
+    rpix, = rmap.lanczos([patchimg], x0=x0, y0=y0)
+    del patchimg
+
+    scale = np.float32(scale)
+    sky = np.float32(sky)
+    f = ResampledFrame()
+    f.name = name
+    f.map = rmap
+    f.rimg = (rpix - sky) * scale
+    f.nnimg = (rmap.nearest(img).astype(np.float32) - sky) * scale
+    f.mask = (rmap.nearest(invvar) > 0)
+    f.sky = sky
+    f.scale = scale
+    f.sig1 = sig1 * scale
+    f.npix1 = np.count_nonzero(invvar > 0)
+    f.npix2 = np.count_nonzero(f.mask)
+    return f
+
+
+def _resample_frame(kwargs):
+    return resample_frame(**kwargs)
+
+
+def resample_frames(mp, frames, chunk=None):
+    '''
+    Resamples frames in parallel with multiprocessing object *mp*.
+
+    *frames*: list of dicts of `resample_frame` keyword arguments.
+
+    *chunk*: if set, frames are handed to *mp* this many at a time, which
+    bounds the number of frames (inputs and full-size temporaries) in
+    flight.
+
+    Returns a list of ResampledFrame (or None) objects.
+    '''
+    if chunk is None:
+        return list(mp.map(_resample_frame, frames))
+    res = []
+    for i in range(0, len(frames), chunk):
+        res.extend(mp.map(_resample_frame, frames[i:i + chunk]))
+    return res
+
+
+class Coadd(object):
+    '''
+    Inverse-variance weighted co-add, accumulated in place, in float32,
+    over the overlapping pixels of each ResampleMap.
+    '''
+    def __init__(self, H, W, nn=False):
+        self.wsum = np.zeros((H, W), np.float32)
+        self.sum = np.zeros((H, W), np.float32)
+        self.sum2 = np.zeros((H, W), np.float32)
+        self.nnsum = None
+        if nn:
+            self.nnsum = np.zeros((H, W), np.float32)
+
+    def add(self, rmap, img, w, nnimg=None):
+        '''
+        Adds resampled vector *img* (and *nnimg*), with weight *w* (a scalar
+        or vector), at the pixels of ResampleMap *rmap*.
+        '''
+        # (each target pixel appears at most once in a ResampleMap)
+        I = (rmap.Yo, rmap.Xo)
+        w = np.broadcast_to(np.float32(w) if np.isscalar(w)
+                            else w.astype(np.float32), img.shape)
+        self.wsum[I] += w
+        wimg = img * w
+        self.sum[I] += wimg
+        wimg *= img
+        self.sum2[I] += wimg
+        if nnimg is not None and self.nnsum is not None:
+            self.nnsum[I] += nnimg * w
+
+    # For W4, single-image weights are ~ 1e-10
+    tinyw = 1e-16
+
+    def image(self):
+        return self.sum / np.maximum(self.wsum, self.tinyw)
+
+    def nnimage(self):
+        return self.nnsum / np.maximum(self.wsum, self.tinyw)
+
+    def invvar(self):
+        return self.wsum.copy()
+
+    def ppstd(self, coimg=None):
+        '''
+        Returns the per-pixel (weighted) standard deviation of the frames.
+        '''
+        if coimg is None:
+            coimg = self.image()
+        var = self.sum2 / np.maximum(self.wsum, self.tinyw) - coimg**2
+        return np.sqrt(np.maximum(var, 0.))
@@ -28,6 +28,7 @@ from tractor.sdss import *
 from tractor.galaxy import *
 
 import wise
+from wise.coadd import Coadd, resample_frames
 
 
 def get_l1b_file(basedir, scanid, frame, band):
@@ -382,104 +383,84 @@ def stage104(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
 
     tims = tractor.getImages()
 
-    # Resample
-    ims = mp.map(_resample_one, [(tim, None, cowcs, True) for tim in tims])
+    # Resample.  The pixel mapping of each frame onto the coadd (and back)
+    # is computed once, and reused for the image, invvar and mask here, and
+    # for the model in stage107.  Frames are handed out in chunks, to bound
+    # the number of frames (and their full-size temporaries) in flight.
+    chunk = opt.resample_chunk
+    if chunk is None:
+        chunk = 4 * max(1, opt.threads or 1)
+    ims = resample_frames(mp, [_resample_args(tim, cowcs) for tim in tims],
+                          chunk=chunk)
 
     # Coadd
-    lancsum = np.zeros((H, W))
-    lancsum2 = np.zeros((H, W))
-    wsum = np.zeros((H, W))
+    co = Coadd(H, W)
     for i, d in enumerate(ims):
         if d is None:
             print('No overlap:', tims[i])
             print('image shape:', tims[i].shape)
             print('# valid pix:', np.sum(tims[i].invvar > 0))
             continue
-        lancsum += (d.rimg * d.ww)
-        lancsum2 += (d.rimg**2 * d.ww)
-        wsum += d.ww
+        co.add(d.map, d.rimg, d.w * d.mask)
 
-        # plt.clf()
-        # plt.subplot(1,2,1)
-        # plt.imshow(lancsum, interpolation='nearest', origin='lower')
-        # plt.colorbar()
-        # plt.subplot(1,2,2)
-        # plt.imshow(wsum, interpolation='nearest', origin='lower')
-        # plt.colorbar()
-        # plt.suptitle('coadd step %i' % i)
-        # ps.savefig()
-        # print 'median ww:', np.median(d.ww)
-        # print 'sig1:', d.sig1
-
-    # For W4, single-image ww is ~ 1e-10
-    tinyw = 1e-16
-    coimg = (lancsum / np.maximum(wsum, tinyw))
-    coinvvar = wsum
+    coimg = co.image()
+    coinvvar = co.invvar()
     coimg1 = coimg
 
     sig = 1. / np.sqrt(np.median(coinvvar[coinvvar > 0]))
     print('Coadd sig:', sig)
     # Per-pixel std
-    coppstd = np.sqrt(lancsum2 / (np.maximum(wsum, tinyw)) - coimg**2)
+    coppstd = co.ppstd(coimg)
     coppstd1 = coppstd
     sig1 = sig
 
     # Using the difference between the coadd and the resampled
     # individual images ("rchi"), mask additional pixels and redo the
     # coadd.
-    nnsum = np.zeros((H, W))
-    lancsum[:, :] = 0
-    lancsum2[:, :] = 0
-    wsum[:, :] = 0
+    co = Coadd(H, W, nn=True)
     for d in ims:
         if d is None:
             continue
-        rchi = (d.rimg - coimg) * d.mask / np.maximum(coppstd, 1e-6)
-        badpix = (np.abs(rchi) >= 5.)
+        rchi = ((d.rimg - d.map.gather(coimg)) * d.mask /
+                np.maximum(d.map.gather(coppstd), 1e-6))
+        badpix = (np.abs(d.expand(rchi)) >= 5.)
         # grow by a small margin
         badpix = binary_dilation(badpix)
-        notbad = np.logical_not(badpix)
         d.rchi = rchi
-        d.mask *= notbad
-        w = (1. / d.sig1**2)
-        ww = w * d.mask
-        # update d.ww?
-        nnsum += (d.nnimg * ww)
-        lancsum += (d.rimg * ww)
-        lancsum2 += (d.rimg**2 * ww)
-        wsum += ww
-    conn = (nnsum / np.maximum(wsum, tinyw))
-    coimg = (lancsum / np.maximum(wsum, tinyw))
-    coinvvar = wsum
+        d.mask &= np.logical_not(d.map.gather(badpix))
+        co.add(d.map, d.rimg, d.w * d.mask, nnimg=d.nnimg)
+    conn = co.nnimage()
+    coimg = co.image()
+    coinvvar = co.invvar()
 
     print('Second-round coadd:')
     sig = 1. / np.sqrt(np.median(coinvvar[coinvvar > 0]))
     print('Coadd sig:', sig)
     # per-pixel variance
-    coppstd = np.sqrt(lancsum2 / (np.maximum(wsum, tinyw)) - coimg**2)
+    coppstd = co.ppstd(coimg)
+    del co
 
     # 2. Apply rchi masks to individual images
     print('Applying rchi masks to images...')
-    tims = tractor.getImages()
-
-    args = []
     for i, (tim, d) in enumerate(zip(tims, ims)):
-        if d is None:
-            args.append((tim, None, cowcs))
-            continue
-        args.append((tim, d.mask, cowcs))
-    rmasks = mp.map(_rev_resample_mask, args)
-
-    for i, (mask, tim) in enumerate(zip(rmasks, tims)):
+        mask = None
+        if d is not None:
+            mask = d.map.reverse(d.expand(d.mask))
         if mask is None:
             tim.coaddmask = None
             continue
         tim.coaddmask = mask
         tim.orig_invvar = tim.invvar
-        if mask is not None:
-            tim.setInvvar(tim.invvar * (mask > 0))
-        else:
-            tim.setInvvar(tim.invvar)
+        tim.setInvvar(tim.invvar * (mask > 0))
+
+    # Full-size resampled images, for plots and later stages
+    for d in ims:
+        if d is None:
+            continue
+        d.rimg = d.expand(d.rimg)
+        d.rchi = d.expand(d.rchi)
+        d.mask = d.expand(d.mask, dtype=bool)
+        del d.nnimg
 
     if ps:
         # Mosaic of all individual exposures
@@ -748,123 +729,14 @@ def get_sip_subwcs(wcs, extent):
     return wcs.get_subimage(int(x0), int(y0), int(x1 - x0), int(y1 - y0))
 
 
-def _resample_one(argl):
-    (tim, mod, targetwcs, spline) = args
-    print('Resampling', tim.name)
-    wcs2 = get_sip_subwcs(tim.getWcs().wcs, tim.extent)
-    try:
-        yo, xo, yi, xi, _ = resample_with_wcs(
-            targetwcs, wcs2, [], [], spline=spline)
-    except OverlapError:
-        return None
-    W, H = targetwcs.get_width(), targetwcs.get_height()
-    nnim = np.zeros((H, W))
-    # print 'extent', tim.extent
-    # print 'tim shape', tim.shape, tim.data.shape
-    # print 'wcs2:', wcs2
-    # print 'xi', xi.min(), xi.max()
-    # print 'yi', yi.min(), yi.max()
-    # print 'target W,H', W,H
-    # print 'xo', xo.min(), xo.max()
-    # print 'yo', yo.min(), yo.max()
-    nnim[yo, xo] = tim.data[yi, xi]
-    iv = np.zeros((H, W))
-    iv[yo, xo] = tim.invvar[yi, xi]
-    # Patch masked pixels so we can interpolate
-    patchimg = tim.data.copy()
-    ok = patch_image(patchimg, tim.invvar > 0,
-                     required=tim.rdmask)
-    if not ok:
-        print('WARNING: patching failed.  Image size', patchimg.shape)
-        print('Wanted to patch', np.count_nonzero(tim.rdmask), 'pixels')
-        return None
-
-    # Resample
-    Lorder = 3
-    inims = [patchimg]
-    if mod is not None:
-        inims.append(mod)
-    try:
-        yo, xo, yi, xi, rpix = resample_with_wcs(
-            targetwcs, wcs2, inims, Lorder, spline=spline)
-    except OverlapError:
-        return None
-    rpatch = np.zeros((H, W))
-    rpatch[yo, xo] = rpix[0]
-
-    sig1 = tim.sigma1
-    sky = tim.getSky().getValue()
+def _resample_args(tim, targetwcs):
     # photocal.getScale() takes nanomaggies to image counts; we want to convert
     # images to nanomaggies (per pix)
-    scale = 1. / tim.getPhotoCal().getScale()
-    sig1 = sig1 * scale
-
-    rmod = None
-    if mod is not None:
-        rmod = np.zeros((H, W))
-        rmod[yo, xo] = rpix[1]
-        rmod = (rmod - sky) * scale
-    # print 'scale', scale, 'scaled sig1:', sig1
-    w = (1. / sig1**2)
-    ww = w * (iv > 0)
-
-    d = Duck()
-    d.nnimg = (nnim - sky) * scale
-    d.rimg = (rpatch - sky) * scale
-    d.rmod = rmod
-    d.ww = ww
-    d.mask = (iv > 0)
-    d.sig1 = sig1
-    d.name = tim.name
-    d.mod = mod
-    d.img = tim.data
-    d.invvar = tim.invvar
-    d.sky = sky
-    d.scale = scale
-    d.npix1 = np.sum(tim.getInvError() > 0)
-    if rmod is not None:
-        d.lnp1 = np.sum(((mod - tim.getImage()) * tim.getInvError())**2)
-        d.lnp2 = np.sum(((rmod - rpatch)**2 * iv))
-    else:
-        d.lnp1 = 0.
-        d.lnp2 = 0.
-    d.npix2 = np.sum(iv > 0)
-    return d
-
-
-def _resample_mod(args):
-    (tim, mod, targetwcs, spline) = args
-    W, H = targetwcs.get_width(), targetwcs.get_height()
-    wcs2 = get_sip_subwcs(tim.getWcs().wcs, tim.extent)
-    Lorder = 3
-    try:
-        yo, xo, yi, xi, rpix = resample_with_wcs(
-            targetwcs, wcs2, [mod], Lorder, spline=spline)
-    except OverlapError:
-        return None
-    rmod = np.zeros((H, W))
-    rmod[yo, xo] = rpix[0]
-    iv = np.zeros((H, W))
-    iv[yo, xo] = tim.invvar[yi, xi]
-    sig1 = tim.sigma1
-    w = (1. / sig1**2)
-    ww = w * (iv > 0)
-    return rmod, ww
-
-
-def _rev_resample_mask(args):
-    (tim, mask, targetwcs) = args
-    if mask is None:
-        return None
-    wcs2 = get_sip_subwcs(tim.getWcs().wcs, tim.extent)
-    try:
-        yo, xo, yi, xi, nil = resample_with_wcs(wcs2, targetwcs, [], [])
-    except OverlapError:
-        return None
-    w, h = int(wcs2.get_width()), int(wcs2.get_height())
-    rmask = np.zeros((h, w))
-    rmask[yo, xo] = mask[yi, xi]
-    return rmask
+    return dict(img=tim.data, invvar=tim.invvar,
+                wcs=get_sip_subwcs(tim.getWcs().wcs, tim.extent),
+                targetwcs=targetwcs, sky=tim.getSky().getValue(),
+                scale=1. / tim.getPhotoCal().getScale(), sig1=tim.sigma1,
+                required=tim.rdmask, spline=True, reverse=True, name=tim.name)
 
 
 def stage107(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
@@ -872,6 +744,7 @@ def stage107(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
              tractor=None, ims1=None,
              mp=None,
              coimg=None, coinvvar=None, coppstd=None, cowcs=None,
+             resampled=None,
              # comod=None,
              # ims2=None,
              **kwa):
@@ -889,7 +762,7 @@ def stage107(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
         scale = 1. / tim.getPhotoCal().getScale()
         modx = (mod - sky) * scale
 
-        args.append((tim, modx, cowcs, True))
+        args.append((tim, modx))
 
         if i < 10 and ps is not None:
 
@@ -924,28 +797,19 @@ def stage107(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
             plt.suptitle(tim.name)
             ps.savefig()
 
-    mims = mp.map(_resample_mod, args)
-
-    # redo = []
-    # for i,(mim,(t,m,c,nil)) in enumerate(zip(mims,args)):
-    #     if mim is None:
-    #         redo.append((t,m,c,False))
-    # if len(redo):
-    #     mims2 = mp.map(_resample_mod, redo)
-    #     j = 0
-    #     for i,mim in enumerate(mims):
-    #         if mim is None:
-    #             mims[i] = mims2[j]
-    #             j += 1
-
-    modsum2 = np.zeros((H, W))
-    wsum2 = np.zeros((H, W))
-    for mim in mims:
-        if mim is None:
+    # Resample the models with the frames' maps from stage104
+    co = Coadd(H, W)
+    for (tim, modx), d in zip(args, resampled):
+        if d is None:
             continue
-        rmod, ww = mim
-        modsum2 += (rmod * ww)
-        wsum2 += ww
+        rmod, = d.map.lanczos([modx])
+        w = (1. / tim.sigma1**2)
+        co.add(d.map, rmod, w * (d.map.nearest(tim.invvar) > 0))
+        # No later stage needs the maps (stage700 uses only the full-size
+        # images); drop them to keep the stage pickles small.
+        d.map = None
+    modsum2, wsum2 = co.sum, co.wsum
+    del co
     comod2 = modsum2 / np.maximum(wsum2, 1e-12)
     cochi2 = (coimg - comod2) * np.sqrt(coinvvar)
 
@@ -980,7 +844,7 @@ def stage107(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
         # plt.colorbar()
         # ps.savefig()
 
-    return dict(comod2=comod2)
+    return dict(comod2=comod2, resampled=resampled)
 
 
 def stage108(opt=None, ps=None, ralo=None, rahi=None, declo=None, dechi=None,
@@ -2212,10 +2076,7 @@ def stage606():
     # 2. Apply rchi masks to individual images
     tims = tractor.getImages()
 
-    args = []
-    for i, (tim, d) in enumerate(zip(tims, ims)):
-        args.append((tim, d.mask, cowcs))
-    rmasks = mp.map(_rev_resample_mask, args)
+    rmasks = [d.map.reverse(d.mask) for d in ims]
     for i, (mask, tim) in enumerate(zip(rmasks, tims)):
         # if i < 10:
         #     plt.clf()
@@ -2356,11 +2217,6 @@ def stage700(opt=None, ps=None, tractor=None, band=None, bandnum=None, T=None,
         # print 'd:', dir(d)
         d.rimg = d.rimg.astype(np.float32)
         d.rchi = d.rchi.astype(np.float32)
-        delattr(d, 'nnimg')
-        delattr(d, 'invvar')
-        delattr(d, 'ww')
-        delattr(d, 'mod')
-        delattr(d, 'img')
 
         # print 'd:'
         # for x in dir(d):
@@ -2675,6 +2531,9 @@ def main():
                       help='Stage pickle pattern')
 
     parser.add_option('--threads', dest='threads', type=int, help='Multiproc')
+    parser.add_option('--resample-chunk', dest='resample_chunk', type=int,
+                      help='Resample this many frames at a time (default: '
+                      '4 per thread)')
 
     parser.add_option('--osources', dest='osources',
                       help='File containing competing measurements to produce a model image for')